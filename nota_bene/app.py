@@ -4,11 +4,13 @@ import sys
 import os
 import re
 import subprocess
-from nota_bene.utils import init_session_keys, list_subdirectories, file_to_bytesio, set_project_paths, save_session
+from nota_bene.utils import init_session_keys, set_project_paths, load_project, project_has, configure_http_pool
+from nota_bene.projects import list_projects, read_manifest, describe_project
+from nota_bene.session_store import forget_session_store
+from nota_bene.artifacts import get_artifact_store
+from nota_bene.audio import set_probe_cache_dir
 import shutil
-import pypickle
 
-init_session_keys()
 # https://streamlit-emoji-shortcodes-streamlit-app-gwckff.streamlit.app/
 
 # %%
@@ -27,17 +29,17 @@ def main():
         {
             "Main": [st.Page("app_pages/intro.py", title="📢 Introductie")],
             "Audio": [
-                st.Page("app_pages/audio_recording.py", title=("✅ " if st.session_state.get('audio') else "❗") + "Record Audio"),
-                st.Page("app_pages/audio_upload.py", title=("✅ " if st.session_state.get('audio_filepath') else "❗") + "Upload Recordings"),
-                st.Page("app_pages/audio_playback.py", title=("✅ " if st.session_state.get('audio') else "❗") + "Playback Recordings"),
+                st.Page("app_pages/audio_recording.py", title=("✅ " if project_has('audio') else "❗") + "Record Audio"),
+                st.Page("app_pages/audio_upload.py", title=("✅ " if project_has('audio_filepath') else "❗") + "Upload Recordings"),
+                st.Page("app_pages/audio_playback.py", title=("✅ " if project_has('audio') else "❗") + "Playback Recordings"),
             ],
             "Transcription": [
-                st.Page("app_pages/transcribe.py", title=("✅ " if st.session_state.get('context') else "❗") + "Run Transcription"),
-                st.Page("app_pages/transcribe_edit.py", title=("✅ " if st.session_state.get('context') else "❗") + "Edit Transcription"),
+                st.Page("app_pages/transcribe.py", title=("✅ " if project_has('context') else "❗") + "Run Transcription"),
+                st.Page("app_pages/transcribe_edit.py", title=("✅ " if project_has('context') else "❗") + "Edit Transcription"),
             ],
             "Notuleren": [
-                st.Page("app_pages/model_instructions.py", title=("✅ " if st.session_state.get('instruction') else "❗") + "Model Instruction"),
-                st.Page("app_pages/create_minute_notes.py", title=("✅ " if st.session_state.get("minute_notes") else "❗") + "Create Minute Notes"),
+                st.Page("app_pages/model_instructions.py", title=("✅ " if project_has('instruction') else "❗") + "Model Instruction"),
+                st.Page("app_pages/create_minute_notes.py", title=("✅ " if project_has("minute_notes") else "❗") + "Create Minute Notes"),
 
             ],
             "Configurations": [
@@ -72,20 +74,14 @@ def sidebar():
     col1, col2 = st.sidebar.columns([0.5, 0.5])
     # Selectbox
     col1.caption('Select Project (auto loaded)')
-    options = list_subdirectories(st.session_state['temp_dir'])
-    index = options.index(st.session_state["project_name"]) if st.session_state["project_name"]!='' in options else None
-    project_name = col1.selectbox("Select a Project", options=options, index=index, label_visibility='collapsed', help='Select project')
+    options = list_projects(st.session_state['temp_dir'])
+    index = options.index(st.session_state["project_name"]) if st.session_state["project_name"] in options else None
+    project_name = col1.selectbox("Select a Project", options=options, index=index, format_func=lambda name: describe_project(read_manifest(os.path.join(st.session_state['temp_dir'], name))), label_visibility='collapsed', help='Select project')
 
     # If a different project is choosen, load the session parameters
-    if project_name != st.session_state["project_name"]:
-        # Set session states for paths
-        set_project_paths(project_name)
-        # Load the session states
-        if os.path.isfile(st.session_state["save_path"]):
-            # Load pickle file
-            session_state = pypickle.load(st.session_state["save_path"])
-            for key, value in session_state.items():
-                st.session_state[key] = value
+    if project_name is not None and project_name != st.session_state["project_name"]:
+        # Load the session states. The audio, transcript and notes are loaded when a page needs them.
+        load_project(project_name)
         # Refresh screen
         st.rerun()
 
@@ -102,7 +98,13 @@ def sidebar():
     if st.session_state['project_name'] is not None and st.session_state['project_name'] != '':
         if cols[0].button(f"Delete Project {st.session_state['project_name']}", type='primary'):
             cols[0].caption('Deleting audio files in {st.session_state["project_path"]}')
+            # Wait for pending saves, so that they do not recreate the project
+            forget_session_store(st.session_state['save_path'])
             shutil.rmtree(st.session_state['project_path'], ignore_errors=True)
+            # The audio files of the project can be removed when no other project uses them
+            store = get_artifact_store(st.session_state['temp_dir'], st.session_state['artifact_cache_size_mb'])
+            store.release(os.path.abspath(st.session_state['project_path']))
+            store.gc()
             # st.session_state["project_name"] = ''
             # st.session_state["project_path"] = os.path.join(st.session_state['temp_dir'], '')
             # st.session_state["audio_filepath"] = ''
@@ -118,7 +120,7 @@ def sidebar():
 
 
 # %%
-def main_run():
+def run_app():
     """Function to run the Streamlit app from the command line."""
     module_path = os.path.abspath(os.path.dirname(__file__))
 
@@ -127,6 +129,17 @@ def main_run():
     except subprocess.CalledProcessError as e:
         print(f"Failed to run Streamlit app: {e}")
 
+
+def main_run():
+    """Entry point of notabene: runs the app, or the batch mode with ``notabene batch``."""
+    from nota_bene.cli import main as cli_main
+    sys.exit(cli_main())
+
 # %%
 if __name__ == "__main__":
+    # Streamlit runs this file as __main__ on every rerun
+    init_session_keys()
+    # Connection limits of the shared HTTP pool, only applied when changed
+    configure_http_pool()
+    set_probe_cache_dir(st.session_state['temp_dir'])
     main()
@@ -1,7 +1,7 @@
 """Page to upload audio file."""
 
 import streamlit as st
-from nota_bene.utils import switch_page_button
+from nota_bene.utils import switch_page_button, ensure_loaded, play_audio
 
 
 # %%
@@ -11,6 +11,7 @@ def run_main():
     1. Playback Audio
 
     """
+    ensure_loaded('audio')
     if st.session_state['project_name'] == '' or st.session_state['project_name'] is None:
         with st.container(border=True):
             st.warning('Create a project first and then select! See left panel sidepanel.')
@@ -25,7 +26,8 @@ def run_main():
         else:
             st.warning('Audio file not found')
         st.caption("This is the final combined audio file.")
-        st.audio(st.session_state['audio'])
+        if st.session_state['audio']:
+            play_audio(st.session_state['audio'])
 
     # Navigation bar
     navigation_panel()
@@ -1,16 +1,16 @@
 import streamlit as st
 from datetime import datetime
 from st_audiorec import st_audiorec
-from nota_bene.utils import switch_page_button
-from nota_bene.utils import write_audio_to_disk, file_to_bytesio, combine_audio_files, compress_audio
-from nota_bene.utils import convert_wav_to_m4a
-import os
+from nota_bene.utils import switch_page_button, ensure_loaded, save_session
+from nota_bene.utils import combine_audio_files, audio_handle, play_audio
+from nota_bene.recordings import RecordingStore
 
 # %%
 def main():
     """
     Record audio from microphone and return the audio data while optionally saving to disk.
     """
+    ensure_loaded('audio', 'audio_recording')
 
     if st.session_state['project_name'] == '' or st.session_state['project_name'] is None:
         with st.container(border=True):
@@ -19,10 +19,9 @@ def main():
     else:
         st.header('Record Audio: ' + st.session_state['project_name'], divider=True)
 
-    if 'audio_recording' not in st.session_state:
-        st.session_state['audio_recording'] = {}
-    if 'audio_order' not in st.session_state:
-        st.session_state['audio_order'] = []
+    # Recorded fragments are stored on disk
+    store = RecordingStore(st.session_state['project_path'])
+    migrate_recordings(store)
 
     with st.container(border=True):
         st.caption('Use the buttons for navigation. Note that recordings from laptops usually ends up in poor audio quality, hence poor transcription results. An external microphone is then recommended.')
@@ -35,28 +34,27 @@ def main():
 
         if wav_audio_data is not None and st.button('Save this audio fragment for transcription'):
             audioname = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            st.session_state['audio_recording'][audioname] = wav_audio_data
-            st.session_state['audio_order'].append(audioname)
-            # st.info(f"Audio fragment number {len(st.session_state['audio_recording'].keys())-1} audio fragment(s) is saved.")
+            # Compress the fragment straight to disk
+            store.add(wav_audio_data, audioname)
 
     # Add by pathname
     # add_audio_from_path()
     # Set the order of the recordings
-    user_button_process = set_order_recordings()
+    user_button_process = set_order_recordings(store)
 
     # Process the audio recordings
     with st.spinner():
-        output_file = process_audio_recordings(user_button_process, bitrate=st.session_state['bitrate'])
+        output_file = process_audio_recordings(store, user_button_process, bitrate=st.session_state['bitrate'])
 
     if output_file:
-        st.session_state['audio'] = file_to_bytesio(output_file)
+        st.session_state['audio'] = audio_handle(output_file)
         st.session_state['audio_filepath'] = output_file
 
     if st.session_state['audio'] is not None:
         with st.container(border=True):
             st.subheader('Final Audio File')
             st.caption("This is the final combined audio fragment that will be used for the transcription.")
-            st.audio(st.session_state['audio'])
+            play_audio(st.session_state['audio'])
 
         # with st.container(border=True):
         #     col1, col2 = st.columns([0.5, 0.5])
@@ -72,86 +70,74 @@ def main():
             switch_page_button("app_pages/audio_playback.py", text='Volgende stap: Playback Audio', button_type='primary')
 
 #%%
-def set_order_recordings():
-    if len(st.session_state['audio_recording']) > 0:
+def set_order_recordings(store):
+    index = store.index()
+    user_button_process = False
+    if len(index) > 0:
         with st.container(border=True):
             st.subheader('Sort recordings')
-            st.caption(f"In total there are {len(st.session_state['audio_recording'])} audio recordings saved. You can remove or reorder them accordingly.")
-            for key in st.session_state['audio_order']:  # Maintain order using the list
+            st.caption(f"In total there are {len(index)} audio recordings saved ({store.duration() / 60:.1f} min). You can play, remove or reorder them accordingly.")
+            for entry in index:  # Maintain order using the index
+                # The names are timestamps that are not unique, the ids are
+                key = entry['id']
                 col1, col2, col3, col4, col5 = st.columns([0.5, 0.3, 0.1, 0.1, 0.1])
                 with st.container(border=False):
-                    col1.audio(st.session_state['audio_recording'][key], format='audio/wav')
-                    col2.write(key)
+                    # Only the selected fragment gets a player, so reruns stay fast with many fragments
+                    if st.session_state.get('recording_preview') == key:
+                        col1.audio(store.path(key), format='audio/flac')
+                    elif col1.button("▶️ Play", key=f"play_{key}"):
+                        st.session_state['recording_preview'] = key
+                        st.rerun()
+                    col2.write(f"{entry['name']} ({(entry['duration'] or 0) / 60:.1f} min)")
                     if col3.button("⬆️", key=f"up_{key}"):
-                        move_audio(key, "up")
+                        move_audio(store, key, "up")
                     if col4.button("⬇️", key=f"down_{key}"):
-                        move_audio(key, "down")
+                        move_audio(store, key, "down")
                     if col5.button(":x:", key=f"remove_{key}"):
-                        remove_audio(key)
+                        remove_audio(store, key)
 
             # Create button
             user_button_process = st.button('Volgende stap: combineer de audio bestanden.')
-        return user_button_process
+    return user_button_process
 
 #%%
-def process_audio_recordings(user_button_process, bitrate='24k'):
+def process_audio_recordings(store, user_button_process, bitrate='24k'):
     output_file = None
+    file_list = store.paths()
 
-    if len(st.session_state['audio_recording']) > 0 and user_button_process:
-        # st.write(st.session_state['audio_recording'].keys())
-        # st.write(st.session_state['audio_order'])
-
-        ext = '.wav'
-        file_list = []
-        for i, filename in enumerate(st.session_state['audio_order']):
-            # st.write(f'Working on {filename}')
-            # Get the correct order
-            wav_audio = st.session_state['audio_recording'].get(filename)
-            # Create filepath
-            filepath = os.path.join(st.session_state['project_path'], f'audio_{i}{ext}')
-            # Write audio to temp directory
-            filepath = write_recording_to_disk(filepath, wav_audio, convert_to_m4a=True, bitrate=st.session_state['bitrate'])
-            # Compress audio
-            filepath_c = compress_audio(filepath, bitrate=bitrate)
-            # Add the file path to list
-            file_list.append(filepath_c)
-
-        # Combine the audio files
-        output_file = combine_audio_files(file_list, st.session_state['project_path'], bitrate, '.m4a')
+    if len(file_list) > 0 and user_button_process:
+        # Combine, downmix, resample and compress the recordings. Recordings are compressed in parallel.
+        my_bar = st.progress(0, text='Compressing recordings..')
+        names = store.names()
+
+        def _progress(n_done, n_files, filepath):
+            my_bar.progress(n_done / n_files, text=f'Compressed recording {names[file_list.index(filepath)]} ({n_done}/{n_files})')
+
+        output_file = combine_audio_files(file_list, st.session_state['project_path'], bitrate, '.m4a', n_jobs=st.session_state['ingest_workers'], progress=_progress, max_size_mb=st.session_state['artifact_cache_size_mb'])
 
     # Return
     return output_file
 
 
 # %%
-def write_recording_to_disk(filepath, wav_audio, convert_to_m4a=True, bitrate='128k'):
-    # Save wav file to disk
-    with open(filepath, "wb") as f:
-        f.write(wav_audio)
-    # Convert wav to m4a
-    if convert_to_m4a:
-        filepath = convert_wav_to_m4a(filepath, bitrate=bitrate, overwrite=True)
-    # Return
-    return filepath
-
-def remove_audio(key):
-    if key in st.session_state['audio_recording']:
-        del st.session_state['audio_recording'][key]
-        st.session_state['audio_order'].remove(key)
-        st.rerun()
-
-def move_audio(key, direction):
-    index = st.session_state['audio_order'].index(key)
-    if direction == "up" and index > 0:
-        st.session_state['audio_order'][index], st.session_state['audio_order'][index - 1] = (
-            st.session_state['audio_order'][index - 1],
-            st.session_state['audio_order'][index]
-        )
-    elif direction == "down" and index < len(st.session_state['audio_order']) - 1:
-        st.session_state['audio_order'][index], st.session_state['audio_order'][index + 1] = (
-            st.session_state['audio_order'][index + 1],
-            st.session_state['audio_order'][index]
-        )
+def migrate_recordings(store):
+    """Move the recordings that older versions kept in the session state to the store on disk."""
+    if not st.session_state['audio_recording']:
+        return
+    for name in st.session_state['audio_order']:
+        audio = st.session_state['audio_recording'].get(name)
+        if audio is not None:
+            store.add(audio.getvalue() if hasattr(audio, 'getvalue') else audio, name)
+    st.session_state['audio_recording'] = {}
+    st.session_state['audio_order'] = []
+    save_session()
+
+def remove_audio(store, key):
+    store.remove(key)
+    st.rerun()
+
+def move_audio(store, key, direction):
+    store.move(key, direction)
     st.rerun()
 
 # %%
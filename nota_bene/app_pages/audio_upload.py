@@ -1,12 +1,11 @@
 """Page to upload audio file."""
 
 import streamlit as st
-from nota_bene.utils import switch_page_button
+from nota_bene.utils import switch_page_button, ensure_loaded
 import os
 import shutil
-import numpy as np
-from nota_bene.utils import write_audio_to_disk, file_to_bytesio, combine_audio_files, compress_audio, save_session
-from nota_bene.utils import convert_wav_to_m4a
+from nota_bene.utils import write_audio_to_disk, combine_audio_files, save_session, audio_handle
+from nota_bene.recordings import RecordingStore
 from datetime import datetime
 
 
@@ -16,12 +15,12 @@ def run_main():
 
     1. Upload all audio files and order accordingly.
     2. Store to disk and name to 01_ etc
-    3. Resample to 16k
-    4. Combine all audio files into one big audio file.
-    5. Split audio file into parts of 20Mb
-    6. Transcribe
+    3. Combine, downmix, resample to 16k and compress all audio files in one ffmpeg pass.
+    4. Split audio file into parts of 20Mb
+    5. Transcribe
 
     """
+    ensure_loaded('audio')
 
     if st.session_state['project_name'] == '' or st.session_state['project_name'] is None:
         with st.container(border=True):
@@ -102,39 +101,39 @@ def audio_processing(uploaded_files, file_order, temp_dir, bitrate):
 
         file_list = []
         audio_names = []
-        for i, filename in enumerate(uploaded_files):
+        uploads = {file.name: file for file in uploaded_files}
+        # Write the uploads to disk in the order of the user
+        for i, name in enumerate(file_order):
             # progressbar
-            progress_percent = int((max(i + 1, 1) / len(uploaded_files)) * 90)
-            my_bar.progress(progress_percent, text=f'Processing {filename.name}')
-
-            if not np.isin(filename.name, file_order):
-                # st.warning(f'{filename.name} skipped')
-                continue
-            else:
-                # Get index
-                idx = file_order.index(filename.name)
-                # Get file ext and file path
-                _, ext = os.path.splitext(filename.name)
-                filepath = os.path.join(temp_dir, f'audio_{i}{ext}')
-
-                # Write audio to temp directory
-                write_audio_to_disk(uploaded_files[idx], filepath)
-                # Compress audio
-                filepath_c = compress_audio(filepath, bitrate=bitrate)
-                # Add the file path to list
-                file_list.append(filepath_c)
-                audio_names.append(filename.name)
+            progress_percent = int((max(i + 1, 1) / len(file_order)) * 50)
+            my_bar.progress(progress_percent, text=f'Processing {name}')
+
+            # Get file ext and file path
+            _, ext = os.path.splitext(name)
+            filepath = os.path.join(temp_dir, f'audio_{i}{ext}')
+            # Write audio to temp directory
+            write_audio_to_disk(uploads[name], filepath)
+            # Add the file path to list
+            file_list.append(filepath)
+            audio_names.append(name)
 
         # Combine the audio files
-        my_bar.progress(90, text=f'combining audio fragments.. Wait for it..')
+        my_bar.progress(50, text=f'Combining and compressing audio fragments.. Wait for it..')
+
+        def _progress(n_done, n_files, filepath):
+            my_bar.progress(50 + int(n_done / n_files * 40), text=f'Compressed {audio_names[file_list.index(filepath)]} ({n_done}/{n_files})')
 
-        # Combine all audio files and return the filepath
+        # Concatenate, downmix, resample and compress all audio files and return the filepath. Files are compressed in parallel.
         with st.spinner("Wait for it... combining audio fragments.."):
-            st.session_state['audio_filepath'] = combine_audio_files(file_list, temp_dir, bitrate, '.m4a')
+            st.session_state['audio_filepath'] = combine_audio_files(file_list, temp_dir, bitrate, '.m4a', n_jobs=st.session_state['ingest_workers'], progress=_progress, max_size_mb=st.session_state['artifact_cache_size_mb'])
 
             if st.session_state['audio_filepath']:
-                # Create bytesIO
-                st.session_state['audio'] = file_to_bytesio(st.session_state['audio_filepath'])
+                # The uploads are written again on every combine, and the combined file is kept in the artifact store
+                for filepath in file_list:
+                    if os.path.isfile(filepath):
+                        os.remove(filepath)
+                # File-backed audio handle
+                st.session_state['audio'] = audio_handle(st.session_state['audio_filepath'])
                 st.session_state['audio_names'] = audio_names
                 # Save
                 my_bar.progress(95, text=f'Saving session states..')
@@ -146,7 +145,7 @@ def audio_processing(uploaded_files, file_order, temp_dir, bitrate):
 #%%
 def add_audio_from_path():
     """
-    Convert wav file to m4a.
+    Add an audio file on disk to the recordings of the project.
 
     """
     with st.container(border=False):
@@ -155,20 +154,13 @@ def add_audio_from_path():
         user_filepath = st.text_input(label='conversion_and_compression', value='', label_visibility='collapsed').strip()
         add_button = st.button('Add Audio File From Path')
 
-        # Start conversio and compression
+        # Start compression
         if add_button and user_filepath != '' and os.path.isfile(user_filepath):
             with st.spinner('In progress.. Be patient and do not press anything..'):
-                # Convert to m4a
-                m4a_filepath = convert_wav_to_m4a(user_filepath, output_directory=st.session_state['project_path'], bitrate=st.session_state['bitrate'], overwrite=True)
-                st.write(m4a_filepath)
-                # Read m4a file
-                # with open(m4a_filepath, 'rb') as file:
-                #     audiobyes = file.read()
-                audiobyes = file_to_bytesio(m4a_filepath)
-                # Store in session
+                # Compress the file to a recording segment on disk
                 audioname = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                st.session_state['audio_recording'][audioname] = audiobyes
-                st.session_state['audio_order'].append(audioname)
+                segment_path = RecordingStore(st.session_state['project_path']).add_file(user_filepath, audioname)
+                st.write(segment_path)
         elif add_button and not os.path.isfile(user_filepath):
             st.warning(f'Audio file does not exists: {user_filepath}')
 
@@ -5,7 +5,10 @@ import time
 import numpy as np
 import copy
 import os
-from nota_bene.utils import set_project_paths, load_llm_model
+from nota_bene.utils import set_project_paths, load_llm_model, get_transcript_cache, get_llm_cache
+from nota_bene.artifacts import get_artifact_store
+from nota_bene.model_pool import get_model_pool
+from nota_bene.workers import default_torch_threads
 
 #%%
 def run_main():
@@ -19,6 +22,26 @@ def run_main():
     _update_tempdir()
     # Set bitrate
     _update_bitrate()
+    # Whisper model memory
+    _update_whisper_pool()
+    # Parallel audio processing
+    _update_ingest_workers()
+    # Parallel transcription
+    _update_workers()
+    # Transcript cache
+    _update_transcript_cache()
+    # Intermediate audio files
+    _update_artifact_cache()
+    # Context window of the local LLM
+    _update_llm_context_window()
+    # Parallel minute notes
+    _update_llm_concurrency()
+    # LLM response cache
+    _update_llm_cache()
+    # Connections to the endpoints
+    _update_http_pool()
+    # OpenAI transcription
+    _update_openai_limits()
 
 #%%
 def _update_bitrate():
@@ -31,6 +54,160 @@ def _update_bitrate():
         if st.session_state['bitrate'] != set_user_bitrate_str:
             st.session_state['bitrate'] = set_user_bitrate_str
 
+#%%
+def _update_ingest_workers():
+    with st.container(border=True):
+        st.subheader('Parallel audio processing', divider='gray')
+        st.caption('Uploaded files and recordings are compressed in parallel ffmpeg processes before they are combined into one audio file.')
+        n_cores = os.cpu_count() or 1
+        n_workers = st.slider("Files at the same time", min_value=1, max_value=n_cores, value=min(st.session_state['ingest_workers'], n_cores), step=1)
+        # Store
+        if st.session_state['ingest_workers'] != n_workers:
+            st.session_state['ingest_workers'] = n_workers
+
+#%%
+def _update_whisper_pool():
+    with st.container(border=True):
+        st.subheader('Whisper models in memory', divider='gray')
+        st.caption('Loaded Whisper models are kept in memory and reused across chunks, reruns and users. The least recently used model is removed when the memory budget is exceeded.')
+        col1, col2 = st.columns([0.7, 0.3])
+        budget = col1.slider("Memory budget (GB)", min_value=1.0, max_value=64.0, value=float(st.session_state['whisper_memory_budget']), step=1.0)
+        # Store
+        if st.session_state['whisper_memory_budget'] != budget:
+            st.session_state['whisper_memory_budget'] = budget
+
+        pool = get_model_pool(st.session_state['whisper_memory_budget'])
+        col1.caption(f"In use: {pool.memory_usage / 1024**3:.2f} GB | Loaded: {', '.join([f'{name} ({device})' for name, device in pool.loaded()]) or '-'}")
+        col2.caption('Release memory')
+        if col2.button('Unload Whisper models', use_container_width=True):
+            pool.clear()
+            st.rerun()
+
+#%%
+def _update_workers():
+    with st.container(border=True):
+        st.subheader('Parallel transcription', divider='gray')
+        st.caption('Transcribe the audio chunks in parallel worker processes (local Whisper models only). Every worker loads its own copy of the model, so memory usage grows with the number of workers. Use 1 worker to transcribe the chunks one after another.')
+        n_cores = os.cpu_count() or 1
+        col1, col2 = st.columns([0.5, 0.5])
+        n_workers = col1.slider("Workers", min_value=1, max_value=n_cores, value=min(st.session_state['transcribe_workers'], n_cores), step=1)
+        torch_threads = col2.slider("Torch threads per worker", min_value=1, max_value=n_cores, value=st.session_state['torch_threads'] or default_torch_threads(n_workers), step=1)
+        # Store
+        if st.session_state['transcribe_workers'] != n_workers:
+            st.session_state['transcribe_workers'] = n_workers
+            # Divide the cores over the workers again
+            st.session_state['torch_threads'] = None
+            st.rerun()
+        elif torch_threads != (st.session_state['torch_threads'] or default_torch_threads(n_workers)):
+            st.session_state['torch_threads'] = torch_threads
+        if n_workers * torch_threads > n_cores:
+            col2.warning(f'{n_workers} workers x {torch_threads} threads exceeds the {n_cores} available cores.')
+
+#%%
+def _update_transcript_cache():
+    with st.container(border=True):
+        st.subheader('Transcript cache', divider='gray')
+        st.caption('Transcripts are cached by the audio content, Whisper model and decode options, and are shared by all projects. The least recently used transcripts are removed when the cache exceeds its size.')
+        col1, col2 = st.columns([0.7, 0.3])
+        size_mb = col1.slider("Cache size (MB)", min_value=128, max_value=16384, value=int(st.session_state['transcript_cache_size_mb']), step=128)
+        # Store
+        if st.session_state['transcript_cache_size_mb'] != size_mb:
+            st.session_state['transcript_cache_size_mb'] = size_mb
+
+        cache = get_transcript_cache()
+        stats = cache.stats()
+        col1.caption(f"Entries: {stats['entries']} | Size: {stats['size_mb']:.1f} MB | Hits: {stats['hits']} | Misses: {stats['misses']} | Evictions: {stats['evictions']}")
+        col2.caption('Remove all cached transcripts')
+        if col2.button('Clear transcript cache', use_container_width=True):
+            cache.clear()
+            st.rerun()
+
+#%%
+def _update_artifact_cache():
+    with st.container(border=True):
+        st.subheader('Intermediate audio files', divider='gray')
+        st.caption('Combined audio files and decoded samples are stored once in the temp directory, named by their input files and settings. Files that are not used by a project anymore are removed, least recently used first, when the total size exceeds the budget.')
+        col1, col2 = st.columns([0.7, 0.3])
+        size_mb = col1.slider("Disk budget (MB)", min_value=512, max_value=65536, value=int(st.session_state['artifact_cache_size_mb']), step=512)
+        # Store
+        if st.session_state['artifact_cache_size_mb'] != size_mb:
+            st.session_state['artifact_cache_size_mb'] = size_mb
+
+        store = get_artifact_store(st.session_state['temp_dir'], st.session_state['artifact_cache_size_mb'])
+        stats = store.stats()
+        col1.caption(f"Files: {stats['entries']} | In use by projects: {stats['referenced']} | Size: {stats['size_mb']:.1f} MB")
+        col2.caption('Remove the files that are not used')
+        if col2.button('Clean up audio files', use_container_width=True):
+            store.clear_unreferenced()
+            st.rerun()
+
+#%%
+def _update_llm_context_window():
+    with st.container(border=True):
+        st.subheader('Context window', divider='gray')
+        st.caption('Number of tokens that the local LLM reads and writes per prompt. With the Auto approach, the transcript is sent in one prompt when it fits, and otherwise in the fewest chunks that fit. Use the context length the model is loaded with in LM Studio or Ollama.')
+        n_ctx = st.select_slider("Context window (tokens)", options=[2048, 4096, 8192, 16384, 32768, 65536, 131072], value=int(st.session_state['llm_n_ctx']))
+        # Store
+        if st.session_state['llm_n_ctx'] != n_ctx:
+            st.session_state['llm_n_ctx'] = n_ctx
+
+#%%
+def _update_llm_concurrency():
+    with st.container(border=True):
+        st.subheader('Parallel minute notes', divider='gray')
+        st.caption('With the Chunk-Wise approach, the minute notes of the chunks are requested from the local LLM at the same time and merged afterwards. Use 1 when the server handles one request at a time (e.g. Ollama with OLLAMA_NUM_PARALLEL=1).')
+        concurrency = st.slider("Concurrent prompts", min_value=1, max_value=16, value=int(st.session_state['llm_concurrency']), step=1)
+        # Store
+        if st.session_state['llm_concurrency'] != concurrency:
+            st.session_state['llm_concurrency'] = concurrency
+
+#%%
+def _update_llm_cache():
+    with st.container(border=True):
+        st.subheader('LLM response cache', divider='gray')
+        st.caption('Minute notes, and the notes per chunk of the Chunk-Wise approach, are cached by the model, endpoint, settings, instructions and transcript. Running the same model on the same transcript again returns the cached notes without using the server. The least recently used responses are removed when the cache exceeds its size.')
+        col1, col2 = st.columns([0.7, 0.3])
+        size_mb = col1.slider("LLM cache size (MB)", min_value=16, max_value=4096, value=int(st.session_state['llm_cache_size_mb']), step=16)
+        # Store
+        if st.session_state['llm_cache_size_mb'] != size_mb:
+            st.session_state['llm_cache_size_mb'] = size_mb
+
+        cache = get_llm_cache()
+        stats = cache.stats()
+        col1.caption(f"Entries: {stats['entries']} | Size: {stats['size_mb']:.1f} MB | Hits: {stats['hits']} | Misses: {stats['misses']} | Evictions: {stats['evictions']}")
+        col2.caption('Remove all cached responses')
+        if col2.button('Clear LLM cache', use_container_width=True):
+            cache.clear()
+            st.rerun()
+
+#%%
+def _update_http_pool():
+    with st.container(border=True):
+        st.subheader('Connections to the endpoints', divider='gray')
+        st.caption('Connections to the LLM endpoints and OpenAI are kept open and shared by all users, pages and background jobs, so they are set up once. Requests wait for a free connection when all connections to an endpoint are in use.')
+        col1, col2, col3 = st.columns(3)
+        max_connections = col1.number_input("Connections per endpoint", min_value=1, max_value=64, value=int(st.session_state['llm_max_connections']), step=1)
+        connect_timeout = col2.number_input("Connect timeout (s)", min_value=1, max_value=120, value=int(st.session_state['llm_connect_timeout']), step=1)
+        read_timeout = col3.number_input("Read timeout (s)", min_value=10, max_value=3600, value=int(st.session_state['llm_read_timeout']), step=10, help='Maximum time to wait for the next part of a response.')
+        # Store
+        st.session_state['llm_max_connections'] = max_connections
+        st.session_state['llm_connect_timeout'] = connect_timeout
+        st.session_state['llm_read_timeout'] = read_timeout
+
+#%%
+def _update_openai_limits():
+    with st.container(border=True):
+        st.subheader('OpenAI transcription', divider='gray')
+        st.caption('Audio chunks are uploaded concurrently to OpenAI. The requests are rate limited and retried with backoff when the service responds with a rate limit (429) or server error (5xx).')
+        col1, col2, col3 = st.columns(3)
+        concurrency = col1.number_input("Concurrent uploads", min_value=1, max_value=32, value=int(st.session_state['openai_concurrency']), step=1)
+        rpm = col2.number_input("Requests per minute", min_value=1, max_value=10000, value=int(st.session_state['openai_rpm']), step=10)
+        max_retries = col3.number_input("Retries", min_value=0, max_value=20, value=int(st.session_state['openai_max_retries']), step=1)
+        # Store
+        st.session_state['openai_concurrency'] = concurrency
+        st.session_state['openai_rpm'] = rpm
+        st.session_state['openai_max_retries'] = max_retries
+
 #%%
 def _update_tempdir():
     # with colm1:
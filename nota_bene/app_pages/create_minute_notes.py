@@ -6,14 +6,14 @@ format, and download them as either Markdown or PDF files. It also provides a us
 interface to navigate back if no transcript is available.
 """
 
-from io import BytesIO
 import streamlit as st
-from markdown_pdf import MarkdownPdf, Section
-from openai import OpenAI
-from nota_bene.utils import switch_page_button, save_session, load_llm_model
+from nota_bene.utils import switch_page_button, ensure_loaded, save_session, save_project_state, load_llm_model, generate_minute_notes, generate_minute_notes_stream, generate_minute_notes_openai, get_llm_cache, get_openai_client
+from nota_bene.local_llm import StreamStats, checkpointed
+from nota_bene.pipeline import Pipeline, fingerprint, STALE
+from nota_bene.tokens import plan_llm_strategy, describe_plan
+from nota_bene.exports import get_export_cache
 import numpy as np
 import time
-from LLMlight import LLMlight
 
 #%% Create header
 @st.dialog("Key?")
@@ -26,6 +26,7 @@ def enter_api_key():
 
 @st.fragment
 def run_main():
+    ensure_loaded('context', 'minute_notes')
     if st.session_state['project_name']:
         st.header('Create minute notes: ' + st.session_state['project_name'], divider=True)
 
@@ -51,34 +52,54 @@ def run_main():
             # Button
             col2.caption('Create Minute Notes')
             user_press = col2.button(f"Run LLM!", type='primary', use_container_width=True)
+            read_cache = col2.checkbox('Load cached minute notes.', value=True, help='Return the minute notes of an earlier run with the same model, settings, instructions and transcript, without calling the model. Uncheck to run the model again.')
 
             if user_model=='gpt-4o-mini':
                 load_openai_modules(col1, col2)
+                stage_params = minute_notes_params(st.session_state['instruction'])
             else:
-                preprocessing, user_summarize, user_chunk_size = load_local_modules(col1)
+                prompt = st.session_state['instructions'].get(st.session_state['instruction_name'])
+                preprocessing, user_summarize, user_chunk_size = load_local_modules(col1, prompt)
+                stage_params = minute_notes_params(prompt, preprocessing, user_chunk_size)
+
+            # The minute notes were made from another transcript or with other instructions
+            pipeline = Pipeline(st.session_state['project_path'])
+            if st.session_state['minute_notes'] and pipeline.state('minute_notes', params=stage_params) == STALE:
+                st.info(f"The minute notes are out of date: {pipeline.reason('minute_notes', params=stage_params)}. Run the LLM again to update them.", icon="ℹ️")
 
             # Run local LLM
             if user_press and st.session_state['model'] == 'gpt-4o-mini':
-                run_openai()
+                run_openai(read_cache=read_cache)
             elif user_press:
-                run_local_llm(preprocessing=preprocessing, summarize=user_summarize, chunk_size=user_chunk_size)
+                run_local_llm(preprocessing=preprocessing, summarize=user_summarize, chunk_size=user_chunk_size, read_cache=read_cache)
 
+    # Streamed minute notes of a run that did not finish
+    recover_minute_notes()
     # Show minute_notes
     show_minute_notes()
     # Show Back-Download button
     navigation()
 
 #%%
-def load_local_modules(col1):
-    user_method = col1.radio('Approach', options=['Unlimited', 'Global-reasoning', 'Chunk-Wise'], label_visibility='visible')
-    user_summarize = True
-    user_chunk_size = 8192
-
-    # if user_method != 'Full':
-        # user_summarize = col2.checkbox('Summarize results', value=True, label_visibility='visible')
-        # user_chunk_size = col2.slider('Context Window', min_value=4096, max_value=16384, step=2048, value=8192)
+def minute_notes_params(instruction, preprocessing=None, chunk_size=None):
+    """Parameters of the minute notes stage of the pipeline."""
+    return {'model': st.session_state['model'], 'instruction': fingerprint(instruction), 'preprocessing': preprocessing, 'chunk_size': chunk_size}
 
-    if user_method=='Global-reasoning':
+#%%
+def load_local_modules(col1, prompt=None):
+    user_method = col1.radio('Approach', options=['Auto', 'Unlimited', 'Global-reasoning', 'Chunk-Wise'], label_visibility='visible',
+                             help='Auto sends the transcript in one prompt when it fits in the context window of the model, and otherwise in the fewest chunks that fit. The context window is set on the configurations page.')
+    user_summarize = True
+    n_ctx = st.session_state['llm_n_ctx']
+    # Token counts of the transcript and the instructions. The chunks fit in the context window.
+    plan = plan_llm_strategy(st.session_state['context'], prompt or '', n_ctx=n_ctx)
+    user_chunk_size = plan['chunk_size'] or int(plan['available_tokens'] * plan['chars_per_token'])
+
+    if user_method=='Auto':
+        preprocessing = plan['preprocessing']
+        user_chunk_size = plan['chunk_size']
+        user_chunk_text = describe_plan(plan, n_ctx)
+    elif user_method=='Global-reasoning':
         preprocessing='global-reasoning'
         user_chunk_text = user_chunk_size
     elif user_method=='Chunk-Wise':
@@ -88,6 +109,8 @@ def load_local_modules(col1):
         preprocessing=None
         user_chunk_text = 'Unlimited'
         user_chunk_size = None
+        if plan['preprocessing'] is not None:
+            col1.warning(f"The transcript ({plan['context_tokens']} tokens) does not fit in the context window ({n_ctx} tokens) and is cut off by the model. Use Auto or Chunk-Wise.", icon="⚠️")
 
     st.markdown(
         f"""
@@ -115,6 +138,23 @@ def load_openai_modules(col1, col2):
             else:
                 col2.write("❌ API-key not found")
 
+# %%
+def recover_minute_notes():
+    if not st.session_state['minute_notes_partial']:
+        return
+    with st.container(border=True):
+        st.warning(f"The minute notes of an earlier run did not finish. {len(st.session_state['minute_notes_partial'].split(' '))} words were saved.", icon="⚠️")
+        col1, col2 = st.columns(2)
+        if col1.button('Recover partial minute notes', type='primary'):
+            st.session_state['minute_notes'] = st.session_state['minute_notes_partial']
+            st.session_state['minute_notes_partial'] = None
+            save_session()
+            st.rerun()
+        if col2.button('Discard'):
+            st.session_state['minute_notes_partial'] = None
+            save_session()
+            st.rerun()
+
 # %%
 @st.fragment
 def show_minute_notes():
@@ -145,6 +185,9 @@ def show_minute_notes():
                 except:
                     st.metric("Words", 0)
                     # st.session_state["minute_notes"] = None
+            stats = st.session_state['llm_stream_stats']
+            if stats and stats['time_to_first_token'] is not None:
+                st.caption(f"Time to first token: {stats['time_to_first_token']:.1f} s | {stats['tokens_per_second'] or 0:.1f} tokens/s | {stats['tokens']} tokens")
 
     with st.container(border=True):
         if st.session_state["edit_mode_minute_notes"]:
@@ -165,6 +208,7 @@ def show_minute_notes():
             with col1:
                 if st.button("💾 Save Minute Notes"):
                     st.session_state["minute_notes"] = updated_minute_notes
+                    Pipeline(st.session_state['project_path']).update_output('minute_notes', fingerprint(updated_minute_notes))
                     st.session_state["edit_mode_minute_notes"] = False
                     st.success("Notulen zijn bijgewerkt.")
                     st.rerun()
@@ -185,7 +229,7 @@ def show_minute_notes():
 
 
 # %%
-def run_local_llm(preprocessing='Unlimited', summarize=True, chunk_size=8192):
+def run_local_llm(preprocessing='Unlimited', summarize=True, chunk_size=8192, read_cache=True):
     if st.session_state['instruction_name'] is None:
         st.warning('Instructions must be selected first.')
         return
@@ -194,63 +238,91 @@ def run_local_llm(preprocessing='Unlimited', summarize=True, chunk_size=8192):
     instruction_name = st.session_state['instruction_name']
     prompt = st.session_state['instructions'][instruction_name]
 
+    if preprocessing is None:
+        # Unlimited: the tokens are shown while they are generated
+        run_local_llm_stream(prompt, read_cache=read_cache)
+        return
+
     # try:
     with st.spinner(f"Running {st.session_state['model']}"):
         start_time = time.time()
         st.warning("LLM model is running! Avoid navigating away or interacting with the app until it finishes.", icon="⚠️")
 
-        # Initialize model
-        overlap = int(0.25 * chunk_size) if isinstance(chunk_size, (int, float)) else None
-
-        model = LLMlight(model=st.session_state['model'],
-                         retrieval_method='RAG_basic',
-                         embedding=None,
-                         preprocessing=preprocessing,
-                         alpha=None,
-                         temperature=0.8,
-                         top_p=1,
-                         chunks={'method': 'chars', 'size': chunk_size, 'overlap': overlap},
-                         n_ctx=16384,
-                         endpoint=st.session_state['endpoint'],
-                         verbose='info',
-                         )
-
-        # Run model
-        response = model.prompt(prompt['query'],
-                           instructions=prompt['instructions'],
-                           context=st.session_state['context'],
-                           system=prompt['system'],
-                           stream=False,
-                           )
+        my_bar = st.progress(0, text='Sending the transcript to the model..') if preprocessing == 'chunk-wise' else None
+
+        def _progress(n_done, n_total, stage):
+            text = f'Minute notes of chunk {n_done}/{n_total}' if stage == 'map' else f'Merging the minute notes {n_done}/{n_total}'
+            my_bar.progress(n_done / n_total, text=text)
+
+        # Run model. Chunk-wise, the chunks are sent to the endpoint concurrently.
+        response = generate_minute_notes(st.session_state['context'],
+                                         prompt,
+                                         model=st.session_state['model'],
+                                         endpoint=st.session_state['endpoint'],
+                                         preprocessing=preprocessing,
+                                         chunk_size=chunk_size,
+                                         n_ctx=st.session_state['llm_n_ctx'],
+                                         max_concurrency=st.session_state['llm_concurrency'],
+                                         progress=_progress if my_bar is not None else None,
+                                         cache=get_llm_cache(),
+                                         read_cache=read_cache,
+                                         )
 
         duration = (time.time() - start_time) / 60  # Convert to min
         st.session_state['timings_llm'].append(duration)
+        st.session_state['llm_stream_stats'] = None
         st.session_state["minute_notes"] = response
+        Pipeline(st.session_state['project_path']).record('minute_notes', params=minute_notes_params(prompt, preprocessing, chunk_size), output=fingerprint(response))
         save_session()
         st.rerun()
     # except Exception as e:
     #     st.error(f'❌ Unexpected error. {e}')
 
 
+def run_local_llm_stream(prompt, read_cache=True):
+    """Stream the minute notes of the local LLM. The partial notes are saved every few seconds, so they can be recovered."""
+    save_path = st.session_state['save_path']
+    stats = StreamStats()
+
+    def _checkpoint(text):
+        # Also in the session, so that the next save_session does not overwrite the stored partial notes
+        st.session_state['minute_notes_partial'] = text
+        save_project_state(save_path, {'minute_notes_partial': text})
+
+    stream = generate_minute_notes_stream(st.session_state['context'],
+                                          prompt,
+                                          model=st.session_state['model'],
+                                          endpoint=st.session_state['endpoint'],
+                                          n_ctx=st.session_state['llm_n_ctx'],
+                                          stats=stats,
+                                          cache=get_llm_cache(),
+                                          read_cache=read_cache,
+                                          )
+    with st.container(border=True):
+        try:
+            response = st.write_stream(checkpointed(stream, _checkpoint))
+        except Exception as e:
+            # The partial notes stay stored and can be recovered
+            st.error(f'❌ The minute notes did not finish. {e}')
+            return
+
+    # The notes are complete
+    st.session_state['timings_llm'].append((time.time() - stats.start) / 60)
+    st.session_state['llm_stream_stats'] = stats.as_dict()
+    st.session_state["minute_notes"] = response
+    st.session_state['minute_notes_partial'] = None
+    Pipeline(st.session_state['project_path']).record('minute_notes', params=minute_notes_params(prompt), output=fingerprint(response))
+    save_session()
+    st.rerun()
+
+
 # %%
-def run_openai():
-    client = OpenAI(api_key=st.session_state['openai_api_key'])
-    response = client.chat.completions.create(
-        model=st.session_state['model'],
-        temperature=0,
-        messages=[
-            {
-                "role": "system",
-                "content": st.session_state['instruction'],
-            },
-            {
-                "role": "user",
-                "content": st.session_state['context']},
-        ],
-        stream=True,
-    )
+def run_openai(read_cache=True):
+    client = get_openai_client(st.session_state['openai_api_key'])
+    response = generate_minute_notes_openai(st.session_state['context'], st.session_state['instruction'], st.session_state['model'], client, stream=True, cache=get_llm_cache(), read_cache=read_cache)
 
     st.session_state["minute_notes"] = st.write_stream(response)
+    Pipeline(st.session_state['project_path']).record('minute_notes', params=minute_notes_params(st.session_state['instruction']), output=fingerprint(st.session_state["minute_notes"]))
     save_session()
 
 # %%
@@ -265,14 +337,25 @@ def navigation():
                 st.download_button("Download notulen (.md)", file_name="notulen.md", data=st.session_state["minute_notes"], type='primary')
         with col3:
             if st.session_state["minute_notes"] is not None and st.session_state["minute_notes"] != '':
-                try:
-                    pdf = MarkdownPdf(toc_level=1)
-                    f = BytesIO()
-                    pdf.add_section(Section(st.session_state["minute_notes"]))
-                    pdf.save(f)
-                    st.download_button("Download notulen (.pdf)", file_name="notulen.pdf", data=f, type='primary')
-                except Exception as e:
-                    st.error(f'❌ Unexpected error. {e}')
-                    
+                download_pdf(st.session_state["minute_notes"])
+
+
+def download_pdf(minute_notes):
+    """Download button of the PDF. The PDF is rendered once per version of the notes, in the background."""
+    exports = get_export_cache()
+    pdf = exports.get('pdf', minute_notes)
+    if pdf is not None:
+        st.download_button("Download notulen (.pdf)", file_name="notulen.pdf", data=pdf, type='primary')
+        return
+
+    exports.prepare('pdf', minute_notes)
+    if st.button("Create notulen (.pdf)", type='primary'):
+        try:
+            with st.spinner('Creating the PDF..'):
+                exports.result('pdf', minute_notes)
+            st.rerun()
+        except Exception as e:
+            st.error(f'❌ Unexpected error. {e}')
+
 # %%
 run_main()
@@ -1,23 +1,18 @@
 """Page to submit audio for transcription."""
 
-import time
-import os
-import json
 import streamlit as st
 import numpy as np
 from datetime import datetime, timedelta
 
-try:
-    import whisper
-except:
-    print('pip install openai-whisper')
-
-from nota_bene.utils import switch_page_button, create_audio_chunks, transcribe_audio_from_path, transcribe_local, save_session
+from nota_bene.utils import switch_page_button, save_session, ensure_loaded, get_transcript_cache, get_pcm_path
+from nota_bene.audio import SAMPLE_RATE
+from nota_bene.jobs import get_job_runner, job_result, transcript_params, ACTIVE, DONE, FAILED, CANCELLED, INTERRUPTED
+from nota_bene.pipeline import Pipeline, STALE
 
 
 #%%
-@st.fragment
 def run_main():
+    ensure_loaded('audio', 'context', 'segments')
     run_status = False
     if st.session_state['project_name']:
         st.header('Transcribe Audio Files: ' + st.session_state['project_name'], divider=True)
@@ -36,15 +31,11 @@ def run_main():
             if run_status:
                 st.rerun()
 
-    # Show some stats
-    if len(st.session_state['timings']) > 0:
-        st.markdown(f"""
-        <div style="width: 100%; background-color: #E5E7EB; border-radius: 6px; margin-top: 1em;">
-          <div style="width: {100}%; background-color: #3B82F6; height: 12px; border-radius: 6px;"></div>
-        </div>
-        <p style="font-size: 0.9em; color: #6B7280;">Audio Transcription is completed: {100:.1f}%</p>
-        """, unsafe_allow_html=True)
+    # Show the status of the background job
+    show_job_status()
 
+    # Show some stats
+    if len(st.session_state['timings']) > 0 and st.session_state['context']:
         col1, col2, col3 = st.columns(3)
         with col1:
             st.metric("Avg Time / Chunk", f"{np.mean(st.session_state['timings']):.1f} min")
@@ -76,12 +67,20 @@ def run_transcription():
     user_press = col2.button(f"Run Transcription!", type='primary')
     # Checkbox
     load_transcript_userselect = st.checkbox('Load processed audio transcripts.', value=True, help='Load previously transcribed transcriptions during run.')
+    st.session_state['vad'] = st.checkbox('Skip silences.', value=st.session_state['vad'], help='Cut the audio in silences instead of every 5 minutes, and skip long silences (breaks, muted microphones). This saves time and prevents hallucinations of the model.')
 
     # Change model
     if model_type != st.session_state['model_type']:
         st.session_state['model_type'] = model_type
         st.rerun()
 
+    # The transcript was made with other audio or settings
+    pipeline = Pipeline(st.session_state['project_path'])
+    stage_params = transcript_params({'model_type': model_type, 'vad': st.session_state['vad'], 'segment_time': 300})
+    transcript_state = pipeline.state('transcript', params=stage_params)
+    if st.session_state['context'] and transcript_state == STALE:
+        st.info(f"The transcript is out of date: {pipeline.reason('transcript', params=stage_params)}. Run the transcription again to update it.", icon="ℹ️")
+
     if not st.session_state['openai_api_key']:
         st.markdown(
             """
@@ -100,126 +99,137 @@ def run_transcription():
             """
         )
     elif user_press:
-        # 1. Cut the audio file in chunks of 30min
-        # 2. Transcribe per chunk
-        # 3. Stack all text together
-        if load_transcript_userselect and st.session_state['context']:
-            st.warning("Transcription is already performed and loaded. Uncheck to run again the transcription.")
-            return
-        else:
-            st.session_state['timings'] = []
-            st.session_state['context'] = None
-            st.warning("Transcription is running! Avoid navigating away or interacting with the app until it finishes.", icon="⚠️")
+        # 1. Cut the audio file in chunks of 5min while ffmpeg is decoding
+        # 2. Transcribe per chunk in a background job
+        # 3. Stack all text together when the job is finished
+        if load_transcript_userselect and st.session_state['context'] and transcript_state != STALE:
+            st.warning("Transcription is already performed and up to date. Uncheck to run again the transcription.")
+            return False
+
+        runner = get_job_runner()
+        if runner.is_running(st.session_state['project_path']):
+            st.warning("A transcription is already running for this project. Cancel it first to start a new one.")
+            return False
+
+        st.session_state['timings'] = []
+        st.session_state['context'] = None
+        envtype = 'OpenAI' if model_type.lower()=='openai' else 'local'
+        params = {
+            'audio_filepath': st.session_state['audio_filepath'],
+            'pcm_path': get_pcm_path(st.session_state['project_path'], st.session_state['audio_filepath']),
+            **stage_params,
+            # Parallel workers for the local models, concurrent uploads for OpenAI
+            'n_workers': st.session_state['transcribe_workers'] if envtype == 'local' else 1,
+            'torch_threads': st.session_state['torch_threads'],
+            'read_cache': load_transcript_userselect,
+            'cache_dir': get_transcript_cache().cache_dir,
+            'cache_size_mb': st.session_state['transcript_cache_size_mb'],
+            'whisper_memory_budget': st.session_state['whisper_memory_budget'],
+            'openai_concurrency': st.session_state['openai_concurrency'],
+            'openai_rpm': st.session_state['openai_rpm'],
+            'openai_max_retries': st.session_state['openai_max_retries'],
+        }
+        runner.submit(st.session_state['project_path'], params, api_key=st.session_state['openai_api_key'])
+        # Show the status view
+        st.rerun()
 
-        status_placeholder = st.empty()
-        status_placeholder2 = st.empty()
-        status_placeholder3 = st.empty()
-        status_placeholder4 = st.empty()
+    return False
 
-        # Create chunks of 300sec
-        segment_time = 300
-        audio_chunks = create_audio_chunks(st.session_state['project_path'], st.session_state['audio_filepath'], segment_time=segment_time)
 
-        transcripts = []
-        timings = []
-        envtype = 'OpenAI' if model_type.lower()=='openai' else 'local'
-        # my_bar.progress(0, text=f'Working on the first audio chunk using Whisper-{model_type} model in the [{envtype}] environment.')
-
-        status_placeholder2.markdown(f"""✅ Transcription of **{st.session_state['project_name']}** is initiated.""")
-        status_placeholder3.markdown(f"""✅ Running in **{envtype}** environment.""")
-        status_placeholder4.markdown(f"""✅ **Whisper-{model_type} model** is succesfully loaded.""")
-
-        # Run over all audio fragments
-        for i, audio_path in enumerate(audio_chunks):
-            # time
-            # st.write(audio_path)
-            start_time = time.time()
-            # Create a unique cache filename for this chunk
-            base_filename = os.path.splitext(os.path.basename(audio_path))[0]
-            chunk_filename = f"{base_filename}.json"
-            chunk_path = os.path.join(st.session_state['project_path'], chunk_filename)
-
-            # Load transcript from textfile or run model
-            if os.path.exists(chunk_path) and load_transcript_userselect:
-                # Load cached transcript
-                with open(chunk_path, "r", encoding="utf-8") as f:
-                    cached_data = json.load(f)
-                    transcript_text = cached_data.get('text', '')
-                    duration = cached_data.get('duration', '')
-                    if isinstance(duration, str):
-                        duration = float(duration) if duration.isnumeric() else 0
-            else:
-                # Create transcript
-                if model_type.lower() == 'openai':
-                    # large-v2
-                    transcript = transcribe_audio_from_path(audio_path)
-                    # Als het een streamlit object is, dan kan je deze ook gebruiken:
-                    # transcript = transcribe_audio_streamlit_object(audio)
-                else:
-                    # Run local model
-                    transcript = transcribe_local(audio_path, model_type)
-
-                # Get the transcript text
-                transcript_text = transcript.get('text', '')
-                # Store timings
-                duration = (time.time() - start_time) / 60  # Convert to min
-
-            # Save transcript to cache
-            with open(chunk_path, "w", encoding="utf-8") as f:
-                json.dump({'text': transcript_text, 'duration': round(duration, 4)}, f, ensure_ascii=False, indent=2)
-
-            # Append transcripts
-            transcripts.append(transcript_text)
-            timings.append(duration)
-
-            # Progress calculation
-            progress_percent = int((max(i + 1, 1) / len(audio_chunks)) * 100)
-            avg_time = sum(timings) / len(timings)
-            remaining_chunks = len(audio_chunks) - (i + 1)
-
-            # Format estimated time left
-            estimated_min = avg_time * remaining_chunks
-            estimated_time_left = 'To be estimated' if estimated_min < 0.1 else f"{round(estimated_min, 1)} min"
-            # Calculate estimated finish time
-            if estimated_min < 0.1:
-                formatted_completion_time = 'To be estimated'
+#%%
+def show_job_status():
+    """Show the status of the latest transcription job of the project. Polls while the job is running."""
+    if not st.session_state['project_path']:
+        return
+    job = get_job_runner().latest(st.session_state['project_path'])
+    if job is None:
+        return
+    # Rerun this fragment every few seconds while the job is active
+    st.fragment(_job_status, run_every=2 if job['status'] in ACTIVE else None)()
+
+
+def _job_status():
+    runner = get_job_runner()
+    project_path = st.session_state['project_path']
+    job = runner.latest(project_path)
+    params = job['params']
+    envtype = 'OpenAI' if params['model_type'].lower()=='openai' else 'local'
+    n_workers = params['n_workers'] if envtype == 'local' else params['openai_concurrency']
+
+    with st.container(border=True):
+        progress = job_progress(job)
+        st.progress(progress['percent'] / 100, text=f"Transcription {job['status']}: {progress['percent']:.0f}%")
+        st.caption(f"Chunk {progress['n_done']} of ~{progress['n_total']} | Whisper-{params['model_type']} | {envtype} | Workers: {n_workers} | Audio: {progress['done_seconds'] / 60:.1f} of {progress['total_seconds'] / 60:.1f} min")
+
+        if job['status'] in ACTIVE:
+            st.caption(f"Average chunk time: {progress['avg_time']:.1f} min | Estimated time left: {progress['time_left']} | {progress['completion_time']}")
+            st.info("The transcription runs in the background. You can navigate away and come back later.", icon="ℹ️")
+            if st.button('Cancel Transcription'):
+                runner.cancel(project_path, job['id'])
+                st.rerun(scope='fragment')
+        elif job['status'] in (CANCELLED, INTERRUPTED, FAILED):
+            if job['status'] == FAILED:
+                st.error(f"Transcription failed: {job['error']}")
             else:
-                estimated_completion_time = datetime.now() + timedelta(minutes=estimated_min)
-                formatted_completion_time = estimated_completion_time.strftime("%Y-%m-%d %H:%M:%S")
-
-            # Show detailed progress text
-            status_placeholder3 = st.empty()
-            status_placeholder4 = st.empty()
-            status_placeholder2.markdown(f"""
-            <div style="width: 100%; background-color: #E5E7EB; border-radius: 6px; margin-top: 1em;">
-              <div style="width: {progress_percent}%; background-color: #3B82F6; height: 12px; border-radius: 6px;"></div>
-            </div>
-            <p style="font-size: 0.9em; color: #6B7280;">Progress: {progress_percent:.1f}%</p>
-            """, unsafe_allow_html=True)
-
-            # Show detailed status
-            status_placeholder.markdown(
-                f"""
-                <div style="padding: 1em; border-radius: 8px; background-color: #F3F4F6; color: #111827;">
-                    <strong>Chunk {i + 1} of {len(audio_chunks)}</strong><br>
-                    Model: <span style="color:#2563EB;"><code>Whisper-{model_type}</code></span> |
-                    Environment: <span style="color:#10B981;"><code>{envtype}</code></span><br>
-                    Average chunk time: <strong>{avg_time:.1f} min</strong> | Total chunks: {len(audio_chunks)}<br>
-                    Estimated time left: <strong>{estimated_time_left}</strong> | {formatted_completion_time}
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
-
-        # Timings
-        if len(timings) > 0: st.session_state['timings'] = timings
-        # Create one big transcript
-        st.session_state['context'] = ' '.join(transcripts)
-        # Save session
-        save_session()
-        return True
+                st.warning(f"Transcription is {job['status']} after {progress['n_done']} chunks.")
+            if st.button('Resume Transcription', type='primary', help='Continue with the chunks that are not transcribed yet.'):
+                runner.resume(project_path, job['id'], api_key=st.session_state['openai_api_key'])
+                st.rerun()
+        elif job['status'] == DONE:
+            if job['skipped_seconds'] > 0:
+                st.caption(f"Skipped {job['skipped_seconds'] / 60:.1f} min of silence.")
+            # Cache statistics
+            if params['cache_dir']:
+                stats = get_transcript_cache().stats()
+                st.caption(f"Transcript cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), {stats['entries']} entries, {stats['size_mb']:.1f} MB")
+            # Load the transcript of the finished job once into the session
+            if st.session_state['transcribe_job'] != job['id']:
+                result = job_result(job)
+                if len(result['timings']) > 0: st.session_state['timings'] = result['timings']
+                st.session_state['context'] = result['context']
+                st.session_state['segments'] = result['segments']
+                st.session_state['transcribe_job'] = job['id']
+                # Save session
+                save_session()
+                st.rerun()
 
-    return False
+
+def job_progress(job):
+    """Progress of the job in seconds of the recording.
+
+    The number of chunks is not known while the recording is still being decoded, so the
+    remaining chunks are estimated from the average length of the chunks so far.
+    """
+    chunks = list(job['chunks'].values())
+    timings = [chunk['duration'] for chunk in chunks if not chunk.get('cached')] or [0]
+    done_seconds = sum(chunk['end'] - chunk['start'] for chunk in chunks) / SAMPLE_RATE
+    total_seconds = max(job['total_seconds'] or 0, done_seconds)
+    if job['status'] == DONE:
+        total_seconds = done_seconds
+    percent = min(100, done_seconds / total_seconds * 100) if total_seconds > 0 else 0
+    avg_time = float(np.mean(timings))
+    avg_seconds = done_seconds / len(chunks) if chunks else 0
+    remaining_chunks = max(0.0, (total_seconds - done_seconds) / avg_seconds) if avg_seconds > 0 else 0
+
+    # Chunks run in parallel when there are multiple workers
+    n_workers = job['params']['n_workers'] if job['params']['model_type'].lower() != 'openai' else job['params']['openai_concurrency']
+    estimated_min = avg_time * remaining_chunks / max(1, min(n_workers, remaining_chunks))
+    if estimated_min < 0.1:
+        time_left, completion_time = 'To be estimated', 'To be estimated'
+    else:
+        time_left = f"{round(estimated_min, 1)} min"
+        completion_time = (datetime.now() + timedelta(minutes=estimated_min)).strftime("%Y-%m-%d %H:%M:%S")
+
+    return {
+        'percent': percent,
+        'n_done': len(chunks),
+        'n_total': len(chunks) + int(np.ceil(remaining_chunks)),
+        'done_seconds': done_seconds,
+        'total_seconds': total_seconds,
+        'avg_time': avg_time,
+        'time_left': time_left,
+        'completion_time': completion_time,
+    }
 
 
 # %%
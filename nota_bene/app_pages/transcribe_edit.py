@@ -9,11 +9,13 @@ try:
 except:
     print('pip install openai-whisper')
 
-from nota_bene.utils import switch_page_button, create_audio_chunks, transcribe_audio_from_path, transcribe_local, save_session
+from nota_bene.utils import switch_page_button, ensure_loaded, save_session
+from nota_bene.pipeline import Pipeline, fingerprint
 
 #%%
 @st.fragment
 def run_main():
+    ensure_loaded('context', 'segments')
     # Ensure necessary session state variables are initialized
     st.session_state.setdefault('edit_transcript_mode', False)
     st.session_state.setdefault('context', '')
@@ -42,6 +44,8 @@ def run_main():
             if st.button("💾 Save Transcript"):
                 st.session_state['context'] = edited_transcript
                 st.session_state['edit_transcript_mode'] = False
+                # The minute notes of the previous transcript are stale
+                Pipeline(st.session_state['project_path']).update_output('transcript', fingerprint(edited_transcript))
                 save_session(save_audio=True)
                 st.success("Transcript updated.")
                 st.rerun()
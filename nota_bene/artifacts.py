@@ -0,0 +1,291 @@
+"""
+Content-addressed store of the intermediate audio files.
+
+Intermediates are stored in ``.artifacts`` in the temp directory, named by a hash of their
+inputs and parameters. Projects hold references to the artifacts they use, and the
+garbage collector removes the unreferenced ones when the store exceeds its size budget.
+"""
+
+import os
+import re
+import glob
+import time
+import json
+import hashlib
+import logging
+import threading
+
+from contextlib import contextmanager
+
+from nota_bene.cache import make_key, atomic_write_json, _file_lock
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_DIRNAME = '.artifacts'
+# Artifacts that were used in the last seconds are never removed, so a running build or job keeps its files
+GRACE_SECONDS = 600
+# Exact names of the intermediates that older versions wrote in the project directories
+LEGACY_PATTERNS = (r'chunk_\d{3}\.m4a', r'audio_file_stacked_\d+k\.\w+', r'audio_\d+_compressed_\d+k\.\w+')
+# Written in the project directory once the legacy intermediates are removed
+LEGACY_MARKER = '.legacy_swept'
+
+# (path, size, mtime) -> sha256 of the files that are hashed in this process
+_DIGESTS = {}
+
+
+#%%
+def file_digest(file_path, block_size=1024**2):
+    """sha256 of the content of the file. The digest is computed once per version of the file."""
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if key not in _DIGESTS:
+        hasher = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                hasher.update(block)
+        _DIGESTS[key] = hasher.hexdigest()
+    return _DIGESTS[key]
+
+
+def is_artifact(file_path):
+    """The file is in an artifact store."""
+    return isinstance(file_path, str) and os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(file_path)))) == ARTIFACT_DIRNAME
+
+
+def _artifact_key(filename):
+    # The key is the part of the filename before the extension or suffix, e.g. '<key>_16k.f32'
+    return re.split(r'[._]', filename, maxsplit=1)[0]
+
+
+#%%
+class ArtifactStore:
+    """Content-addressed intermediates with reference tracking and a size budget.
+
+    Parameters
+    ----------
+    temp_dir : str
+        Temp directory of the app. The artifacts are stored in ``.artifacts`` in this directory.
+    max_size_mb : float, optional
+        Size budget of the store in MB. Unreferenced artifacts are removed when exceeded.
+    """
+    def __init__(self, temp_dir, max_size_mb=4096):
+        self.temp_dir = temp_dir
+        self.root = os.path.join(temp_dir, ARTIFACT_DIRNAME)
+        self.refs_path = os.path.join(self.root, 'refs.json')
+        self.max_size_mb = max_size_mb
+        self._lock = threading.RLock()
+
+    def key(self, kind, file_paths, params=None):
+        """Hash of the kind, the content of the input files in order and the parameters."""
+        return make_key(kind, *[file_digest(file_path) for file_path in file_paths], params or {})
+
+    def path(self, key, ext):
+        return os.path.join(self.root, key[:2], key + ext)
+
+    def build(self, kind, file_paths, params, ext, builder):
+        """Return the artifact of the inputs and parameters. It is built with builder(path) when it does not exist.
+
+        Parameters
+        ----------
+        kind : str
+            Kind of artifact, e.g. 'audio'. Part of the key.
+        file_paths : list
+            Input files in order.
+        params : dict
+            Parameters that change the output.
+        ext : str
+            Extension of the artifact.
+        builder : callable
+            Called with the path of the artifact. It must write the file atomically.
+        """
+        filepath = self.path(self.key(kind, file_paths, params), ext)
+        if os.path.isfile(filepath):
+            logger.info(f'Reusing {kind} artifact {os.path.basename(filepath)}.')
+            self.touch(filepath)
+            return filepath
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        return builder(filepath)
+
+    def touch(self, filepath):
+        """Mark the artifact and its derived files as recently used."""
+        key = _artifact_key(os.path.basename(filepath))
+        # The same time for all files, so that the derived files stay up to date with the artifact
+        now = time.time()
+        for path in glob.glob(os.path.join(os.path.dirname(filepath), key + '*')):
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+
+    #%% References
+    def refs(self):
+        """Return {owner: {slot: artifact filename}}."""
+        try:
+            with open(self.refs_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    @contextmanager
+    def _refs_lock(self):
+        # The references are shared by the processes of the temp directory, e.g. of 'notabene batch --jobs N'
+        os.makedirs(self.root, exist_ok=True)
+        with self._lock, _file_lock(self.refs_path + '.lock'):
+            yield
+
+    def acquire(self, owner, slot, filepath):
+        """Let the owner (project directory) refer to the artifact. It replaces the earlier artifact in the slot."""
+        if not is_artifact(filepath):
+            return
+        with self._refs_lock():
+            refs = self.refs()
+            refs.setdefault(owner, {})[slot] = os.path.basename(filepath)
+            atomic_write_json(self.refs_path, refs)
+
+    def release(self, owner, slot=None):
+        """Drop the reference of the owner in the slot, or all its references."""
+        with self._refs_lock():
+            refs = self.refs()
+            if owner not in refs:
+                return
+            if slot is None:
+                refs.pop(owner)
+            else:
+                refs[owner].pop(slot, None)
+            atomic_write_json(self.refs_path, refs)
+
+    def referenced(self):
+        """Keys of the artifacts that are referenced by existing projects. References of deleted projects are dropped."""
+        with self._refs_lock():
+            return self._referenced()
+
+    def _referenced(self):
+        refs = self.refs()
+        alive = {owner: slots for owner, slots in refs.items() if os.path.isdir(owner)}
+        if len(alive) != len(refs):
+            atomic_write_json(self.refs_path, alive)
+        return {_artifact_key(filename) for slots in alive.values() for filename in slots.values()}
+
+    #%% Garbage collection
+    def entries(self):
+        """Return [(key, size, last used, paths)] of the artifacts, least recently used first."""
+        groups = {}
+        if not os.path.isdir(self.root):
+            return []
+        for root, _, files in os.walk(self.root):
+            if root == self.root:
+                continue
+            for filename in files:
+                filepath = os.path.join(root, filename)
+                try:
+                    stat = os.stat(filepath)
+                except FileNotFoundError:
+                    continue
+                entry = groups.setdefault(_artifact_key(filename), [0, 0, []])
+                entry[0] += stat.st_size
+                entry[1] = max(entry[1], stat.st_mtime)
+                entry[2].append(filepath)
+        return sorted(((key, size, mtime, paths) for key, (size, mtime, paths) in groups.items()), key=lambda x: x[2])
+
+    def size(self):
+        """Total size of the artifacts in bytes."""
+        return sum(entry[1] for entry in self.entries())
+
+    def gc(self, max_size_mb=None):
+        """Remove unreferenced artifacts, least recently used first, until the store fits in the budget.
+
+        Returns
+        -------
+        int
+            Number of removed artifacts.
+        """
+        max_bytes = (self.max_size_mb if max_size_mb is None else max_size_mb) * 1024**2
+        # No other process can refer to an artifact while it is removed
+        with self._refs_lock():
+            referenced = self._referenced()
+            entries = self.entries()
+            total = sum(entry[1] for entry in entries)
+            n_removed = 0
+            now = time.time()
+            for key, size, mtime, paths in entries:
+                if total <= max_bytes:
+                    break
+                if key in referenced or now - mtime < GRACE_SECONDS:
+                    continue
+                for filepath in paths:
+                    try:
+                        os.remove(filepath)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                n_removed += 1
+        if n_removed > 0:
+            logger.info(f'Removed {n_removed} artifacts from {self.root}')
+        return n_removed
+
+    def clear_unreferenced(self):
+        """Remove all artifacts that are not referenced by a project."""
+        return self.gc(max_size_mb=0)
+
+    def stats(self):
+        """Return the number of artifacts, the number that is referenced and the size in MB."""
+        referenced = self.referenced()
+        entries = self.entries()
+        return {
+            'entries': len(entries),
+            'referenced': sum(entry[0] in referenced for entry in entries),
+            'size_mb': sum(entry[1] for entry in entries) / 1024**2,
+        }
+
+
+#%%
+def sweep_legacy(project_path, keep=()):
+    """Remove the intermediates that older versions left in the project directory, once per project.
+
+    Parameters
+    ----------
+    project_path : str
+        Directory of the project.
+    keep : iterable, optional
+        Files that are still used by the project, e.g. its audio file.
+
+    Returns
+    -------
+    int
+        Number of removed files.
+    """
+    marker = os.path.join(project_path, LEGACY_MARKER)
+    if os.path.isfile(marker) or not os.path.isdir(project_path):
+        return 0
+    keep = {os.path.abspath(filepath) for filepath in keep if filepath}
+    n_removed = 0
+    for entry in os.scandir(project_path):
+        if not entry.is_file() or os.path.abspath(entry.path) in keep:
+            continue
+        if any(re.fullmatch(pattern, entry.name) for pattern in LEGACY_PATTERNS):
+            try:
+                os.remove(entry.path)
+                n_removed += 1
+            except OSError:
+                pass
+    open(marker, 'w').close()
+    if n_removed > 0:
+        logger.info(f'Removed {n_removed} intermediates of an older version from {project_path}')
+    return n_removed
+
+
+#%%
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_artifact_store(temp_dir, max_size_mb=None):
+    """Return the artifact store of the temp directory. The size budget is updated when given."""
+    temp_dir = os.path.abspath(temp_dir)
+    with _STORES_LOCK:
+        if temp_dir not in _STORES:
+            _STORES[temp_dir] = ArtifactStore(temp_dir)
+        store = _STORES[temp_dir]
+    if max_size_mb is not None:
+        store.max_size_mb = max_size_mb
+    return store
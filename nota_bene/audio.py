@@ -0,0 +1,718 @@
+"""
+Decoded audio buffers.
+
+The combined recording is decoded once by ffmpeg into a raw 16 kHz mono float32 file.
+The file is memory-mapped and chunks are views on that buffer, so the audio is not
+decoded again per chunk and worker processes share the same pages through the page
+cache. A :class:`PCMSlice` is a small picklable reference to such a view that can be
+sent to a worker process.
+
+Chunk boundaries can be placed in silences with a simple energy-based voice activity
+detection. Long silences are dropped before inference and the remaining speech regions
+are kept as sample offsets so that transcript timestamps map back to the recording.
+
+Uploads and recordings are combined into the project audio file with one ffmpeg filter
+graph that concatenates, downmixes, resamples and encodes in a single pass.
+"""
+
+import os
+import io
+import json
+import wave
+import shutil
+import tempfile
+import queue
+import logging
+import threading
+import subprocess
+from typing import NamedTuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from nota_bene.cache import DiskCache, make_key
+
+logger = logging.getLogger(__name__)
+
+# Whisper expects 16 kHz mono audio
+SAMPLE_RATE = 16000
+
+
+#%%
+class PCMSlice(NamedTuple):
+    """Reference to the samples [start, end) of a decoded PCM file.
+
+    When regions are given, the slice only contains the (start, end) speech regions
+    within [start, end) and the silences between them are dropped.
+    """
+    pcm_path: str
+    start: int
+    end: int
+    regions: tuple = ()
+
+    @property
+    def offset(self):
+        """Start of the slice in seconds."""
+        return self.start / SAMPLE_RATE
+
+    @property
+    def seconds(self):
+        """Number of seconds of audio in the slice, without the dropped silences."""
+        if self.regions:
+            return sum(end - start for start, end in self.regions) / SAMPLE_RATE
+        return (self.end - self.start) / SAMPLE_RATE
+
+    def load(self):
+        """Return the samples. A contiguous slice is a view on the memory-mapped file."""
+        pcm = load_pcm(self.pcm_path)
+        if self.regions:
+            return np.concatenate([pcm[start:end] for start, end in self.regions])
+        return pcm[self.start:self.end]
+
+    def to_timeline(self, seconds):
+        """Map a timestamp in the slice to the timestamp in the recording."""
+        if not self.regions:
+            return self.offset + seconds
+
+        sample = int(round(seconds * SAMPLE_RATE))
+        for start, end in self.regions:
+            if sample <= end - start:
+                return (start + sample) / SAMPLE_RATE
+            sample -= end - start
+        return self.end / SAMPLE_RATE
+
+
+#%%
+def decode_to_pcm(file_path, pcm_path=None, overwrite=False):
+    """Decode an audio file once to raw 16 kHz mono float32 samples on disk.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the audio file.
+    pcm_path : str, optional
+        Output path of the raw samples. Defaults to the audio file with the extension ``.f32``.
+    overwrite : bool, optional
+        Decode again even when the output is newer than the audio file.
+
+    Returns
+    -------
+    str
+        Path to the raw samples.
+    """
+    if pcm_path is None:
+        pcm_path = os.path.splitext(file_path)[0] + '_16k.f32'
+
+    # The decoded file is up to date
+    if not overwrite and pcm_up_to_date([file_path], pcm_path):
+        return pcm_path
+
+    logger.info(f'Decoding {file_path} to 16 kHz mono PCM..')
+    tmp_path = pcm_path + '.tmp'
+    command = [
+        'ffmpeg',
+        '-nostdin',
+        '-threads', '0',
+        '-i', file_path,        # Input file
+        '-f', 'f32le',          # Raw float32 samples
+        '-ac', '1',             # Mono
+        '-ar', str(SAMPLE_RATE),  # Resample to 16 kHz
+        '-y', tmp_path,
+    ]
+    subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    os.replace(tmp_path, pcm_path)
+    return pcm_path
+
+
+def pcm_up_to_date(file_paths, pcm_path):
+    """The decoded file is complete and newer than all audio files."""
+    if not os.path.isfile(pcm_path) or os.path.isfile(pcm_path + '.partial'):
+        return False
+    return all(os.path.getmtime(pcm_path) >= os.path.getmtime(file_path) for file_path in file_paths)
+
+
+def load_pcm(pcm_path):
+    """Memory-map the raw float32 samples (read-only)."""
+    if os.path.getsize(pcm_path) == 0:
+        return np.zeros(0, dtype=np.float32)
+    return np.memmap(pcm_path, dtype=np.float32, mode='r')
+
+
+def pcm_seconds(pcm_path):
+    """Length of the decoded audio in seconds."""
+    return os.path.getsize(pcm_path) / np.dtype(np.float32).itemsize / SAMPLE_RATE
+
+
+def pcm_slices(pcm_path, segment_time=300, start=0):
+    """Cut the decoded audio from sample start in fixed slices of segment_time seconds."""
+    n_samples = os.path.getsize(pcm_path) // np.dtype(np.float32).itemsize
+    step = int(segment_time * SAMPLE_RATE)
+    return [PCMSlice(pcm_path, pos, min(pos + step, n_samples)) for pos in range(start, n_samples, step)]
+
+
+def pcm_to_wav(audio, name='audio.wav'):
+    """Encode float32 samples to an in-memory 16-bit WAV file, e.g. to upload a slice."""
+    audio = np.clip(np.asarray(audio), -1.0, 1.0)
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes((audio * 32767).astype('<i2').tobytes())
+    buffer.seek(0)
+    buffer.name = name
+    return buffer
+
+
+#%% Voice activity detection
+def frame_energy_db(audio, frame_len, block_frames=20000):
+    """Energy in dB per frame. Computed per block so that memory stays bounded for long recordings."""
+    n_frames = len(audio) // frame_len
+    energy = np.empty(n_frames, dtype=np.float32)
+    for i in range(0, n_frames, block_frames):
+        j = min(i + block_frames, n_frames)
+        frames = np.asarray(audio[i * frame_len:j * frame_len], dtype=np.float32).reshape(j - i, frame_len)
+        energy[i:j] = 10 * np.log10(np.mean(np.square(frames), axis=1) + 1e-10)
+    return energy
+
+
+def _runs(mask):
+    """Start and end indices of the runs of True values."""
+    diff = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.flatnonzero(diff == 1), np.flatnonzero(diff == -1)
+
+
+def detect_speech(energy, frame_time=0.03, margin_db=12, floor_db=-65, min_speech=0.25, min_silence=2.0, padding=0.25):
+    """Detect speech regions from the frame energies.
+
+    Parameters
+    ----------
+    energy : np.ndarray
+        Energy in dB per frame, see :func:`frame_energy_db`.
+    frame_time : float, optional
+        Length of a frame in seconds.
+    margin_db : float, optional
+        Frames that are margin_db above the noise floor are speech.
+    floor_db : float, optional
+        Frames below this absolute level are always silence (muted microphones).
+    min_speech : float, optional
+        Speech bursts shorter than this number of seconds are ignored.
+    min_silence : float, optional
+        Silences shorter than this number of seconds are kept as part of the speech.
+    padding : float, optional
+        Seconds of audio that are kept around every speech region.
+
+    Returns
+    -------
+    list
+        (start_frame, end_frame) of the speech regions.
+    """
+    if len(energy) == 0:
+        return []
+
+    # Adaptive threshold. The upper bound prevents that speech is dropped when there is hardly any silence.
+    threshold = min(np.percentile(energy, 10) + margin_db, np.percentile(energy, 95) - margin_db)
+    starts, ends = _runs((energy > threshold) & (energy > floor_db))
+
+    # Remove short bursts (clicks, coughs)
+    keep = (ends - starts) >= int(min_speech / frame_time)
+    starts, ends = starts[keep], ends[keep]
+    if len(starts) == 0:
+        return []
+
+    # Merge regions that are separated by short pauses
+    long_gaps = (starts[1:] - ends[:-1]) >= int(min_silence / frame_time)
+    starts = starts[np.concatenate([[True], long_gaps])]
+    ends = ends[np.concatenate([long_gaps, [True]])]
+
+    # Pad the regions
+    pad = int(padding / frame_time)
+    starts = np.maximum(starts - pad, 0)
+    ends = np.minimum(ends + pad, len(energy))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def _split_region(start, end, energy, target, search):
+    """Split a long region at the quietest frames around the target length."""
+    parts = []
+    while end - start > target + search:
+        lo, hi = start + target - search, min(start + target + search, end)
+        cut = lo + int(np.argmin(energy[lo:hi]))
+        parts.append((start, cut))
+        start = cut
+    parts.append((start, end))
+    return parts
+
+
+def vad_slices(pcm_path, segment_time=300, frame_time=0.03, search_time=30, start=0, end=None, **kwargs):
+    """Cut the decoded audio in slices of about segment_time seconds at silences and drop the silences.
+
+    Parameters
+    ----------
+    pcm_path : str
+        Path to the raw 16 kHz float32 samples.
+    segment_time : float, optional
+        Target length of a slice in seconds.
+    frame_time : float, optional
+        Length of the analysis frames in seconds.
+    search_time : float, optional
+        Speech regions that are longer than segment_time are cut at the quietest frame within
+        segment_time +/- search_time.
+    start, end : int, optional
+        Only segment the samples [start, end) of the decoded audio.
+    **kwargs
+        Parameters of :func:`detect_speech`.
+
+    Returns
+    -------
+    list
+        PCMSlice objects with the speech regions as sample offsets in the recording.
+    """
+    offset = start
+    audio = load_pcm(pcm_path)[start:end]
+    frame_len = int(frame_time * SAMPLE_RATE)
+    energy = frame_energy_db(audio, frame_len)
+    regions = detect_speech(energy, frame_time=frame_time, **kwargs)
+
+    target = int(segment_time / frame_time)
+    search = int(search_time / frame_time)
+    slices, current, current_len = [], [], 0
+    for region_start, region_end in regions:
+        for start, end in _split_region(region_start, region_end, energy, target, search):
+            # Close the current slice when the region does not fit anymore
+            if current and current_len + (end - start) > target + search:
+                slices.append(current)
+                current, current_len = [], 0
+            current.append((start, end))
+            current_len += end - start
+            if current_len >= target:
+                slices.append(current)
+                current, current_len = [], 0
+    if current:
+        slices.append(current)
+
+    def to_sample(frame):
+        # The last frame is extended to the end of the audio
+        return offset + (len(audio) if frame == len(energy) else frame * frame_len)
+
+    pcm_slices = []
+    for regions in slices:
+        regions = tuple((to_sample(start), to_sample(end)) for start, end in regions)
+        # A single region is a contiguous view without copies
+        pcm_slices.append(PCMSlice(pcm_path, regions[0][0], regions[-1][1], regions if len(regions) > 1 else ()))
+    return pcm_slices
+
+
+#%% Streaming decode
+class _StreamSegmenter:
+    """Cut the samples that are written so far into slices, holding back the slice that may still grow.
+
+    The known slices (of an earlier run) are returned as they are once their samples are
+    written; only the samples after the last known slice are segmented.
+    """
+    def __init__(self, pcm_path, segment_time=300, vad=False, search_time=30, known_slices=(), **kwargs):
+        self.pcm_path = pcm_path
+        self.segment_time = segment_time
+        self.vad = vad
+        self.search_time = search_time
+        self.kwargs = kwargs
+        self.known = list(known_slices)
+        self.pos = 0
+
+    def feed(self, n_samples, final=False):
+        """Return the slices that are complete now that n_samples are written."""
+        known = []
+        while self.known and self.known[0].end <= n_samples:
+            known.append(self.known.pop(0))
+            self.pos = known[-1].end
+        if self.known and not final:
+            return known
+        # The audio is shorter than the known slices, e.g. when a recording was replaced
+        self.known = []
+        return known + self._segment(n_samples, final)
+
+    def _segment(self, n_samples, final):
+        if not self.vad:
+            step = int(self.segment_time * SAMPLE_RATE)
+            slices = []
+            while n_samples - self.pos >= step or (final and n_samples > self.pos):
+                end = min(self.pos + step, n_samples)
+                slices.append(PCMSlice(self.pcm_path, self.pos, end))
+                self.pos = end
+            return slices
+
+        # Wait until the window holds at least two slices, so that the cut points are not at the window edge
+        if not final and n_samples - self.pos < 2 * (self.segment_time + self.search_time) * SAMPLE_RATE:
+            return []
+        slices = vad_slices(self.pcm_path, segment_time=self.segment_time, search_time=self.search_time, start=self.pos, end=n_samples, **self.kwargs)
+        if final:
+            self.pos = n_samples
+            return slices
+        # The last slice may continue in the samples that are not decoded yet
+        slices = slices[:-1]
+        if slices:
+            self.pos = slices[-1].end
+        return slices
+
+
+def _ffmpeg_inputs(file_paths, concat_path):
+    """Input arguments for ffmpeg. Multiple files are concatenated with the concat demuxer."""
+    if len(file_paths) == 1:
+        return ['-i', file_paths[0]]
+    with open(concat_path, 'w') as f:
+        for file in file_paths:
+            f.write(f"file '{file}'\n")
+    return ['-f', 'concat', '-safe', '0', '-i', concat_path]
+
+
+def _decode_stream(file_paths, pcm_path, segmenter, output, block_time=30):
+    """Decode the audio files with ffmpeg to pcm_path and put the slices in the output queue as soon as they are complete."""
+    try:
+        concat_path = pcm_path + '.txt'
+        command = ['ffmpeg', '-nostdin', '-threads', '0'] + _ffmpeg_inputs(file_paths, concat_path) + ['-f', 'f32le', '-ac', '1', '-ar', str(SAMPLE_RATE), '-']
+        # Mark the decoded file as incomplete until ffmpeg has finished
+        open(pcm_path + '.partial', 'w').close()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        itemsize = np.dtype(np.float32).itemsize
+        block_size = int(block_time * SAMPLE_RATE) * itemsize
+        remainder, n_bytes = b'', 0
+        with open(pcm_path, 'wb') as f:
+            while True:
+                data = process.stdout.read(block_size)
+                if not data:
+                    break
+                # Only write whole samples so that the file can always be memory-mapped
+                data = remainder + data
+                n_whole = len(data) - len(data) % itemsize
+                remainder = data[n_whole:]
+                f.write(data[:n_whole])
+                f.flush()
+                n_bytes += n_whole
+                for pcm_slice in segmenter.feed(n_bytes // itemsize):
+                    output.put(pcm_slice)
+
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        for pcm_slice in segmenter.feed(n_bytes // itemsize, final=True):
+            output.put(pcm_slice)
+        os.remove(pcm_path + '.partial')
+        if os.path.isfile(concat_path):
+            os.remove(concat_path)
+        output.put(None)
+    except Exception as e:
+        output.put(e)
+
+
+def stream_pcm_slices(file_paths, pcm_path, segment_time=300, vad=False, known_slices=None, **kwargs):
+    """Decode the audio files and yield the slices while ffmpeg is still decoding.
+
+    The files are concatenated, downmixed and resampled to 16 kHz in one ffmpeg process
+    that runs in a background thread. Slices are handed over through a queue as soon as
+    they are complete, so that transcription of the first slice starts after seconds
+    instead of after decoding the whole recording. When the decoded file is already
+    up to date, the slices are created directly from it.
+
+    Parameters
+    ----------
+    file_paths : str or list
+        Audio file or files that are concatenated in the given order.
+    pcm_path : str
+        Path for the raw 16 kHz float32 samples.
+    segment_time : float, optional
+        (Target) length of the slices in seconds.
+    vad : bool, optional
+        Cut the slices at silences and drop long silences, see :func:`vad_slices`.
+    known_slices : list, optional
+        (start, end, regions) of the slices of an earlier run, e.g. of a resumed job. They are yielded as they are, so the
+        audio is cut at the same points; only the audio after the last one is segmented.
+    **kwargs
+        Parameters of :func:`vad_slices`.
+
+    Yields
+    ------
+    PCMSlice
+        The slices in order of the recording.
+    """
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    known_slices = [PCMSlice(pcm_path, start, end, tuple(map(tuple, regions))) for start, end, regions in known_slices or ()]
+
+    if pcm_up_to_date(file_paths, pcm_path):
+        n_samples = os.path.getsize(pcm_path) // np.dtype(np.float32).itemsize
+        known_slices = [pcm_slice for pcm_slice in known_slices if pcm_slice.end <= n_samples]
+        yield from known_slices
+        start = known_slices[-1].end if known_slices else 0
+        if start < n_samples:
+            yield from (vad_slices(pcm_path, segment_time=segment_time, start=start, **kwargs) if vad else pcm_slices(pcm_path, segment_time=segment_time, start=start))
+        return
+
+    logger.info(f'Streaming decode of {len(file_paths)} file(s) to 16 kHz mono PCM..')
+    output = queue.Queue()
+    segmenter = _StreamSegmenter(pcm_path, segment_time=segment_time, vad=vad, known_slices=known_slices, **kwargs)
+    threading.Thread(target=_decode_stream, args=(file_paths, pcm_path, segmenter, output), daemon=True).start()
+    while True:
+        item = output.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+#%% Ingest
+def ingest_command(file_paths, output_file, bitrate='24k', sample_rate=SAMPLE_RATE):
+    """ffmpeg command that concatenates, downmixes, resamples and encodes the files in one pass.
+
+    Every input is converted to mono at sample_rate before the concat filter, so inputs with
+    different sample rates or channel layouts can be combined.
+    """
+    inputs, labels = [], ''
+    for i, file_path in enumerate(file_paths):
+        inputs += ['-i', file_path]
+        labels += f'[{i}:a:0]aresample={sample_rate},aformat=sample_fmts=fltp:channel_layouts=mono[a{i}];'
+    graph = labels + ''.join(f'[a{i}]' for i in range(len(file_paths))) + f'concat=n={len(file_paths)}:v=0:a=1[out]'
+    return [
+        'ffmpeg',
+        '-nostdin',
+        '-threads', '0',
+        *inputs,
+        '-filter_complex', graph,
+        '-map', '[out]',
+        '-c:a', 'aac',          # Encode to AAC
+        '-b:a', bitrate,        # Target bitrate (e.g., '24k')
+        '-movflags', '+faststart',  # Optimize for streaming
+        '-y', output_file,
+    ]
+
+
+def ingest_audio(file_paths, output_file, bitrate='24k', sample_rate=SAMPLE_RATE, overwrite=False, n_jobs=1, progress=None):
+    """Combine the audio files into one mono file at the target bitrate.
+
+    The files are decoded once, concatenated in the given order, downmixed to mono,
+    resampled to 16 kHz (what Whisper uses) and encoded once, so there are no double
+    transcodes. A single file, or n_jobs=1, is done in one ffmpeg filter graph. With
+    multiple files and n_jobs > 1, the files are encoded in parallel ffmpeg processes and
+    the encoded parts are joined without re-encoding. Files that are already conformant,
+    see :func:`plan_transcode`, are copied or remuxed instead of encoded.
+
+    Parameters
+    ----------
+    file_paths : str or list
+        Audio file or files in the order of the recording.
+    output_file : str
+        Path of the combined audio file, e.g. ``.m4a``.
+    bitrate : str, optional
+        Bitrate of the output, e.g. '24k'.
+    sample_rate : int, optional
+        Sample rate of the output.
+    overwrite : bool, optional
+        Encode again even when the output is newer than all inputs.
+    n_jobs : int, optional
+        Number of files that are encoded at the same time.
+    progress : callable, optional
+        Called with (n_done, n_files, file_path) after every file that is encoded in parallel.
+
+    Returns
+    -------
+    str
+        Path of the combined audio file.
+    """
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    if not file_paths:
+        return None
+    if not overwrite and pcm_up_to_date(file_paths, output_file):
+        return output_file
+
+    # Conformant files are not encoded again
+    plans = [plan_transcode(probe_audio(file_path), bitrate=bitrate, sample_rate=sample_rate) for file_path in file_paths]
+    logger.info(f'Ingesting {len(file_paths)} file(s) into {output_file} at {bitrate}: {", ".join(plans)}..')
+    # Write next to the output and move it in place, so a failed run never leaves a partial file
+    root, ext = os.path.splitext(output_file)
+    tmp_path = root + '.tmp' + ext
+    if 'transcode' not in plans:
+        _join_copy(file_paths, plans, tmp_path)
+    elif len(file_paths) == 1 or (n_jobs <= 1 and set(plans) == {'transcode'}):
+        subprocess.run(ingest_command(file_paths, tmp_path, bitrate=bitrate, sample_rate=sample_rate), stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    else:
+        # Per file, so that the conformant files are not encoded
+        _ingest_parallel(file_paths, plans, tmp_path, bitrate=bitrate, sample_rate=sample_rate, n_jobs=max(1, n_jobs), progress=progress)
+    os.replace(tmp_path, output_file)
+    return output_file
+
+
+def _remux_command(file_path, output_file):
+    """Copy the audio stream into a new container without encoding."""
+    return ['ffmpeg', '-nostdin', '-i', file_path, '-map', '0:a:0', '-c', 'copy', '-movflags', '+faststart', '-y', output_file]
+
+
+def _join_copy(file_paths, plans, output_file):
+    """Join conformant files without encoding: copy, remux or concat with stream copy."""
+    if len(file_paths) == 1 and plans[0] == 'copy':
+        shutil.copyfile(file_paths[0], output_file)
+    elif len(file_paths) == 1:
+        subprocess.run(_remux_command(file_paths[0], output_file), stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    else:
+        root, _ = os.path.splitext(output_file)
+        concat_path = root + '.txt'
+        command = ['ffmpeg', '-nostdin'] + _ffmpeg_inputs(file_paths, concat_path) + ['-map', '0:a:0', '-c', 'copy', '-movflags', '+faststart', '-y', output_file]
+        try:
+            subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        finally:
+            if os.path.isfile(concat_path):
+                os.remove(concat_path)
+
+
+def _ingest_parallel(file_paths, plans, output_file, bitrate, sample_rate, n_jobs, progress=None):
+    """Encode the files in parallel and join the parts in order with the concat demuxer (no re-encoding)."""
+    root, ext = os.path.splitext(output_file)
+    part_paths = [f'{root}.part{i}{ext}' for i in range(len(file_paths))]
+
+    def _encode(i):
+        if plans[i] == 'transcode':
+            command = ingest_command([file_paths[i]], part_paths[i], bitrate=bitrate, sample_rate=sample_rate)
+        else:
+            command = _remux_command(file_paths[i], part_paths[i])
+        subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return i
+
+    try:
+        # ffmpeg does the work in its own process, so threads are enough to use all cores
+        with ThreadPoolExecutor(max_workers=min(n_jobs, len(file_paths))) as executor:
+            futures = [executor.submit(_encode, i) for i in range(len(file_paths))]
+            for n_done, future in enumerate(as_completed(futures), start=1):
+                i = future.result()
+                if progress is not None:
+                    progress(n_done, len(file_paths), file_paths[i])
+
+        # The parts are in the order of the files, regardless of the order in which they finished
+        _join_copy(part_paths, ['copy'] * len(part_paths), output_file)
+    finally:
+        for filepath in part_paths:
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+
+
+#%% Probing
+# Number of probes that are kept in memory
+MAX_PROBES = 1024
+# Persistent cache of the probes in the temp directory of the app, see set_probe_cache_dir
+_PROBE_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'notabena', '.cache', 'probes')
+# (path, size, mtime) -> probe of the files that are probed in this process, least recently used first
+_PROBES = OrderedDict()
+_PROBES_LOCK = threading.Lock()
+
+
+def set_probe_cache_dir(temp_dir):
+    """Keep the probes in the cache of the temp directory of the app."""
+    global _PROBE_CACHE_DIR
+    _PROBE_CACHE_DIR = os.path.join(temp_dir, '.cache', 'probes')
+
+
+def _probe_cache():
+    try:
+        return DiskCache(_PROBE_CACHE_DIR, max_size_mb=16)
+    except OSError:
+        return None
+
+
+def probe_audio(file_path, cache=True):
+    """Codec, sample rate, channels, bitrate, duration and container of the first audio stream.
+
+    The file is probed with a single ffprobe call. Probes are cached in memory and on disk,
+    keyed by the path, size and modification time of the file, so every file is probed once.
+
+    Returns
+    -------
+    dict
+        'codec', 'sample_rate', 'channels', 'bitrate' (bits/s), 'duration' (seconds) and
+        'format'. Values that can not be determined are None. None when the file can not be probed.
+    """
+    try:
+        stat = os.stat(file_path)
+    except (OSError, TypeError):
+        return None
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if cache:
+        with _PROBES_LOCK:
+            if key in _PROBES:
+                _PROBES.move_to_end(key)
+                return _PROBES[key]
+
+    disk_cache = _probe_cache() if cache else None
+    disk_key = make_key(*key) if disk_cache is not None else None
+    probe = disk_cache.get(disk_key) if disk_cache is not None else None
+    if probe is None:
+        command = ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+                   '-show_entries', 'stream=codec_name,sample_rate,channels,bit_rate:format=duration,bit_rate,format_name',
+                   '-of', 'json', file_path]
+        try:
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            info = json.loads(result.stdout)
+        except Exception as e:
+            logger.warning(f'Could not probe {file_path}: {e}')
+            return None
+        stream = (info.get('streams') or [{}])[0]
+        fmt = info.get('format') or {}
+        probe = {
+            'codec': stream.get('codec_name'),
+            'sample_rate': _to_number(stream.get('sample_rate'), int),
+            'channels': _to_number(stream.get('channels'), int),
+            # The container bitrate is used when the stream has none (e.g. some wav and webm files)
+            'bitrate': _to_number(stream.get('bit_rate'), int) or _to_number(fmt.get('bit_rate'), int),
+            'duration': _to_number(fmt.get('duration'), float),
+            'format': fmt.get('format_name'),
+        }
+        if disk_cache is not None:
+            disk_cache.set(disk_key, probe)
+    with _PROBES_LOCK:
+        _PROBES[key] = probe
+        while len(_PROBES) > MAX_PROBES:
+            _PROBES.popitem(last=False)
+    return probe
+
+
+def _to_number(value, dtype):
+    try:
+        return dtype(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def probe_duration(file_path):
+    """Duration of the audio file in seconds, or None if it can not be determined."""
+    probe = probe_audio(file_path)
+    return probe['duration'] if probe else None
+
+
+def bitrate_to_bps(bitrate):
+    """Convert a bitrate like '24k' to bits per second."""
+    if isinstance(bitrate, str) and bitrate.lower().endswith('k'):
+        return int(float(bitrate[:-1]) * 1000)
+    return int(bitrate)
+
+
+def plan_transcode(probe, bitrate='24k', sample_rate=SAMPLE_RATE, codec='aac', tolerance=0.1):
+    """Decide how a file is brought to the target format.
+
+    Returns
+    -------
+    str
+        'copy' when the file is already conformant (AAC, mono, 16 kHz, at most the target
+        bitrate, in an mp4/m4a container), 'remux' when only the container differs, and
+        'transcode' otherwise.
+    """
+    if not probe:
+        return 'transcode'
+    conformant = (probe['codec'] == codec
+                  and probe['channels'] == 1
+                  and probe['sample_rate'] == sample_rate
+                  and probe['bitrate'] is not None
+                  and probe['bitrate'] <= bitrate_to_bps(bitrate) * (1 + tolerance))
+    if not conformant:
+        return 'transcode'
+    if probe['format'] and 'mp4' in probe['format'].split(','):
+        return 'copy'
+    return 'remux'
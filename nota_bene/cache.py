@@ -0,0 +1,296 @@
+"""
+Content-addressed on-disk cache.
+
+Entries are json files named by the hash of their key parts. The least recently used
+entries are removed when the cache exceeds its size budget.
+"""
+
+import os
+import json
+import time
+import atexit
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Default size budgets of the shared caches in the temp directory, the same for the app and the batch mode
+TRANSCRIPT_CACHE_SIZE_MB = 2048
+LLM_CACHE_SIZE_MB = 256
+# Seconds between the writes of the hit and miss counts
+FLUSH_SECONDS = 10
+# Part of the budget that is used after an eviction
+EVICT_TARGET = 0.9
+
+
+#%%
+def make_key(*parts):
+    """Create a sha256 key from str, bytes, numbers, dicts or arrays."""
+    hasher = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            hasher.update(part)
+        elif hasattr(part, 'tobytes'):
+            # numpy arrays
+            hasher.update(part.tobytes())
+        elif isinstance(part, dict):
+            hasher.update(json.dumps(part, sort_keys=True, default=str).encode('utf-8'))
+        else:
+            hasher.update(str(part).encode('utf-8'))
+        # Separator so that ('ab', 'c') and ('a', 'bc') do not collide
+        hasher.update(b'\x00')
+    return hasher.hexdigest()
+
+
+def _json_default(obj):
+    # numpy scalars and arrays
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+
+#%%
+class DiskCache:
+    """Size-bounded LRU cache of json values on disk.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache. Created when it does not exist.
+    max_size_mb : float, optional
+        Maximum size of the cache in MB. The least recently used entries are removed when exceeded.
+    """
+    def __init__(self, cache_dir, max_size_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Shared by the caches of the same directory in this process
+        self._state = _dir_state(cache_dir)
+
+    @property
+    def stats_path(self):
+        return os.path.join(self.cache_dir, 'stats.json')
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        """Return the cached value or None when the key is not in the cache."""
+        filepath = self._path(key)
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._count('misses')
+            return None
+
+        # Touch the file so that it is the most recently used
+        try:
+            os.utime(filepath)
+        except OSError:
+            pass
+        self._count('hits')
+        return value
+
+    def set(self, key, value):
+        """Store the value under the key and evict old entries when the cache is too large."""
+        filepath = self._path(key)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        old_size = _file_size(filepath)
+        atomic_write_json(filepath, value)
+        with self._state['lock']:
+            if self._state['size'] is None:
+                # Once per directory and process. Other processes may add entries too, evict() recounts.
+                self._state['size'] = self.size()
+            else:
+                self._state['size'] += _file_size(filepath) - old_size
+            over = self._state['size'] > self.max_size_mb * 1024**2
+        if over:
+            self.evict()
+
+    def delete(self, key):
+        filepath = self._path(key)
+        size = _file_size(filepath)
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            return
+        with self._state['lock']:
+            if self._state['size'] is not None:
+                self._state['size'] -= size
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    def entries(self):
+        """Return (filepath, size, mtime) of all entries, least recently used first."""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for filename in files:
+                if filename.endswith('.json') and root != self.cache_dir:
+                    filepath = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(filepath)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((filepath, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda x: x[2])
+
+    def size(self):
+        """Total size of the entries in bytes."""
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self, target=EVICT_TARGET):
+        """Remove the least recently used entries until the cache is below target times the budget."""
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        max_bytes = self.max_size_mb * 1024**2
+        n_evicted = 0
+        if total > max_bytes:
+            for filepath, size, _ in entries:
+                if total <= target * max_bytes:
+                    break
+                try:
+                    os.remove(filepath)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                n_evicted += 1
+        with self._state['lock']:
+            self._state['size'] = total
+        if n_evicted > 0:
+            logger.info(f'Evicted {n_evicted} entries from {self.cache_dir}')
+            self._count('evictions', n_evicted)
+        return n_evicted
+
+    def clear(self):
+        """Remove all entries and reset the stats."""
+        for filepath, _, _ in self.entries():
+            os.remove(filepath)
+        with self._state['lock']:
+            self._state['size'] = 0
+            self._state['pending'] = dict.fromkeys(self._state['pending'], 0)
+        if os.path.isfile(self.stats_path):
+            os.remove(self.stats_path)
+
+    def stats(self):
+        """Return the hits, misses, evictions, number of entries and size in MB."""
+        self.flush()
+        stats = self._load_stats()
+        entries = self.entries()
+        stats['entries'] = len(entries)
+        stats['size_mb'] = sum(entry[1] for entry in entries) / 1024**2
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else 0.0
+        return stats
+
+    def flush(self):
+        """Add the counts of this process to ``stats.json``."""
+        with self._state['lock']:
+            pending = self._state['pending']
+            self._state['pending'] = dict.fromkeys(pending, 0)
+            self._state['flushed'] = time.time()
+        if not any(pending.values()):
+            return
+        try:
+            with _file_lock(self.stats_path + '.lock'):
+                stats = self._load_stats()
+                for name, n in pending.items():
+                    stats[name] += n
+                atomic_write_json(self.stats_path, stats)
+        except OSError as e:
+            logger.warning(f'Could not update cache stats: {e}')
+
+    def close(self):
+        self.flush()
+
+    def _load_stats(self):
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        try:
+            with open(self.stats_path, 'r', encoding='utf-8') as f:
+                stats.update(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        return stats
+
+    def _count(self, name, n=1):
+        with self._state['lock']:
+            self._state['pending'][name] += n
+            due = time.time() - self._state['flushed'] >= FLUSH_SECONDS
+        if due:
+            self.flush()
+
+
+#%%
+def atomic_write_json(filepath, value):
+    """Write json to a temporary file and move it in place so readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False, default=_json_default)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _file_size(filepath):
+    try:
+        return os.path.getsize(filepath)
+    except OSError:
+        return 0
+
+
+@contextmanager
+def _file_lock(lock_path, timeout=5.0, stale=30.0):
+    """Lock file that is shared between processes."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            # The lock of a process that crashed
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            if time.time() > deadline:
+                raise OSError(f'Timeout while waiting for {lock_path}')
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+#%% Size and pending counts per cache directory
+_DIRS = {}
+_DIRS_LOCK = threading.Lock()
+
+
+def _dir_state(cache_dir):
+    with _DIRS_LOCK:
+        return _DIRS.setdefault(os.path.abspath(cache_dir), {
+            'size': None,
+            'pending': {'hits': 0, 'misses': 0, 'evictions': 0},
+            'flushed': time.time(),
+            'lock': threading.Lock(),
+        })
+
+
+@atexit.register
+def _flush_all():
+    for cache_dir in list(_DIRS):
+        if os.path.isdir(cache_dir):
+            DiskCache(cache_dir).flush()
@@ -0,0 +1,255 @@
+"""
+Headless batch mode.
+
+Transcribe and summarise directories of recordings without the browser. Every project
+is processed with the same pipeline as the app (combine, chunk, transcribe,
+minute notes) and is written to the same project layout under the temp directory, so
+that the results can be opened in the app afterwards.
+
+Examples
+--------
+> notabene batch /data/meetings/2025-*/ --model small --jobs 4
+> notabene batch "/data/recordings/*.m4a" --llm-model mistral --endpoint http://localhost:11434/api/generate
+"""
+
+import os
+import sys
+import glob
+import time
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from nota_bene.cache import TRANSCRIPT_CACHE_SIZE_MB, LLM_CACHE_SIZE_MB
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.m4a')
+
+
+#%%
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='notabene', description='Nota Bene: AI assisted minute notes.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('app', help='Run the streamlit app (default).')
+
+    batch = subparsers.add_parser('batch', help='Transcribe and summarise directories of recordings without the app.')
+    batch.add_argument('inputs', nargs='+', help='Directories or glob patterns. A directory with audio files is one project, a matched audio file is a project on its own.')
+    batch.add_argument('--temp-dir', default=os.path.join(tempfile.gettempdir(), 'notabena'), help='Directory with the projects, the same as the temp directory of the app.')
+    batch.add_argument('--jobs', type=int, default=1, help='Number of projects that are processed in parallel.')
+    batch.add_argument('--model', default='turbo', help='Whisper model: tiny, base, small, medium, large, turbo or OpenAI.')
+    batch.add_argument('--transcribe-workers', type=int, default=1, help='Worker processes per project for the local Whisper models.')
+    batch.add_argument('--bitrate', default='24k', help='Bitrate of the combined audio file.')
+    batch.add_argument('--ingest-workers', type=int, default=1, help='Audio files per project that are compressed in parallel.')
+    batch.add_argument('--segment-time', type=int, default=300, help='Length of the audio chunks in seconds.')
+    batch.add_argument('--no-vad', action='store_true', help='Cut the audio every segment-time seconds instead of in silences.')
+    batch.add_argument('--llm-model', default=None, help='LLM for the minute notes. No minute notes are created when not set.')
+    batch.add_argument('--endpoint', default='http://localhost:1234/v1/chat/completions', help='API endpoint of the local LLM.')
+    batch.add_argument('--instruction', default='minute_notes', help='Name of the prompt in the user_prompts directory.')
+    batch.add_argument('--preprocessing', default='auto', choices=['auto', 'unlimited', 'global-reasoning', 'chunk-wise'], help='Approach of the local LLM. auto sends the transcript in one prompt when it fits in the context window, otherwise chunk-wise.')
+    batch.add_argument('--n-ctx', type=int, default=16384, help='Context window of the local LLM in tokens.')
+    batch.add_argument('--llm-concurrency', type=int, default=4, help='Chunk prompts that are sent to the local LLM at the same time (chunk-wise only).')
+    batch.add_argument('--openai-api-key', default=os.environ.get('OPENAI_API_KEY'), help='OpenAI API key. Defaults to the OPENAI_API_KEY environment variable.')
+    batch.add_argument('--transcript-cache-mb', type=int, default=TRANSCRIPT_CACHE_SIZE_MB, help='Size of the transcript cache in the temp directory, shared with the app.')
+    batch.add_argument('--llm-cache-mb', type=int, default=LLM_CACHE_SIZE_MB, help='Size of the LLM response cache in the temp directory, shared with the app.')
+    batch.add_argument('--overwrite', action='store_true', help='Run all stages again, also the stages that are up to date.')
+    return parser.parse_args(argv)
+
+
+#%%
+def _audio_files(dirname):
+    return sorted(os.path.join(dirname, name) for name in os.listdir(dirname) if name.lower().endswith(AUDIO_EXTENSIONS))
+
+
+def find_projects(inputs):
+    """Return {project_name: [audio files]} for the directories and glob patterns.
+
+    A directory with audio files is one project with the files in alphabetical order. A
+    directory without audio files is searched one level deeper. A matched audio file is a
+    project on its own.
+    """
+    projects = {}
+    for pattern in inputs:
+        for path in sorted(glob.glob(os.path.expanduser(pattern))):
+            path = os.path.abspath(path)
+            if os.path.isfile(path) and path.lower().endswith(AUDIO_EXTENSIONS):
+                projects[os.path.splitext(os.path.basename(path))[0]] = [path]
+            elif os.path.isdir(path):
+                files = _audio_files(path)
+                if files:
+                    projects[os.path.basename(path.rstrip(os.sep))] = files
+                    continue
+                for name in sorted(os.listdir(path)):
+                    subdir = os.path.join(path, name)
+                    if os.path.isdir(subdir) and _audio_files(subdir):
+                        projects[name] = _audio_files(subdir)
+    return projects
+
+
+#%%
+def process_project(project_name, audio_files, args):
+    """Run the pipeline for one project and write the results in the project directory."""
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    from nota_bene.utils import combine_audio_files, audio_handle, save_project_state, load_project_state, load_user_prompts, generate_minute_notes, generate_minute_notes_openai
+    from nota_bene.jobs import transcript_params, DEFAULT_PARAMS
+    from nota_bene.cache import DiskCache
+    from nota_bene.pipeline import Pipeline, fingerprint, FRESH
+    from nota_bene.audio import set_probe_cache_dir
+
+    set_probe_cache_dir(args.temp_dir)
+    project_path = os.path.join(args.temp_dir, project_name)
+    save_path = os.path.join(project_path, 'session.db')
+    os.makedirs(project_path, exist_ok=True)
+    pipeline = Pipeline(project_path)
+
+    # Concatenate, downmix, resample and compress the recordings. The combined file is reused when the recordings did not change.
+    audio_filepath = combine_audio_files(audio_files, project_path, args.bitrate, '.m4a', n_jobs=args.ingest_workers)
+    states = {
+        'project_name': project_name,
+        'project_path': project_path,
+        'save_path': save_path,
+        'audio_filepath': audio_filepath,
+        'audio_names': [os.path.basename(audio_file) for audio_file in audio_files],
+        'bitrate': args.bitrate,
+        'model_type': args.model,
+    }
+    # File-backed audio handle, the same as in the app
+    states['audio'] = audio_handle(audio_filepath)
+    steps = []
+
+    # Only the stages that are stale run again, unless --overwrite
+    params = {**DEFAULT_PARAMS, 'model_type': args.model, 'n_workers': args.transcribe_workers, 'segment_time': args.segment_time, 'vad': not args.no_vad, 'cache_size_mb': args.transcript_cache_mb}
+    previous = {} if args.overwrite else load_project_state(save_path, keys=['context', 'segments', 'timings'])
+    if previous.get('context') and pipeline.state('transcript', params=transcript_params(params)) == FRESH:
+        states.update(previous)
+        context = previous['context']
+    else:
+        context = _transcribe(audio_filepath, project_path, params, args, states)
+        pipeline.record('transcript', params=transcript_params(params), output=fingerprint(context))
+        steps.append(f"{len(states['timings'])} chunks, {len(context.split())} words")
+
+    # Minute notes
+    if args.llm_model:
+        prompt = load_user_prompts()[args.instruction]
+        instruction = prompt['system'] + '\n' + prompt['instructions'] + '\n\n' + prompt['query']
+        if args.llm_model == 'gpt-4o-mini':
+            notes_params = {'model': args.llm_model, 'instruction': fingerprint(instruction), 'preprocessing': None, 'chunk_size': None}
+        else:
+            preprocessing, chunk_size = _llm_strategy(context, prompt, args)
+            notes_params = {'model': args.llm_model, 'instruction': fingerprint(prompt), 'preprocessing': preprocessing, 'chunk_size': chunk_size}
+
+        if args.overwrite or pipeline.state('minute_notes', params=notes_params) != FRESH:
+            start_time = time.time()
+            # Responses of earlier runs are reused, unless --overwrite
+            llm_cache = DiskCache(os.path.join(args.temp_dir, '.cache', 'llm'), max_size_mb=args.llm_cache_mb)
+            if args.llm_model == 'gpt-4o-mini':
+                from nota_bene.http_pool import get_http_pool
+                minute_notes = generate_minute_notes_openai(context, instruction, args.llm_model, get_http_pool().openai_client(args.openai_api_key), cache=llm_cache, read_cache=not args.overwrite)
+            else:
+                minute_notes = generate_minute_notes(context, prompt, model=args.llm_model, endpoint=args.endpoint, preprocessing=preprocessing, chunk_size=chunk_size, n_ctx=args.n_ctx, max_concurrency=args.llm_concurrency, cache=llm_cache, read_cache=not args.overwrite, verbose='warning')
+            states.update({'minute_notes': minute_notes,
+                           'model': args.llm_model,
+                           'endpoint': args.endpoint,
+                           'instruction_name': args.instruction,
+                           'instruction': instruction,
+                           'timings_llm': [(time.time() - start_time) / 60],
+                           })
+            pipeline.record('minute_notes', params=notes_params, output=fingerprint(minute_notes))
+            steps.append('minute notes created')
+
+    save_project_state(save_path, states, wait=True)
+    if not steps:
+        return project_name, 'skipped (up to date, use --overwrite)'
+    return project_name, 'done: ' + ', '.join(steps)
+
+
+def _llm_strategy(context, prompt, args):
+    """Preprocessing and chunk size of the local LLM. The chunks fit in the context window."""
+    from nota_bene.tokens import plan_llm_strategy, describe_plan
+    plan = plan_llm_strategy(context, prompt, n_ctx=args.n_ctx)
+    if args.preprocessing == 'auto':
+        logger.info(describe_plan(plan, args.n_ctx))
+        return plan['preprocessing'], plan['chunk_size']
+    if args.preprocessing == 'unlimited':
+        if plan['preprocessing'] is not None:
+            logger.warning(f"The transcript ({plan['context_tokens']} tokens) does not fit in the context window ({args.n_ctx} tokens). Use --preprocessing auto or chunk-wise.")
+        return None, None
+    return args.preprocessing, plan['chunk_size'] or int(plan['available_tokens'] * plan['chars_per_token'])
+
+
+def _transcribe(audio_filepath, project_path, params, args, states):
+    """Transcribe the chunks while the combined recording is being decoded. Adds the results to states and returns the transcript."""
+    from nota_bene.utils import get_pcm_path
+    from nota_bene.audio import stream_pcm_slices
+    from nota_bene.cache import DiskCache
+    from nota_bene.jobs import transcription_results
+
+    cache = DiskCache(os.path.join(args.temp_dir, '.cache', 'transcripts'), max_size_mb=args.transcript_cache_mb)
+    chunk_stream = enumerate(stream_pcm_slices(audio_filepath, get_pcm_path(project_path, audio_filepath), segment_time=params['segment_time'], vad=params['vad']))
+    audio_chunks = {}
+
+    def _track(chunk_stream):
+        for i, chunk in chunk_stream:
+            audio_chunks[i] = chunk
+            yield i, chunk
+
+    if args.model.lower() != 'openai' and args.transcribe_workers <= 1:
+        # Divide the cores over the projects that run in parallel
+        import torch
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // max(1, args.jobs)))
+
+    results = transcription_results(_track(chunk_stream), params, cache=cache, api_key=args.openai_api_key)
+
+    transcripts, segments, timings = {}, {}, {}
+    for i, transcript, duration in results:
+        transcripts[i] = transcript.get('text', '')
+        timings[i] = duration
+        segments[i] = [{'start': audio_chunks[i].to_timeline(seg['start']), 'end': audio_chunks[i].to_timeline(seg['end']), 'text': seg['text']} for seg in transcript.get('segments', [])]
+    order = sorted(transcripts.keys())
+    context = ' '.join([transcripts[i] for i in order])
+    states.update({
+        'context': context,
+        'segments': [seg for i in order for seg in segments[i]],
+        'timings': [timings[i] for i in order],
+        'timings_llm': [],
+    })
+    return context
+
+
+def batch(args):
+    """Process all projects, with args.jobs projects in parallel."""
+    projects = find_projects(args.inputs)
+    if not projects:
+        print('No audio files found.')
+        return 1
+
+    print(f'Processing {len(projects)} project(s) in {args.temp_dir} with {args.jobs} job(s)..')
+    n_failed = 0
+    mp_context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs), mp_context=mp_context) as executor:
+        futures = {executor.submit(process_project, name, files, args): name for name, files in projects.items()}
+        for future in as_completed(futures):
+            try:
+                project_name, status = future.result()
+                print(f'[{project_name}] {status}')
+            except Exception as e:
+                n_failed += 1
+                print(f'[{futures[future]}] failed: {e}')
+    return 1 if n_failed > 0 else 0
+
+
+def main(argv=None):
+    """Entry point of the command line interface."""
+    args = parse_args(argv)
+    # Streamlit warns for every call outside of the app
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    if args.command == 'batch':
+        return batch(args)
+    from nota_bene.app import run_app
+    return run_app()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
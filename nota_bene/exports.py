@@ -0,0 +1,98 @@
+"""
+Cached exports of the minute notes.
+
+The exports are rendered once per version of the notes in a background thread and kept in
+memory by the hash of the notes.
+"""
+
+import logging
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from nota_bene.cache import make_key
+
+logger = logging.getLogger(__name__)
+
+# Number of exports that are kept in memory
+MAX_EXPORTS = 16
+
+
+#%%
+def render_pdf(markdown):
+    """Render markdown to the bytes of a PDF file."""
+    from markdown_pdf import MarkdownPdf, Section
+    pdf = MarkdownPdf(toc_level=1)
+    pdf.add_section(Section(markdown))
+    f = BytesIO()
+    pdf.save(f)
+    return f.getvalue()
+
+
+# Kind of export -> function that renders the markdown of the notes to bytes.
+# The markdown itself is downloaded as it is, it needs no rendering.
+RENDERERS = {
+    'pdf': render_pdf,
+}
+
+
+#%%
+class ExportCache:
+    """Exports of the minute notes, rendered in the background and cached by the hash of the notes.
+
+    Parameters
+    ----------
+    max_exports : int, optional
+        Number of rendered exports that are kept in memory. The least recently used are removed.
+    """
+    def __init__(self, max_exports=MAX_EXPORTS):
+        self.max_exports = max_exports
+        # (kind, hash of the notes) -> Future with the bytes of the export
+        self._exports = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='export')
+
+    def prepare(self, kind, notes, retry=False):
+        """Start rendering the export in the background, unless it is rendered or being rendered. Returns the future.
+
+        A render that failed is only started again with retry=True.
+        """
+        key = (kind, make_key(notes))
+        with self._lock:
+            future = self._exports.get(key)
+            if future is not None and not (retry and future.done() and future.exception() is not None):
+                self._exports.move_to_end(key)
+                return future
+            # New, or the last render failed
+            logger.info(f'Rendering the {kind} export of the minute notes..')
+            future = self._executor.submit(RENDERERS[kind], notes)
+            self._exports[key] = future
+            while len(self._exports) > self.max_exports:
+                self._exports.popitem(last=False)
+            return future
+
+    def get(self, kind, notes):
+        """Return the bytes of the export when it is rendered, otherwise None. Does not wait."""
+        with self._lock:
+            future = self._exports.get((kind, make_key(notes)))
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return future.result()
+
+    def result(self, kind, notes, timeout=None):
+        """Return the bytes of the export, and wait for the render when needed. Raises the error of the render."""
+        return self.prepare(kind, notes, retry=True).result(timeout=timeout)
+
+    def clear(self):
+        with self._lock:
+            self._exports.clear()
+
+
+#%%
+_EXPORTS = ExportCache()
+
+
+def get_export_cache():
+    """Return the process-wide export cache."""
+    return _EXPORTS
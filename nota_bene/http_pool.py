@@ -0,0 +1,118 @@
+"""
+Shared keep-alive HTTP connections to the LLM and transcription endpoints.
+
+Every endpoint gets one ``requests`` session and every OpenAI API key one client, each
+with a bounded pool of persistent connections.
+"""
+
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONNECTIONS = 8
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 600
+
+
+#%%
+class HttpPool:
+    """Per-endpoint HTTP sessions and per-key OpenAI clients with keep-alive connections.
+
+    Parameters
+    ----------
+    max_connections : int, optional
+        Maximum number of open connections per endpoint. Requests wait for a free connection when exceeded.
+    connect_timeout : float, optional
+        Seconds to wait for a connection.
+    read_timeout : float, optional
+        Seconds to wait for (the next part of) a response.
+    """
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # origin -> requests.Session
+        self._sessions = {}
+        # (api_key, base_url) -> OpenAI client
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        """(connect, read) timeout of the requests."""
+        return (self.connect_timeout, self.read_timeout)
+
+    def configure(self, max_connections=None, connect_timeout=None, read_timeout=None):
+        """Change the limits. New sessions and clients get the new limits.
+
+        The old sessions and clients are not closed: requests that are running, such as a
+        transcription job or a streamed response, finish on their connections.
+        """
+        changed = False
+        for name, value in (('max_connections', max_connections), ('connect_timeout', connect_timeout), ('read_timeout', read_timeout)):
+            if value is not None and getattr(self, name) != value:
+                setattr(self, name, value)
+                changed = True
+        if changed:
+            logger.info(f'HTTP pool: {self.max_connections} connections per endpoint, timeout {self.timeout}.')
+            with self._lock:
+                self._sessions, self._clients = {}, {}
+
+    def session(self, url):
+        """Return the shared session of the endpoint of the url."""
+        parts = urlsplit(url)
+        origin = f'{parts.scheme}://{parts.netloc}'
+        with self._lock:
+            session = self._sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                # No retries here: a retried prompt would run the model twice
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections, pool_block=True, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[origin] = session
+            return session
+
+    def openai_client(self, api_key, base_url=None):
+        """Return the shared OpenAI client of the API key.
+
+        Retries are handled by :func:`call_with_retry`, so the built-in retries of the client are disabled.
+        Set OPENAI_BASE_URL, or base_url, to use a local OpenAI-compatible server.
+        """
+        with self._lock:
+            client = self._clients.get((api_key, base_url))
+            if client is None:
+                import httpx
+                from openai import OpenAI
+                timeout = httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+                limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+                client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=timeout, http_client=httpx.Client(limits=limits, timeout=timeout))
+                self._clients[(api_key, base_url)] = client
+            return client
+
+    def close(self):
+        """Close all open connections. New sessions and clients are created when needed."""
+        with self._lock:
+            sessions, clients = list(self._sessions.values()), list(self._clients.values())
+            self._sessions, self._clients = {}, {}
+        for session in sessions:
+            session.close()
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+
+#%%
+_POOL = HttpPool()
+
+
+def get_http_pool():
+    """Return the process-wide HTTP pool."""
+    return _POOL
@@ -0,0 +1,338 @@
+"""
+Background transcription jobs.
+
+A job runs in a background thread of the server process and writes its progress to
+``jobs.json`` in the project directory after every chunk. The chunk boundaries are stored
+as well, so an interrupted job is resumed at the first chunk that did not finish.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime
+from collections import defaultdict
+
+from nota_bene.cache import DiskCache, atomic_write_json, TRANSCRIPT_CACHE_SIZE_MB
+from nota_bene.audio import stream_pcm_slices, probe_duration, pcm_seconds, SAMPLE_RATE
+from nota_bene.model_pool import get_model_pool
+from nota_bene.pipeline import Pipeline, fingerprint
+from nota_bene.http_pool import get_http_pool
+from nota_bene.transcription import transcribe_whisper, transcribe_openai_concurrent
+
+logger = logging.getLogger(__name__)
+
+# Status of a job
+QUEUED, RUNNING, DONE, FAILED, CANCELLED, INTERRUPTED = 'queued', 'running', 'done', 'failed', 'cancelled', 'interrupted'
+ACTIVE = (QUEUED, RUNNING)
+
+# Default parameters of a transcription job
+DEFAULT_PARAMS = {
+    'audio_filepath': None,
+    'pcm_path': None,
+    'segment_time': 300,
+    'vad': True,
+    'model_type': 'turbo',
+    'device': 'cpu',
+    'n_workers': 1,
+    'torch_threads': None,
+    'read_cache': True,
+    'cache_dir': None,
+    'cache_size_mb': TRANSCRIPT_CACHE_SIZE_MB,
+    'whisper_memory_budget': None,
+    'openai_concurrency': 4,
+    'openai_rpm': 50,
+    'openai_max_retries': 5,
+}
+# Parameters that change the transcript. The others only change how fast it is made.
+TRANSCRIPT_PARAMS = ('model_type', 'vad', 'segment_time')
+
+
+#%%
+def transcription_results(chunk_stream, params, cache=None, api_key=None):
+    """Transcribe the (index, PCMSlice) chunks with the local Whisper model or OpenAI.
+
+    Parameters
+    ----------
+    chunk_stream : iterable
+        (index, audio) tuples. Can be a generator that is still producing chunks.
+    params : dict
+        Job parameters, see ``DEFAULT_PARAMS``.
+    cache : DiskCache, optional
+        Transcript cache.
+    api_key : str, optional
+        OpenAI API key, only used for the model type "OpenAI".
+
+    Yields
+    ------
+    tuple
+        (index, transcript, duration) in order of completion.
+    """
+    from nota_bene.workers import transcribe_chunks_parallel
+    model_type = params['model_type']
+    read_cache = params['read_cache']
+
+    if model_type.lower() == 'openai':
+        # Shared client with keep-alive connections. Retries are handled by call_with_retry.
+        client = get_http_pool().openai_client(api_key)
+        yield from transcribe_openai_concurrent(chunk_stream, client, cache=cache, read_cache=read_cache,
+                                                max_concurrency=params['openai_concurrency'],
+                                                requests_per_minute=params['openai_rpm'],
+                                                max_retries=params['openai_max_retries'])
+    elif params['n_workers'] > 1:
+        yield from transcribe_chunks_parallel(chunk_stream, model_type, n_workers=params['n_workers'], torch_threads=params['torch_threads'], device=params['device'], cache=cache, read_cache=read_cache)
+    else:
+        # Make sure the pool respects the memory budget of the user
+        get_model_pool(params['whisper_memory_budget'])
+        for index, audio in chunk_stream:
+            transcript = transcribe_whisper(audio, model_type, device=params['device'], cache=cache, read_cache=read_cache)
+            yield index, transcript, transcript['duration']
+
+
+def transcript_params(params):
+    """The parameters of the transcript stage of the pipeline, see :class:`Pipeline`."""
+    params = {**DEFAULT_PARAMS, **params}
+    return {key: params[key] for key in TRANSCRIPT_PARAMS}
+
+
+def job_result(job):
+    """Return the transcript, the timestamped segments and the timings of the finished chunks in order."""
+    order = sorted(job['chunks'], key=int)
+    chunks = [job['chunks'][i] for i in order]
+    return {
+        'context': ' '.join(chunk['text'] for chunk in chunks),
+        'segments': [seg for chunk in chunks for seg in chunk['segments']],
+        'timings': [chunk['duration'] for chunk in chunks],
+    }
+
+
+# One lock per job table, shared by all JobTable objects of the same project
+_TABLE_LOCKS = defaultdict(threading.Lock)
+
+
+#%%
+class JobTable:
+    """Persistent table of the transcription jobs of one project.
+
+    The table is a json file that is replaced atomically on every update, so a crash never
+    leaves a partial table behind.
+
+    Parameters
+    ----------
+    project_path : str
+        Directory of the project.
+    """
+    filename = 'jobs.json'
+
+    def __init__(self, project_path):
+        self.project_path = project_path
+        self.path = os.path.join(project_path, self.filename)
+        self._lock = _TABLE_LOCKS[os.path.abspath(self.path)]
+
+    def load(self):
+        """Return all jobs as {job_id: job}."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, job_id):
+        return self.load().get(job_id)
+
+    def latest(self):
+        """Return the most recently created job or None."""
+        jobs = self.load()
+        if not jobs:
+            return None
+        return max(jobs.values(), key=lambda job: job['created'])
+
+    def update(self, job_id, **fields):
+        """Update the fields of a job and return the job."""
+        with self._lock:
+            jobs = self.load()
+            job = jobs.setdefault(job_id, {'id': job_id})
+            job.update(fields)
+            job['updated'] = time.time()
+            os.makedirs(self.project_path, exist_ok=True)
+            atomic_write_json(self.path, jobs)
+            return job
+
+    def add_slice(self, job_id, index, pcm_slice):
+        """Store the boundaries of a chunk, so that a resumed job cuts the audio at the same points."""
+        with self._lock:
+            jobs = self.load()
+            slices = jobs[job_id].setdefault('slices', [])
+            del slices[index:]
+            slices.append([pcm_slice.start, pcm_slice.end, [list(region) for region in pcm_slice.regions]])
+            atomic_write_json(self.path, jobs)
+
+    def add_chunk(self, job_id, index, chunk, done_seconds):
+        """Store a finished chunk so that the job can be resumed from here."""
+        with self._lock:
+            jobs = self.load()
+            job = jobs[job_id]
+            job['chunks'][str(index)] = chunk
+            job['done_seconds'] = max(job.get('done_seconds', 0), done_seconds)
+            job['updated'] = time.time()
+            atomic_write_json(self.path, jobs)
+            return job
+
+
+#%%
+class JobRunner:
+    """Run transcription jobs in background threads of the process, one job per project at a time."""
+    def __init__(self):
+        # project_path -> {'job_id', 'thread', 'cancel'}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def table(self, project_path):
+        return JobTable(project_path)
+
+    def is_running(self, project_path, job_id=None):
+        """A thread of this process is working on the (given) job of the project."""
+        entry = self._running.get(project_path)
+        return entry is not None and entry['thread'].is_alive() and (job_id is None or entry['job_id'] == job_id)
+
+    def latest(self, project_path):
+        """Return the latest job of the project. A job that is active without a thread is marked as interrupted."""
+        table = self.table(project_path)
+        # The lock is held while a job is registered and written, so a new job is never seen without its thread
+        with self._lock:
+            job = table.latest()
+            if job is not None and job['status'] in ACTIVE and not self.is_running(project_path, job['id']):
+                # The process that ran the job was restarted or crashed
+                job = table.update(job['id'], status=INTERRUPTED)
+        return job
+
+    def submit(self, project_path, params, api_key=None):
+        """Start a new transcription job and return its id.
+
+        Parameters
+        ----------
+        project_path : str
+            Directory of the project. The job table is stored here.
+        params : dict
+            Job parameters, see ``DEFAULT_PARAMS``. The parameters are stored in the job table,
+            so they must be json serializable.
+        api_key : str, optional
+            OpenAI API key. It is not stored in the job table.
+        """
+        params = {**DEFAULT_PARAMS, **params}
+        job_id = datetime.now().strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+        table = self.table(project_path)
+        with self._lock:
+            self._check_idle(project_path)
+            table.update(job_id, status=QUEUED, created=time.time(), params=params, chunks={}, slices=[], done_seconds=0, total_seconds=None, skipped_seconds=0, error=None)
+            try:
+                self._start(project_path, job_id, api_key)
+            except Exception as e:
+                table.update(job_id, status=FAILED, error=f'{e.__class__.__name__}: {e}')
+                raise
+        return job_id
+
+    def resume(self, project_path, job_id, api_key=None):
+        """Continue an interrupted, cancelled or failed job. Finished chunks are not transcribed again."""
+        table = self.table(project_path)
+        with self._lock:
+            self._check_idle(project_path)
+            status = table.get(job_id)['status']
+            table.update(job_id, status=QUEUED, error=None)
+            try:
+                self._start(project_path, job_id, api_key)
+            except Exception:
+                table.update(job_id, status=status)
+                raise
+        return job_id
+
+    def cancel(self, project_path, job_id):
+        """Stop the job after the chunks that are being transcribed now."""
+        entry = self._running.get(project_path)
+        if entry is not None and entry['job_id'] == job_id:
+            entry['cancel'].set()
+        elif self.table(project_path).get(job_id)['status'] in ACTIVE:
+            self.table(project_path).update(job_id, status=CANCELLED)
+
+    def _check_idle(self, project_path):
+        if self.is_running(project_path):
+            raise RuntimeError(f'A transcription job is already running for {project_path}.')
+
+    def _start(self, project_path, job_id, api_key):
+        # Called with the lock held
+        cancel = threading.Event()
+        thread = threading.Thread(target=self._run, args=(project_path, job_id, api_key, cancel), name=f'transcribe-{job_id}', daemon=True)
+        self._running[project_path] = {'job_id': job_id, 'thread': thread, 'cancel': cancel}
+        try:
+            thread.start()
+        except Exception:
+            self._running.pop(project_path, None)
+            raise
+
+    def _run(self, project_path, job_id, api_key, cancel):
+        table = self.table(project_path)
+        try:
+            job = table.update(job_id, status=RUNNING, started=time.time())
+            params = job['params']
+            finished = job['chunks']
+            cache = DiskCache(params['cache_dir'], max_size_mb=params['cache_size_mb']) if params['cache_dir'] else None
+            table.update(job_id, total_seconds=probe_duration(params['audio_filepath']) if isinstance(params['audio_filepath'], str) else None)
+
+            audio_chunks = {}
+            # The audio is cut at the boundaries of the earlier run, so the finished chunks match
+            known_slices = job.get('slices') or []
+            chunk_stream = stream_pcm_slices(params['audio_filepath'], params['pcm_path'], segment_time=params['segment_time'], vad=params['vad'], known_slices=known_slices)
+
+            def _remaining(chunk_stream):
+                # Skip the chunks that were finished before the job was interrupted
+                for i, chunk in enumerate(chunk_stream):
+                    # No new chunks after a cancel. The chunks that are being transcribed finish and are stored.
+                    if cancel.is_set():
+                        return
+                    audio_chunks[i] = chunk
+                    if i >= len(known_slices) or known_slices[i][:2] != [chunk.start, chunk.end]:
+                        table.add_slice(job_id, i, chunk)
+                    done = finished.get(str(i))
+                    if done is not None and (done['start'], done['end']) == (chunk.start, chunk.end):
+                        continue
+                    yield i, chunk
+
+            for i, transcript, duration in transcription_results(_remaining(chunk_stream), params, cache=cache, api_key=api_key):
+                chunk = audio_chunks[i]
+                table.add_chunk(job_id, i, {
+                    'start': chunk.start,
+                    'end': chunk.end,
+                    'seconds': chunk.seconds,
+                    'text': transcript.get('text', ''),
+                    # Timestamps relative to the recording, including the skipped silences
+                    'segments': [{'start': chunk.to_timeline(seg['start']), 'end': chunk.to_timeline(seg['end']), 'text': seg['text']} for seg in transcript.get('segments', [])],
+                    'duration': duration,
+                    'cached': transcript.get('cached', False),
+                }, chunk.end / SAMPLE_RATE)
+
+            if cancel.is_set():
+                table.update(job_id, status=CANCELLED)
+                return
+
+            # Chunks of an earlier segmentation that do not exist anymore
+            job = table.load()[job_id]
+            job['chunks'] = {i: chunk for i, chunk in job['chunks'].items() if int(i) in audio_chunks}
+            skipped = pcm_seconds(params['pcm_path']) - sum(chunk.seconds for chunk in audio_chunks.values()) if audio_chunks else 0
+            job = table.update(job_id, status=DONE, chunks=job['chunks'], skipped_seconds=max(0, skipped), finished=time.time())
+            # The minute notes of an earlier transcript are stale
+            Pipeline(project_path).record('transcript', params=transcript_params(params), output=fingerprint(job_result(job)['context']))
+            logger.info(f'Transcription job {job_id} is finished: {len(job["chunks"])} chunks.')
+        except Exception as e:
+            logger.exception(f'Transcription job {job_id} failed.')
+            table.update(job_id, status=FAILED, error=f'{e.__class__.__name__}: {e}')
+
+
+#%%
+_RUNNER = JobRunner()
+
+
+def get_job_runner():
+    """Return the process-wide job runner."""
+    return _RUNNER
@@ -0,0 +1,180 @@
+"""
+Streaming responses of local LLM endpoints.
+
+Supports OpenAI-compatible chat completions (server-sent events, e.g. LM Studio) and the
+Ollama ``/api/generate`` and ``/api/chat`` endpoints (newline-delimited json).
+"""
+
+import json
+import time
+import logging
+
+from nota_bene.http_pool import get_http_pool
+
+logger = logging.getLogger(__name__)
+
+
+#%%
+class StreamStats:
+    """Time to the first token and throughput of a streamed response."""
+    def __init__(self):
+        self.start = time.time()
+        self.first_token = None
+        self.end = None
+        self.n_tokens = 0
+        # Number of tokens reported by the endpoint, when it does
+        self.reported_tokens = None
+
+    def token(self, n=1):
+        if self.first_token is None:
+            self.first_token = time.time()
+        self.n_tokens += n
+
+    def finish(self, reported_tokens=None):
+        self.end = time.time()
+        if reported_tokens:
+            self.reported_tokens = reported_tokens
+
+    @property
+    def time_to_first_token(self):
+        return None if self.first_token is None else self.first_token - self.start
+
+    @property
+    def tokens_per_second(self):
+        if self.first_token is None:
+            return None
+        elapsed = (self.end or time.time()) - self.first_token
+        n_tokens = self.reported_tokens or self.n_tokens
+        return n_tokens / elapsed if elapsed > 0 else None
+
+    def as_dict(self):
+        return {'time_to_first_token': self.time_to_first_token, 'tokens_per_second': self.tokens_per_second, 'tokens': self.reported_tokens or self.n_tokens,
+                'duration': (self.end or time.time()) - self.start}
+
+
+#%%
+def build_messages(query, instructions, context, system):
+    """Chat messages of a prompt with the 'system', 'instructions', 'context' and 'query' parts."""
+    user = '\n\n'.join(part for part in [instructions, f'Context:\n{context}' if context else None, query] if part)
+    return [{'role': 'system', 'content': system or ''}, {'role': 'user', 'content': user}]
+
+
+def endpoint_kind(endpoint):
+    """'ollama-generate', 'ollama-chat' or 'openai' (OpenAI-compatible chat completions)."""
+    endpoint = endpoint.rstrip('/')
+    if endpoint.endswith('/api/generate'):
+        return 'ollama-generate'
+    if endpoint.endswith('/api/chat'):
+        return 'ollama-chat'
+    return 'openai'
+
+
+def stream_completion(endpoint, model, messages, temperature=0.8, top_p=1, n_ctx=16384, stats=None, timeout=None):
+    """Yield the text of the response of a local endpoint while it is generated.
+
+    Parameters
+    ----------
+    endpoint : str
+        URL of the endpoint, e.g. 'http://localhost:1234/v1/chat/completions' or 'http://localhost:11434/api/generate'.
+    model : str
+        Name of the model at the endpoint.
+    messages : list
+        Chat messages, see :func:`build_messages`.
+    temperature, top_p : float, optional
+        Sampling parameters.
+    n_ctx : int, optional
+        Context window (Ollama only).
+    stats : StreamStats, optional
+        Updated with the time to the first token and the number of tokens.
+    timeout : tuple, optional
+        Connect and read timeout in seconds. The read timeout applies between two tokens.
+        Defaults to the timeout of the HTTP pool.
+
+    Yields
+    ------
+    str
+        Text of the tokens.
+    """
+    kind = endpoint_kind(endpoint)
+    payload = _payload(kind, model, messages, temperature, top_p, n_ctx, stream=True)
+    pool = get_http_pool()
+
+    reported_tokens = None
+    with pool.session(endpoint).post(endpoint, json=payload, stream=True, timeout=timeout or pool.timeout) as response:
+        response.raise_for_status()
+        # Server-sent events and ndjson are utf-8; requests would decode text/event-stream as latin-1
+        response.encoding = 'utf-8'
+        for line in response.iter_lines(decode_unicode=True):
+            text, done, reported = _parse_line(kind, line)
+            reported_tokens = reported or reported_tokens
+            if text:
+                if stats is not None:
+                    stats.token()
+                yield text
+            if done:
+                break
+    if stats is not None:
+        stats.finish(reported_tokens)
+
+
+def complete(endpoint, model, messages, temperature=0.8, top_p=1, n_ctx=16384, timeout=None):
+    """Return the whole response of a local endpoint, see :func:`stream_completion` for the parameters."""
+    kind = endpoint_kind(endpoint)
+    pool = get_http_pool()
+    response = pool.session(endpoint).post(endpoint, json=_payload(kind, model, messages, temperature, top_p, n_ctx, stream=False), timeout=timeout or pool.timeout)
+    response.raise_for_status()
+    data = response.json()
+    if kind == 'ollama-generate':
+        return data.get('response', '')
+    if kind == 'ollama-chat':
+        return (data.get('message') or {}).get('content', '')
+    return data['choices'][0]['message']['content']
+
+
+def _payload(kind, model, messages, temperature, top_p, n_ctx, stream):
+    options = {'temperature': temperature, 'top_p': top_p, 'num_ctx': n_ctx}
+    if kind == 'ollama-generate':
+        return {'model': model, 'system': messages[0]['content'], 'prompt': messages[-1]['content'], 'stream': stream, 'options': options}
+    if kind == 'ollama-chat':
+        return {'model': model, 'messages': messages, 'stream': stream, 'options': options}
+    return {'model': model, 'messages': messages, 'temperature': temperature, 'top_p': top_p, 'stream': stream}
+
+
+def _parse_line(kind, line):
+    """Return (text, done, reported number of tokens) of a line of the stream."""
+    if not line:
+        return None, False, None
+    if kind == 'openai':
+        # Server-sent events: 'data: {...}' and 'data: [DONE]'
+        if not line.startswith('data:'):
+            return None, False, None
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            return None, True, None
+        event = json.loads(data)
+        usage = (event.get('usage') or {}).get('completion_tokens')
+        choices = event.get('choices') or [{}]
+        return (choices[0].get('delta') or {}).get('content'), False, usage
+
+    event = json.loads(line)
+    if event.get('error'):
+        raise RuntimeError(f"Ollama: {event['error']}")
+    text = event.get('response') if kind == 'ollama-generate' else (event.get('message') or {}).get('content')
+    return text, bool(event.get('done')), event.get('eval_count')
+
+
+def checkpointed(stream, checkpoint, interval=2.0):
+    """Yield the tokens of stream and call checkpoint(text so far) every interval seconds, and at the end.
+
+    The checkpoint can store the partial response, so that it can be recovered when the
+    session is lost while the response is generated.
+    """
+    parts = []
+    last = time.time()
+    for token in stream:
+        parts.append(token)
+        yield token
+        if time.time() - last >= interval:
+            checkpoint(''.join(parts))
+            last = time.time()
+    checkpoint(''.join(parts))
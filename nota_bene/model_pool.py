@@ -0,0 +1,142 @@
+"""
+Process-wide pool of loaded Whisper models.
+
+Loading a Whisper model reads the full set of weights from disk (~3 GB for ``large``).
+The pool keeps loaded models in memory keyed by model name and device so that every
+chunk, rerun and user session in the same process reuses the same instance. Models are
+evicted in least-recently-used order when the configured memory budget is exceeded.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import whisper
+except:
+    logging.info('pip install openai-whisper')
+
+logger = logging.getLogger(__name__)
+
+# Default memory budget in GB. Can be overruled with the environment variable or in the configurations page.
+DEFAULT_MEMORY_BUDGET_GB = float(os.environ.get('NOTABENE_WHISPER_MEMORY_GB', 8))
+
+
+#%%
+class WhisperModelPool:
+    """LRU pool of Whisper models bounded by a memory budget.
+
+    Parameters
+    ----------
+    memory_budget_gb : float, optional
+        Maximum memory in GB that the loaded models may occupy together. A model that is
+        larger than the budget on its own is still loaded, but then it is the only model
+        that is kept in the pool.
+
+    Examples
+    --------
+    > pool = WhisperModelPool(memory_budget_gb=4)
+    > with pool.acquire('small', device='cpu') as model:
+    >     transcript = model.transcribe(audio_path)
+
+    """
+    def __init__(self, memory_budget_gb=DEFAULT_MEMORY_BUDGET_GB):
+        self.memory_budget_gb = memory_budget_gb
+        # (model_name, device) -> {'model', 'nbytes', 'lock'}
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        # (model_name, device) -> lock that is held while the model is loaded
+        self._load_locks = {}
+
+    @property
+    def memory_budget(self):
+        """Memory budget in bytes."""
+        return int(self.memory_budget_gb * 1024**3)
+
+    @property
+    def memory_usage(self):
+        """Total number of bytes of the models in the pool."""
+        return sum(entry['nbytes'] for entry in self._models.values())
+
+    def loaded(self):
+        """Return the keys of the loaded models, least recently used first."""
+        return list(self._models.keys())
+
+    def get(self, model_name, device='cpu'):
+        """Return the loaded model and load it first if it is not in the pool yet."""
+        return self._get_entry(model_name, device)['model']
+
+    @contextmanager
+    def acquire(self, model_name, device='cpu'):
+        """Get the model and hold its lock so that concurrent callers do not interleave inference.
+
+        Whisper installs hooks on the model during decoding, so one model instance can not
+        be used by two threads at the same time.
+        """
+        entry = self._get_entry(model_name, device)
+        with entry['lock']:
+            yield entry['model']
+
+    def evict(self, model_name, device='cpu'):
+        """Remove a model from the pool."""
+        with self._lock:
+            self._models.pop((model_name, device), None)
+
+    def clear(self):
+        """Remove all models from the pool."""
+        with self._lock:
+            self._models.clear()
+
+    def _get_entry(self, model_name, device):
+        key = (model_name, device)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Loaded outside the pool lock, so sessions that use other (loaded) models do not wait
+        with load_lock:
+            with self._lock:
+                if key in self._models:
+                    # Loaded by another thread while this one waited
+                    self._models.move_to_end(key)
+                    return self._models[key]
+
+            logger.info(f'Loading Whisper-{model_name} model on {device}..')
+            # Load model: Can be "tiny", "small", "medium", "large", "turbo"
+            model = whisper.load_model(model_name, device=device)
+            nbytes = _model_nbytes(model)
+            with self._lock:
+                # Make room before the new model is added
+                self._evict_until(self.memory_budget - nbytes)
+                self._models[key] = {'model': model, 'nbytes': nbytes, 'lock': threading.Lock()}
+                logger.info(f'Whisper-{model_name} loaded ({nbytes / 1024**3:.2f} GB). Models in pool: {self.loaded()}')
+                return self._models[key]
+
+    def _evict_until(self, max_bytes):
+        while self._models and self.memory_usage > max(max_bytes, 0):
+            key, _ = self._models.popitem(last=False)
+            logger.info(f'Evicting Whisper-{key[0]} ({key[1]}) from the model pool.')
+
+
+def _model_nbytes(model):
+    """Number of bytes of the parameters and buffers of a torch model."""
+    nbytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    nbytes += sum(b.numel() * b.element_size() for b in model.buffers())
+    return nbytes
+
+
+#%%
+_POOL = WhisperModelPool()
+
+
+def get_model_pool(memory_budget_gb=None):
+    """Return the process-wide Whisper model pool, optionally updating its memory budget."""
+    if memory_budget_gb is not None and memory_budget_gb != _POOL.memory_budget_gb:
+        _POOL.memory_budget_gb = memory_budget_gb
+        with _POOL._lock:
+            _POOL._evict_until(_POOL.memory_budget)
+    return _POOL
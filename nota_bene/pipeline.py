@@ -0,0 +1,173 @@
+"""
+Dependency tracking of the pipeline stages of a project.
+
+The stages (audio -> transcript -> minute_notes) record the fingerprints of their
+parameters and outputs in ``pipeline.json``. A stage is stale when its parameters changed
+or an upstream stage produced a different output since it ran.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import defaultdict
+
+from nota_bene.cache import make_key, atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+# Stage -> upstream stages
+STAGES = {
+    'audio': (),
+    'transcript': ('audio',),
+    'minute_notes': ('transcript',),
+}
+# State of a stage
+MISSING, STALE, FRESH = 'missing', 'stale', 'fresh'
+
+# One lock per pipeline file, shared by all Pipeline objects of the same project
+_LOCKS = defaultdict(threading.Lock)
+
+
+#%%
+def fingerprint(value):
+    """sha256 of a str, bytes, dict or list. None stays None."""
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        value = json.dumps(value, sort_keys=True, default=str)
+    return make_key(value)
+
+
+def downstream(stage):
+    """The stages that depend on the stage, directly or indirectly, in order."""
+    stages = []
+    for name, upstream in STAGES.items():
+        if stage in upstream or any(up in stages for up in upstream):
+            stages.append(name)
+    return stages
+
+
+#%%
+class Pipeline:
+    """Records of the stages of one project.
+
+    Parameters
+    ----------
+    project_path : str
+        Directory of the project. The records are stored in ``pipeline.json``.
+    """
+    filename = 'pipeline.json'
+
+    def __init__(self, project_path):
+        self.project_path = project_path
+        self.path = os.path.join(project_path, self.filename)
+        self._lock = _LOCKS[os.path.abspath(self.path)]
+
+    def load(self):
+        """Return the records as {stage: record}."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, stage):
+        return self.load().get(stage)
+
+    def output(self, stage):
+        """Fingerprint of the current output of the stage, or None when it did not run."""
+        record = self.get(stage)
+        return record['output'] if record else None
+
+    def record(self, stage, params=None, inputs=None, output=None, edited=False):
+        """Record that the stage ran with the parameters and inputs, and produced the output.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, see ``STAGES``.
+        params : dict, optional
+            Parameters that change the output, e.g. the Whisper model.
+        inputs : list, optional
+            Fingerprints of the external inputs, e.g. the uploaded audio files.
+        output : str, optional
+            Fingerprint of the output, see :func:`fingerprint`.
+        edited : bool, optional
+            The output is written by the user. Its parameters and inputs are not checked.
+        """
+        with self._lock:
+            records = self.load()
+            records[stage] = self._new_record(stage, records, params, inputs, output, edited)
+            self._write(records)
+            return records[stage]
+
+    def update_output(self, stage, output):
+        """Record a new output of a stage that is edited by the user. The downstream stages become stale."""
+        with self._lock:
+            records = self.load()
+            record = records.get(stage)
+            if record is not None and record['output'] == output:
+                return record
+            if record is None:
+                # E.g. a transcript that is pasted instead of transcribed
+                record = records[stage] = self._new_record(stage, records, output=output, edited=True)
+            record.update(output=output, edited=True, updated=time.time())
+            self._write(records)
+            return record
+
+    def _new_record(self, stage, records, params=None, inputs=None, output=None, edited=False):
+        return {
+            'params': None if edited else fingerprint(params or {}),
+            'inputs': None if edited else fingerprint(inputs or []),
+            'upstream': {up: (records.get(up) or {}).get('output') for up in STAGES[stage]},
+            'output': output,
+            'edited': edited,
+            'updated': time.time(),
+        }
+
+    def state(self, stage, params=None, inputs=None):
+        """State of the stage: 'missing', 'stale' or 'fresh'.
+
+        A stage is stale when the given parameters or inputs differ from the ones it ran
+        with, or when an upstream stage is stale or has another output than it used.
+        """
+        return self._state(stage, self.load(), params, inputs)[0]
+
+    def reason(self, stage, params=None, inputs=None):
+        """Why the stage is not fresh, or None."""
+        return self._state(stage, self.load(), params, inputs)[1]
+
+    def _state(self, stage, records, params=None, inputs=None):
+        record = records.get(stage)
+        if record is None:
+            return MISSING, f'{stage} did not run yet'
+        if params is not None and record['params'] is not None and fingerprint(params) != record['params']:
+            return STALE, f'the settings of {stage} changed'
+        if inputs is not None and record['inputs'] is not None and fingerprint(inputs) != record['inputs']:
+            return STALE, f'the input of {stage} changed'
+        for up in STAGES[stage]:
+            up_state, up_reason = self._state(up, records)
+            if up_state == STALE:
+                return STALE, up_reason
+            if records.get(up) is not None and records[up]['output'] != record['upstream'].get(up):
+                return STALE, f"the {up.replace('_', ' ')} changed" + (' (edited)' if records[up].get('edited') else '')
+        return FRESH, None
+
+    def stale(self):
+        """Stages that ran, but are stale because an upstream stage changed."""
+        records = self.load()
+        return [stage for stage in STAGES if self._state(stage, records)[0] == STALE]
+
+    def invalidate(self, stage):
+        """Remove the records of the stage and its downstream stages."""
+        with self._lock:
+            records = self.load()
+            for name in [stage] + downstream(stage):
+                records.pop(name, None)
+            self._write(records)
+
+    def _write(self, records):
+        os.makedirs(self.project_path, exist_ok=True)
+        atomic_write_json(self.path, records)
@@ -0,0 +1,134 @@
+"""
+Lightweight project manifests.
+
+Every project has a small ``manifest.json`` with the name, the duration, the status, the
+models and the timestamps, so the sidebar can list the projects without opening their
+session states.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+from nota_bene.cache import atomic_write_json
+from nota_bene.audio import probe_duration
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = 'manifest.json'
+# States that are shown in the manifest as present or not
+TRACKED_KEYS = ('audio', 'context', 'instruction', 'minute_notes')
+
+# temp_dir -> (mtime, project names)
+_PROJECTS = {}
+# manifest path -> (mtime, manifest)
+_MANIFESTS = {}
+_LOCK = threading.Lock()
+
+
+#%%
+def manifest_path(project_path):
+    return os.path.join(project_path, MANIFEST_FILENAME)
+
+
+def project_status(has):
+    """Status of a project from the states that are present."""
+    if has.get('minute_notes'):
+        return 'minute notes'
+    if has.get('context'):
+        return 'transcribed'
+    if has.get('audio'):
+        return 'audio'
+    return 'new'
+
+
+def read_manifest(project_path):
+    """Return the manifest of the project. Projects without a manifest get a minimal one from the directory."""
+    filepath = manifest_path(project_path)
+    try:
+        mtime = os.stat(filepath).st_mtime_ns
+    except FileNotFoundError:
+        return {'name': os.path.basename(project_path.rstrip(os.sep)), 'status': 'unknown', 'has': {}, 'duration': None,
+                'created': None, 'updated': _mtime(project_path)}
+
+    cached = _MANIFESTS.get(filepath)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f'Could not read {filepath}: {e}')
+        return {'name': os.path.basename(project_path.rstrip(os.sep)), 'status': 'unknown', 'has': {}, 'duration': None, 'created': None, 'updated': None}
+    _MANIFESTS[filepath] = (mtime, manifest)
+    return manifest
+
+
+def update_manifest(project_path, states):
+    """Update the manifest with the states that are saved. Keys that are not in states keep their value."""
+    with _LOCK:
+        manifest = dict(read_manifest(project_path))
+        manifest['name'] = os.path.basename(project_path.rstrip(os.sep))
+        manifest['has'] = dict(manifest.get('has') or {})
+        if manifest.get('created') is None:
+            manifest['created'] = time.time()
+
+        for key in TRACKED_KEYS:
+            if key in states:
+                manifest['has'][key] = bool(states[key])
+        for key in ('model_type', 'model', 'instruction_name'):
+            if key in states:
+                manifest[key] = states[key]
+        # The duration is only probed when the audio file changed
+        if 'audio_filepath' in states and states['audio_filepath'] != manifest.get('audio_filepath'):
+            manifest['audio_filepath'] = states['audio_filepath']
+            manifest['duration'] = probe_duration(states['audio_filepath']) if states['audio_filepath'] and os.path.isfile(states['audio_filepath']) else None
+        manifest['status'] = project_status(manifest['has'])
+        manifest['updated'] = time.time()
+
+        os.makedirs(project_path, exist_ok=True)
+        filepath = manifest_path(project_path)
+        atomic_write_json(filepath, manifest)
+        _MANIFESTS[filepath] = (os.stat(filepath).st_mtime_ns, manifest)
+        return manifest
+
+
+#%%
+def list_projects(temp_dir):
+    """Return the names of the projects in temp_dir in alphabetical order.
+
+    The order does not change when a project is saved, so the selected project keeps its
+    place in the sidebar. The directory is only scanned again when a project is created or removed.
+    """
+    try:
+        mtime = os.stat(temp_dir).st_mtime_ns
+    except (FileNotFoundError, TypeError):
+        return []
+
+    cached = _PROJECTS.get(temp_dir)
+    if cached is None or cached[0] != mtime:
+        # Hidden directories, such as the .cache, are not projects
+        names = [entry.name for entry in os.scandir(temp_dir) if entry.is_dir() and not entry.name.startswith('.')]
+        _PROJECTS[temp_dir] = (mtime, names)
+    else:
+        names = cached[1]
+    return sorted(names, key=str.lower)
+
+
+def describe_project(manifest):
+    """Short description of a project for the sidebar, e.g. 'meeting | 45 min | transcribed'."""
+    parts = [manifest['name']]
+    if manifest.get('duration'):
+        parts.append(f"{manifest['duration'] / 60:.0f} min")
+    if manifest.get('status') not in (None, 'unknown'):
+        parts.append(manifest['status'])
+    return ' | '.join(parts)
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
@@ -0,0 +1,115 @@
+"""
+Disk-backed store of the recorded audio fragments of a project.
+
+Every fragment is written to a FLAC file in ``recordings`` in the project directory, and
+the order of the fragments is kept in ``recordings/index.json``.
+"""
+
+import os
+import json
+import uuid
+import logging
+import threading
+import subprocess
+from collections import defaultdict
+
+from nota_bene.cache import atomic_write_json
+from nota_bene.audio import SAMPLE_RATE, probe_duration
+
+logger = logging.getLogger(__name__)
+
+# One lock per index, shared by all RecordingStore objects of the same project
+_INDEX_LOCKS = defaultdict(threading.Lock)
+
+
+#%%
+class RecordingStore:
+    """Ordered store of recorded fragments on disk.
+
+    Parameters
+    ----------
+    project_path : str
+        Directory of the project. The fragments are stored in ``recordings`` in this directory.
+    """
+    dirname = 'recordings'
+
+    def __init__(self, project_path):
+        self.project_path = project_path
+        self.recording_dir = os.path.join(project_path, self.dirname)
+        self.index_path = os.path.join(self.recording_dir, 'index.json')
+        self._lock = _INDEX_LOCKS[os.path.abspath(self.index_path)]
+
+    def index(self):
+        """Return the fragments in order as a list of {'id', 'name', 'file', 'duration'}."""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+
+    def __len__(self):
+        return len(self.index())
+
+    def names(self):
+        return [entry['name'] for entry in self.index()]
+
+    def paths(self):
+        """Paths of the segment files in order."""
+        return [os.path.join(self.recording_dir, entry['file']) for entry in self.index()]
+
+    def path(self, recording_id):
+        for entry in self.index():
+            if entry['id'] == recording_id:
+                return os.path.join(self.recording_dir, entry['file'])
+        return None
+
+    def add(self, wav_audio, name):
+        """Compress the recorded WAV bytes to a segment file and append it to the index."""
+        return self._add(name, ['-f', 'wav', '-i', 'pipe:0'], wav_audio)
+
+    def add_file(self, file_path, name):
+        """Compress an audio file on disk to a segment file and append it to the index."""
+        return self._add(name, ['-i', file_path], None)
+
+    def _add(self, name, inputs, data):
+        os.makedirs(self.recording_dir, exist_ok=True)
+        filename = uuid.uuid4().hex + '.flac'
+        filepath = os.path.join(self.recording_dir, filename)
+        tmp_path = filepath + '.tmp.flac'
+        # Keyboard interaction is disabled, unless the audio is piped to stdin
+        command = ['ffmpeg'] + ([] if data is not None else ['-nostdin']) + inputs + ['-ac', '1', '-ar', str(SAMPLE_RATE), '-c:a', 'flac', '-y', tmp_path]
+        subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        os.replace(tmp_path, filepath)
+
+        with self._lock:
+            index = self.index()
+            index.append({'id': filename[:-5], 'name': name, 'file': filename, 'duration': probe_duration(filepath)})
+            atomic_write_json(self.index_path, index)
+        return filepath
+
+    def move(self, recording_id, direction):
+        """Move the fragment one position 'up' or 'down'."""
+        with self._lock:
+            index = self.index()
+            ids = [entry['id'] for entry in index]
+            i = ids.index(recording_id)
+            j = i - 1 if direction == 'up' else i + 1
+            if 0 <= j < len(index):
+                index[i], index[j] = index[j], index[i]
+                atomic_write_json(self.index_path, index)
+
+    def remove(self, recording_id):
+        """Remove the fragment from the index and delete its segment file."""
+        with self._lock:
+            index = self.index()
+            removed = [entry for entry in index if entry['id'] == recording_id]
+            atomic_write_json(self.index_path, [entry for entry in index if entry['id'] != recording_id])
+        for entry in removed:
+            try:
+                os.remove(os.path.join(self.recording_dir, entry['file']))
+            except FileNotFoundError:
+                pass
+
+    def duration(self):
+        """Total duration of the fragments in seconds."""
+        return sum(entry['duration'] or 0 for entry in self.index())
@@ -0,0 +1,295 @@
+"""
+Per-project store of the session states.
+
+The states are stored per key in a SQLite database (``session.db``) in the project
+directory, and large binaries as content-addressed files in ``.blobs``. Only the keys that
+changed are written, by a background writer thread.
+"""
+
+import io
+import os
+import time
+import queue
+import atexit
+import pickle
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Binaries larger than this number of bytes are stored as blob files
+BLOB_THRESHOLD = 256 * 1024
+# Name of the pickled session of older versions
+LEGACY_FILENAME = 'session_states.pkl'
+
+
+#%%
+class SessionStore:
+    """Key/value store of the session states of one project.
+
+    Parameters
+    ----------
+    db_path : str
+        Path of the SQLite database. The blobs are stored in ``.blobs`` next to it.
+    blob_threshold : int, optional
+        Binaries larger than this number of bytes are stored as blob files.
+    """
+    def __init__(self, db_path, blob_threshold=BLOB_THRESHOLD):
+        self.db_path = db_path
+        self.blob_dir = os.path.join(os.path.dirname(db_path), '.blobs')
+        self.blob_threshold = blob_threshold
+        # key -> digest of the serialized value that is saved
+        self._digests = None
+        # id(obj) -> (obj, digest) of the binaries, so that a binary is hashed only once
+        self._blob_ids = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writer = None
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, value BLOB, digest TEXT, blobs TEXT, updated REAL)')
+        return conn
+
+    def exists(self):
+        return os.path.isfile(self.db_path) or os.path.isfile(self._legacy_path)
+
+    @property
+    def _legacy_path(self):
+        return os.path.join(os.path.dirname(self.db_path), LEGACY_FILENAME)
+
+    #%% Reading
+    def load(self, keys=None, exclude=()):
+        """Return {key: value} of the stored states, or of the given keys only.
+
+        Projects of older versions that only have a ``session_states.pkl`` are loaded from
+        the pickle. They are written to the store with the next save.
+        """
+        self.flush()
+        if not os.path.isfile(self.db_path):
+            return self._load_legacy(keys, exclude)
+
+        conn = self._connect()
+        try:
+            if keys is None:
+                exclude = list(exclude)
+                rows = conn.execute(f'SELECT key, value, digest FROM states WHERE key NOT IN ({",".join("?" * len(exclude))})', exclude).fetchall()
+            else:
+                keys = list(keys)
+                rows = conn.execute(f'SELECT key, value, digest FROM states WHERE key IN ({",".join("?" * len(keys))})', keys).fetchall()
+            # The digests of all stored keys, also of the keys that are not loaded, so the next save only writes changes
+            digests = dict(conn.execute('SELECT key, digest FROM states').fetchall()) if self._digests is None else None
+        finally:
+            conn.close()
+
+        states = {}
+        with self._lock:
+            if self._digests is None:
+                self._digests = digests or {}
+            for key, value, digest in rows:
+                try:
+                    states[key] = self._loads(value)
+                except Exception as e:
+                    logger.warning(f'Could not load {key} from {self.db_path}: {e}')
+                    continue
+                self._digests[key] = digest
+        return states
+
+    def _load_legacy(self, keys=None, exclude=()):
+        if not os.path.isfile(self._legacy_path):
+            return {}
+        import pypickle
+        states = pypickle.load(self._legacy_path)
+        return {key: value for key, value in states.items() if (keys is None or key in keys) and key not in exclude}
+
+    def _loads(self, value):
+        unpickler = pickle.Unpickler(io.BytesIO(value))
+        unpickler.persistent_load = self._persistent_load
+        return unpickler.load()
+
+    def _persistent_load(self, pid):
+        kind, digest = pid
+        with open(self._blob_path(digest), 'rb') as f:
+            data = f.read()
+        return io.BytesIO(data) if kind == 'bytesio' else data
+
+    #%% Writing
+    def save(self, states):
+        """Write the keys of states that changed since the last save in the background.
+
+        Returns
+        -------
+        list
+            The keys that are written.
+        """
+        with self._lock:
+            if self._digests is None:
+                self._digests = self._stored_digests()
+            blob_ids = {}
+            changed = []
+            for key, value in states.items():
+                blobs = {}
+                try:
+                    data = self._dumps(value, blobs, blob_ids)
+                except Exception as e:
+                    logger.warning(f'Session state {key} can not be saved: {e}')
+                    continue
+                digest = hashlib.sha256(data).hexdigest()
+                if self._digests.get(key) != digest:
+                    changed.append((key, data, digest, blobs))
+                    self._digests[key] = digest
+            # Only keep the references to the binaries that are still in the session
+            self._blob_ids = blob_ids
+
+        if changed:
+            self._queue.put(changed)
+            self._start_writer()
+        return [item[0] for item in changed]
+
+    def flush(self):
+        """Block until all saves are written to disk."""
+        if self._writer is not None:
+            self._queue.join()
+
+    def delete(self, keys):
+        """Remove keys from the store."""
+        self.flush()
+        with self._lock:
+            for key in keys:
+                (self._digests or {}).pop(key, None)
+        self._queue.put([(key, None, None, {}) for key in keys])
+        self._start_writer()
+
+    def _stored_digests(self):
+        if not os.path.isfile(self.db_path):
+            return {}
+        conn = self._connect()
+        try:
+            return dict(conn.execute('SELECT key, digest FROM states').fetchall())
+        finally:
+            conn.close()
+
+    def _dumps(self, value, blobs, blob_ids):
+        """Pickle the value. Large binaries, also when nested in dicts or lists, are replaced by blob references."""
+        def persistent_id(obj):
+            if isinstance(obj, (bytes, bytearray)):
+                kind, size = 'bytes', len(obj)
+            elif isinstance(obj, io.BytesIO):
+                kind, size = 'bytesio', obj.getbuffer().nbytes
+            else:
+                return None
+            if size < self.blob_threshold:
+                return None
+            entry = blob_ids.get(id(obj)) or self._blob_ids.get(id(obj))
+            if entry is None or entry[0] is not obj:
+                data = obj.getvalue() if kind == 'bytesio' else obj
+                entry = (obj, hashlib.sha256(data).hexdigest())
+            blob_ids[id(obj)] = entry
+            blobs[entry[1]] = obj
+            return (kind, entry[1])
+
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(value)
+        return buffer.getvalue()
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def _write_blob(self, digest, obj):
+        filepath = self._blob_path(digest)
+        if os.path.isfile(filepath):
+            return
+        os.makedirs(self.blob_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.blob_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(obj.getbuffer() if isinstance(obj, io.BytesIO) else obj)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _start_writer(self):
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name=f'session-store-{os.path.basename(os.path.dirname(self.db_path))}', daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            changed = self._queue.get()
+            try:
+                self._write(changed)
+            except Exception as e:
+                logger.error(f'Could not save the session to {self.db_path}: {e}')
+                # Write the keys again with the next save
+                with self._lock:
+                    for key, *_ in changed:
+                        (self._digests or {}).pop(key, None)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, changed):
+        # Blobs first, so that a committed row never refers to a missing blob
+        for _, _, _, blobs in changed:
+            for digest, obj in blobs.items():
+                self._write_blob(digest, obj)
+
+        conn = self._connect()
+        try:
+            with conn:
+                for key, data, digest, blobs in changed:
+                    if data is None:
+                        conn.execute('DELETE FROM states WHERE key = ?', (key,))
+                    else:
+                        conn.execute('INSERT OR REPLACE INTO states (key, value, digest, blobs, updated) VALUES (?, ?, ?, ?, ?)', (key, data, digest, ' '.join(blobs), time.time()))
+            referenced = {digest for (blobs,) in conn.execute('SELECT blobs FROM states') for digest in (blobs or '').split()}
+        finally:
+            conn.close()
+        self._remove_unreferenced_blobs(referenced)
+
+    def _remove_unreferenced_blobs(self, referenced):
+        if not os.path.isdir(self.blob_dir):
+            return
+        for filename in os.listdir(self.blob_dir):
+            if filename not in referenced and not filename.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(self.blob_dir, filename))
+                except OSError:
+                    pass
+
+
+#%%
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_session_store(db_path):
+    """Return the store of the database, so that all sessions of a project share the same writer."""
+    db_path = os.path.abspath(db_path)
+    with _STORES_LOCK:
+        if db_path not in _STORES:
+            _STORES[db_path] = SessionStore(db_path)
+        return _STORES[db_path]
+
+
+def forget_session_store(db_path):
+    """Remove the store of a deleted project."""
+    with _STORES_LOCK:
+        store = _STORES.pop(os.path.abspath(db_path), None)
+    if store is not None:
+        store.flush()
+
+
+@atexit.register
+def _flush_all():
+    for store in list(_STORES.values()):
+        store.flush()
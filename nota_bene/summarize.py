@@ -0,0 +1,215 @@
+"""
+Map-reduce minute notes of long transcripts.
+
+The transcript is cut in chunks at content-defined boundaries, the notes of the chunks
+are created concurrently and then merged. An edit of the transcript only changes the
+chunk it is in, so the cached notes of the other chunks are reused.
+"""
+
+import re
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from nota_bene.cache import make_key
+
+logger = logging.getLogger(__name__)
+
+# The query does not depend on the position of the chunk, so the notes of a chunk can be reused when other chunks change
+MAP_QUERY = ('Write the minute notes of this part of the meeting transcript. '
+             'The notes of all parts are merged afterwards, so only use what is said in this part.')
+# Part of a chunk that is repeated of the previous chunk
+OVERLAP = 0.1
+REDUCE_QUERY = 'Merge the minute notes of these consecutive parts of the meeting into one set of minute notes.'
+REDUCE_INSTRUCTIONS = ('The context contains the minute notes of consecutive parts of one meeting, in order. '
+                       'Merge them into one set of minute notes: combine the same topics, remove duplicates and keep the chronological order.')
+
+
+#%%
+def split_text(text, chunk_size=8192, overlap=0):
+    """Cut the text in chunks of at most chunk_size characters, at speaker turns, sentences or words.
+
+    The chunks end at content-defined boundaries, so an edit only changes the chunks around
+    it. A chunk is at least half of chunk_size long, unless the text ends.
+
+    Parameters
+    ----------
+    text : str
+        Text to cut.
+    chunk_size : int, optional
+        Maximum number of characters per chunk.
+    overlap : int, optional
+        Number of characters that a chunk repeats of the previous chunk.
+
+    Returns
+    -------
+    list of str
+    """
+    text = text or ''
+    if len(text) <= chunk_size:
+        return [text] if text.strip() else []
+    overlap = max(0, min(overlap, chunk_size // 2))
+    # The overlap is part of the chunk
+    size = chunk_size - overlap
+
+    units = [piece for unit in _units(text) for piece in _split_words(unit, size)]
+    chunks, previous = [], ''
+    for group in _group(units, size, is_end=lambda unit: unit.rstrip(' \t').endswith('\n')):
+        body = ''.join(group)
+        chunks.append((_tail(previous, overlap) + body).strip())
+        previous = body
+    return [chunk for chunk in chunks if chunk]
+
+
+def _units(text):
+    """Cut the text after every speaker turn (new line) and sentence."""
+    starts = [0] + [m.end() for m in re.finditer(r'\n\s*|[.!?]+\s+', text)]
+    return [text[a:b] for a, b in zip(starts, starts[1:] + [len(text)]) if b > a]
+
+
+def _split_words(unit, size):
+    """Cut a unit that is longer than size at words."""
+    pieces = []
+    while len(unit) > size:
+        space = unit.rfind(' ', size // 2, size)
+        end = space + 1 if space >= 0 else size
+        pieces.append(unit[:end])
+        unit = unit[end:]
+    return pieces + [unit] if unit else pieces
+
+
+def _tail(text, length):
+    """The last length characters of the text, starting at a word."""
+    if length <= 0 or not text:
+        return ''
+    tail = text[-length:]
+    space = tail.find(' ')
+    return tail[space + 1:] if 0 <= space < len(tail) - 1 else tail
+
+
+def _is_boundary(unit, size):
+    """Content-defined boundary: true for about one in size / (4 * len(unit)) units, by the hash of the unit only."""
+    return int(make_key(unit)[:8], 16) < 0x100000000 * min(1.0, 4 * len(unit) / size)
+
+
+def _group(units, size, min_items=1, is_end=None):
+    """Group consecutive units in groups of at most size characters, ending at content-defined boundaries.
+
+    A group ends after a unit when it has at least half of size characters and the unit is
+    the end of a speaker turn (is_end) or a content-defined boundary. Because the
+    boundaries do not depend on the position of a unit, the groups after an edited unit are
+    the same as before the edit, from the first boundary after it. Every group has at least
+    min_items units, when possible.
+    """
+    groups, group, length = [], [], 0
+    for unit in units:
+        if group and length + len(unit) > size and len(group) >= min_items:
+            groups.append(group)
+            group, length = [], 0
+        group.append(unit)
+        length += len(unit)
+        if length >= size // 2 and len(group) >= min_items and ((is_end is not None and is_end(unit)) or _is_boundary(unit, size)):
+            groups.append(group)
+            group, length = [], 0
+    if group:
+        # A group that is too small is merged with the previous group
+        if len(group) < min_items and groups:
+            groups[-1].extend(group)
+        else:
+            groups.append(group)
+    return groups
+
+
+#%%
+def map_reduce_minute_notes(context, prompt, complete, chunk_size=8192, overlap=None, max_concurrency=4, progress=None):
+    """Create the minute notes of a long transcript with concurrent chunk prompts and reduce passes.
+
+    Parameters
+    ----------
+    context : str
+        Transcript of the meeting.
+    prompt : dict
+        Prompt with the 'query', 'instructions' and 'system' parts, see :func:`load_user_prompts`.
+    complete : callable
+        complete(query, instructions, context, system) returns the response of the LLM. It is
+        called from multiple threads at the same time.
+    chunk_size : int, optional
+        Number of characters per chunk. Also the size of the partial notes that are merged in one reduce prompt.
+    overlap : int, optional
+        Number of characters that consecutive chunks overlap. Defaults to 10% of chunk_size.
+    max_concurrency : int, optional
+        Maximum number of prompts that are sent to the LLM at the same time.
+    progress : callable, optional
+        Called with (n_done, n_total, stage) after every prompt. The stage is 'map' or 'reduce'.
+
+    Returns
+    -------
+    str
+        Minute notes.
+    """
+    overlap = int(OVERLAP * chunk_size) if overlap is None else overlap
+    chunks = split_text(context, chunk_size=chunk_size, overlap=overlap)
+    if len(chunks) <= 1:
+        notes = complete(prompt['query'], prompt['instructions'], context, prompt['system'])
+        if progress is not None:
+            progress(1, 1, 'map')
+        return notes
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix='minute-notes') as executor:
+        # Map: the notes of every chunk
+        logger.info(f'Creating the minute notes of {len(chunks)} chunks with {max_concurrency} concurrent prompts..')
+        notes = _run_all(executor, [(MAP_QUERY, prompt['instructions'], chunk, prompt['system']) for chunk in chunks], complete, progress, 'map')
+
+        # Reduce: merge consecutive notes until the notes of the whole meeting remain
+        n_pass = 0
+        while len(notes) > 1:
+            n_pass += 1
+            batches = _group(notes, chunk_size, min_items=2)
+            logger.info(f'Reduce pass {n_pass}: merging {len(notes)} partial notes in {len(batches)} prompt(s)..')
+            final = len(batches) == 1
+            tasks = []
+            for batch in batches:
+                merged = '\n\n---\n\n'.join(batch)
+                # The last pass gets the query of the user, so the notes have the requested format
+                tasks.append((prompt['query'] if final else REDUCE_QUERY,
+                              prompt['instructions'] + '\n\n' + REDUCE_INSTRUCTIONS, merged, prompt['system']))
+            notes = _run_all(executor, tasks, complete, progress, 'reduce')
+    return notes[0]
+
+
+def cached_completion(complete, cache, key_parts, read_cache=True):
+    """Wrap complete(query, instructions, context, system) with a response cache.
+
+    Parameters
+    ----------
+    complete : callable
+        Function that calls the LLM.
+    cache : DiskCache or None
+        Response cache. Without a cache, complete is returned as it is.
+    key_parts : dict
+        Everything else that changes the response, such as the model, the endpoint and the sampling parameters.
+    read_cache : bool, optional
+        Use the cached responses. When False, the LLM is called and the cache is updated.
+    """
+    if cache is None:
+        return complete
+
+    def _complete(query, instructions, context, system):
+        key = make_key('llm-response', key_parts, query, instructions, system, context)
+        cached = cache.get(key) if read_cache else None
+        if cached is not None:
+            return cached['text']
+        text = complete(query, instructions, context, system)
+        cache.set(key, {'text': text})
+        return text
+    return _complete
+
+
+def _run_all(executor, tasks, complete, progress, stage):
+    """Run the tasks concurrently and return the responses in the order of the tasks."""
+    futures = [executor.submit(complete, *task) for task in tasks]
+    results = []
+    for n_done, future in enumerate(futures, start=1):
+        results.append(future.result())
+        if progress is not None:
+            progress(n_done, len(futures), stage)
+    return results
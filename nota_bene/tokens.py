@@ -0,0 +1,127 @@
+"""
+Token counts of transcripts and prompts, and the choice of the LLM strategy.
+
+Tokens are counted with ``tiktoken`` when it is installed, otherwise they are estimated
+from the words and punctuation.
+"""
+
+import re
+import math
+import logging
+from collections import OrderedDict
+
+from nota_bene.cache import make_key
+from nota_bene.summarize import split_text, OVERLAP
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Part of the context window that is kept free for the response
+OUTPUT_FRACTION = 0.25
+# Tokens of the chat template and the map/reduce instructions around the prompt
+TEMPLATE_TOKENS = 256
+# Chunk sizes are a multiple of this number of characters
+CHUNK_STEP = 1024
+# Number of token counts that are kept in memory
+MAX_CACHED = 256
+
+# fingerprint of the text -> number of tokens
+_COUNTS = OrderedDict()
+_ENCODING = None
+
+
+#%%
+def _encoding():
+    global _ENCODING
+    if _ENCODING is None and tiktoken is not None:
+        try:
+            _ENCODING = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            logger.info(f'tiktoken is not available, the tokens are estimated: {e}')
+    return _ENCODING
+
+
+def estimate_tokens(text):
+    """Estimate the number of tokens: about one per four characters of a word, and one per punctuation mark."""
+    n_tokens = 0
+    for match in re.finditer(r'\w+|[^\w\s]', text or ''):
+        word = match.group()
+        n_tokens += max(1, math.ceil(len(word) / 4)) if word[0].isalnum() or word[0] == '_' else 1
+    return n_tokens
+
+
+def count_tokens(text):
+    """Number of tokens of the text. The count is cached per text."""
+    if not text:
+        return 0
+    key = make_key(text)
+    if key in _COUNTS:
+        _COUNTS.move_to_end(key)
+        return _COUNTS[key]
+    encoding = _encoding()
+    n_tokens = len(encoding.encode(text, disallowed_special=())) if encoding is not None else estimate_tokens(text)
+    _COUNTS[key] = n_tokens
+    if len(_COUNTS) > MAX_CACHED:
+        _COUNTS.popitem(last=False)
+    return n_tokens
+
+
+def prompt_tokens(prompt):
+    """Number of tokens of the 'system', 'instructions' and 'query' parts of a prompt."""
+    if isinstance(prompt, str):
+        return count_tokens(prompt)
+    return sum(count_tokens((prompt or {}).get(part)) for part in ('system', 'instructions', 'query'))
+
+
+#%%
+def plan_llm_strategy(context, prompt, n_ctx=16384, output_tokens=None):
+    """Choose the cheapest strategy and chunk size that fit in the context window of the model.
+
+    Parameters
+    ----------
+    context : str
+        Transcript.
+    prompt : dict or str
+        Prompt with the 'system', 'instructions' and 'query' parts, or the instruction text.
+    n_ctx : int, optional
+        Context window of the model in tokens.
+    output_tokens : int, optional
+        Tokens that are kept free for the response. Defaults to a quarter of the context window.
+
+    Returns
+    -------
+    dict
+        'preprocessing' (None for Unlimited or 'chunk-wise'), 'chunk_size' (characters, None
+        for Unlimited), 'n_chunks', 'context_tokens', 'prompt_tokens', 'available_tokens' and
+        'chars_per_token'.
+    """
+    output_tokens = int(n_ctx * OUTPUT_FRACTION) if output_tokens is None else output_tokens
+    n_context = count_tokens(context)
+    n_prompt = prompt_tokens(prompt)
+    available = max(256, n_ctx - output_tokens - n_prompt - TEMPLATE_TOKENS)
+    chars_per_token = len(context) / n_context if n_context > 0 else 4.0
+
+    plan = {'context_tokens': n_context, 'prompt_tokens': n_prompt, 'available_tokens': available, 'chars_per_token': chars_per_token}
+    if n_context <= available:
+        # One prompt is the cheapest
+        return {**plan, 'preprocessing': None, 'chunk_size': None, 'n_chunks': 1}
+
+    # The fewest chunks that fit, of about equal size, so the last chunk is not a small remainder.
+    # Room for the overlap between the chunks and the boundaries at speaker turns and sentences.
+    n_chunks = math.ceil(n_context / available)
+    chunk_tokens = math.ceil(n_context / n_chunks)
+    chunk_size = int(min(available, chunk_tokens * (1 + 2 * OVERLAP + 0.1)) * chars_per_token)
+    # Rounded, so a small edit of the transcript keeps the chunk size and thereby the chunks
+    chunk_size = max(CHUNK_STEP, chunk_size // CHUNK_STEP * CHUNK_STEP)
+    n_chunks = len(split_text(context, chunk_size=chunk_size, overlap=int(OVERLAP * chunk_size)))
+    return {**plan, 'preprocessing': 'chunk-wise', 'chunk_size': chunk_size, 'n_chunks': n_chunks}
+
+
+def describe_plan(plan, n_ctx):
+    """Short description of the plan, e.g. 'Chunk-Wise: 3 chunks (transcript 30000 tokens, context window 16384)'."""
+    strategy = 'Unlimited: one prompt' if plan['preprocessing'] is None else f"Chunk-Wise: {plan['n_chunks']} chunks of up to {int(plan['chunk_size'] / plan['chars_per_token'])} tokens"
+    return f"{strategy} (transcript {plan['context_tokens']} tokens, prompt {plan['prompt_tokens']} tokens, context window {n_ctx})"
@@ -0,0 +1,277 @@
+"""
+Transcription of audio with the local Whisper models or the OpenAI service.
+
+The functions in this module do not depend on streamlit so that they can be used in
+worker processes. Transcripts are cached by the decoded audio, the model and the options.
+"""
+
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import openai
+
+from nota_bene.audio import PCMSlice, pcm_to_wav
+from nota_bene.cache import make_key
+from nota_bene.model_pool import get_model_pool
+
+try:
+    import whisper
+except:
+    logging.info('pip install openai-whisper')
+
+logger = logging.getLogger(__name__)
+
+
+#%%
+def load_audio(audio):
+    """Return 16 kHz mono float32 samples of an audio file, a PCMSlice or an array."""
+    if isinstance(audio, PCMSlice):
+        # View on the decoded recording, no decoding needed
+        audio = audio.load()
+    elif isinstance(audio, str):
+        audio = whisper.load_audio(audio)
+    return audio
+
+
+def transcript_key(audio, model_name, options=None):
+    """Cache key of the decoded audio, the model name and the decode options."""
+    return make_key(audio, model_name, options or {})
+
+
+def get_cached_transcript(audio, model_name, cache, options=None):
+    """Return the cached transcript or None."""
+    if cache is None:
+        return None
+    transcript = cache.get(transcript_key(load_audio(audio), model_name, options))
+    if transcript is not None:
+        transcript['cached'] = True
+    return transcript
+
+
+#%%
+def transcribe_whisper(audio, model_name, device='cpu', cache=None, read_cache=True, options=None):
+    """Transcribe audio with a local Whisper model.
+
+    Parameters
+    ----------
+    audio : str, PCMSlice or np.ndarray
+        Path to the audio file, a slice of the decoded recording or the 16 kHz mono float32 signal.
+    model_name : str
+        Whisper model: "tiny", "base", "small", "medium", "large" or "turbo".
+    device : str, optional
+        Device to run the model on.
+    cache : DiskCache, optional
+        Transcript cache. Results are stored in the cache when provided.
+    read_cache : bool, optional
+        Return the cached transcript when available. If False, the audio is transcribed again and the cache is updated.
+    options : dict, optional
+        Decode options that are passed to ``model.transcribe``.
+
+    Returns
+    -------
+    dict
+        Whisper transcript with the 'text', 'segments' and the 'duration' of the transcription in minutes.
+    """
+    options = options or {}
+    audio = load_audio(audio)
+    key = transcript_key(audio, model_name, options)
+
+    if cache is not None and read_cache:
+        transcript = cache.get(key)
+        if transcript is not None:
+            transcript['cached'] = True
+            return transcript
+
+    start_time = time.time()
+    with get_model_pool().acquire(model_name, device=device) as model:
+        transcript = model.transcribe(audio, **options)
+    transcript['duration'] = (time.time() - start_time) / 60  # Convert to min
+
+    if cache is not None:
+        cache.set(key, transcript)
+    transcript['cached'] = False
+    return transcript
+
+
+def submit_as_completed(executor, func, items, max_pending=None):
+    """Submit func(index, item) for the (index, item) tuples and yield the results as they complete.
+
+    The items can be a generator that is still producing, e.g. chunks of a recording that is
+    being decoded. Items are submitted as soon as they arrive and finished results are
+    yielded in between, so that the executor is never idle waiting for the whole input.
+    With max_pending, the next item is only taken when fewer items are in flight. Closing
+    the generator cancels the items that did not start.
+    """
+    pending = set()
+    try:
+        for index, item in items:
+            if max_pending is not None and len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(func, index, item))
+            # Yield the results that are finished in the meantime
+            done, pending = wait(pending, timeout=0)
+            for future in done:
+                yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        if pending:
+            # Closed early or failed: only the items that are running are finished
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+#%% OpenAI
+class TokenBucket:
+    """Thread-safe token bucket that limits the number of requests per minute.
+
+    Parameters
+    ----------
+    requests_per_minute : float
+        Rate at which the tokens are refilled.
+    capacity : int, optional
+        Maximum burst size. Defaults to one second worth of requests, with a minimum of 1.
+    """
+    def __init__(self, requests_per_minute, capacity=None):
+        self.rate = requests_per_minute / 60
+        self.capacity = capacity or max(1, int(self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _is_retryable(error):
+    """Rate limits (429), server errors (5xx), timeouts and connection errors are retried."""
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    status = getattr(error, 'status_code', None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def _retry_after(error):
+    """Seconds from the Retry-After header of the response, if any."""
+    try:
+        return float(error.response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def call_with_retry(func, rate_limiter=None, max_retries=5, base_delay=1.0, max_delay=60.0):
+    """Call func and retry with exponential backoff and full jitter on retryable errors."""
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_retries or not _is_retryable(e):
+                raise
+            delay = max(random.uniform(0, min(max_delay, base_delay * 2**attempt)), _retry_after(e))
+            logger.warning(f'Request failed ({e.__class__.__name__}). Retry {attempt + 1}/{max_retries} in {delay:.1f} sec.')
+            time.sleep(delay)
+
+
+def transcribe_openai(audio, client, cache=None, read_cache=True, model_name='whisper-1', rate_limiter=None, max_retries=0):
+    """Transcribe audio with the OpenAI service.
+
+    Parameters
+    ----------
+    audio : str, PCMSlice or np.ndarray
+        Path to the audio file or decoded samples. Samples are uploaded as 16 kHz WAV.
+        The decoded content is used for the cache key.
+    client : OpenAI
+        OpenAI client.
+    cache : DiskCache, optional
+        Transcript cache.
+    read_cache : bool, optional
+        Return the cached transcript when available.
+    model_name : str, optional
+        Name of the OpenAI transcription model.
+    rate_limiter : TokenBucket, optional
+        Rate limiter that is shared by the concurrent requests.
+    max_retries : int, optional
+        Number of retries with jittered backoff on 429/5xx responses.
+
+    Returns
+    -------
+    dict
+        Transcript with the 'text' and the 'duration' of the transcription in minutes.
+    """
+    key = transcript_key(load_audio(audio), model_name) if cache is not None else None
+    if cache is not None and read_cache:
+        transcript = cache.get(key)
+        if transcript is not None:
+            transcript['cached'] = True
+            return transcript
+
+    def _create():
+        if isinstance(audio, str):
+            with open(audio, 'rb') as audio_file:
+                return client.audio.transcriptions.create(model=model_name, file=audio_file)
+        return client.audio.transcriptions.create(model=model_name, file=pcm_to_wav(load_audio(audio)))
+
+    start_time = time.time()
+    transcription = call_with_retry(_create, rate_limiter=rate_limiter, max_retries=max_retries)
+    transcript = {'text': transcription.text, 'duration': (time.time() - start_time) / 60}
+
+    if cache is not None:
+        cache.set(key, transcript)
+    transcript['cached'] = False
+    return transcript
+
+
+def transcribe_openai_concurrent(audio_chunks, client, cache=None, read_cache=True, model_name='whisper-1', max_concurrency=4, requests_per_minute=50, max_retries=5):
+    """Transcribe the audio chunks with concurrent uploads to the OpenAI service.
+
+    Parameters
+    ----------
+    audio_chunks : iterable
+        (index, audio) tuples of the chunks to transcribe. Can be a generator that is still producing chunks.
+        The next chunk is only taken when an upload is free, so a generator that stops stops the uploads.
+    client : OpenAI
+        OpenAI client that is shared by all uploads. The client is thread-safe and pools its connections.
+    cache : DiskCache, optional
+        Transcript cache.
+    read_cache : bool, optional
+        Return cached transcripts when available.
+    model_name : str, optional
+        Name of the OpenAI transcription model.
+    max_concurrency : int, optional
+        Maximum number of uploads at the same time.
+    requests_per_minute : float, optional
+        Rate limit of the requests.
+    max_retries : int, optional
+        Number of retries with jittered backoff on 429/5xx responses.
+
+    Yields
+    ------
+    tuple
+        (index, transcript, duration) in order of completion. Use the index to reassemble the chunks.
+    """
+    rate_limiter = TokenBucket(requests_per_minute)
+
+    def _transcribe(index, audio):
+        transcript = transcribe_openai(audio, client, cache=cache, read_cache=read_cache, model_name=model_name, rate_limiter=rate_limiter, max_retries=max_retries)
+        return index, transcript, transcript['duration']
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        yield from submit_as_completed(executor, _transcribe, audio_chunks, max_pending=max(1, max_concurrency))
@@ -8,34 +8,202 @@ full prompt template used in generating structured meeting minute notes.
 
 from io import BytesIO
 import os
+import shutil
 import numpy as np
 import subprocess
-import json
-from pathlib import Path
 import logging
-import pypickle
 from LLMlight import LLMlight
 
-try:
-    import whisper
-except:
-    logging.info('pip install openai-whisper')
-
 import streamlit as st
-from openai import OpenAI
 import tempfile
+from nota_bene.model_pool import DEFAULT_MEMORY_BUDGET_GB
+from nota_bene.cache import DiskCache, make_key, TRANSCRIPT_CACHE_SIZE_MB, LLM_CACHE_SIZE_MB
+from nota_bene.session_store import get_session_store
+from nota_bene.projects import read_manifest, update_manifest
+from nota_bene.audio import ingest_audio, SAMPLE_RATE
+from nota_bene.artifacts import get_artifact_store, is_artifact, sweep_legacy, file_digest
+from nota_bene.pipeline import Pipeline
+from nota_bene.summarize import map_reduce_minute_notes, cached_completion
+from nota_bene.local_llm import stream_completion, complete, build_messages
+from nota_bene.http_pool import get_http_pool
+
+# Large states of a project that are loaded the first time a page needs them
+LAZY_KEYS = ('audio', 'audio_recording', 'context', 'segments', 'minute_notes')
 
 
 #%%
-def load_llm_model(modelname='', retrieval_method='naive_RAG', verbose='info'):
+def load_llm_model(modelname='', retrieval_method='naive_RAG', verbose='info', endpoint=None):
+    """Return the shared LLMlight model of the endpoint, see :func:`_shared_llm_model`."""
+    return _shared_llm_model(modelname, retrieval_method, endpoint or st.session_state['endpoint'], verbose)
+
+
+@st.cache_resource(max_entries=16)
+def _shared_llm_model(modelname, retrieval_method, endpoint, verbose):
+    """One LLMlight model per model, method and endpoint, that is reused by all validations, model checks and runs."""
     model = LLMlight(model=modelname,
                      retrieval_method=retrieval_method,
                      alpha=None,
-                     endpoint=st.session_state['endpoint'],
+                     endpoint=endpoint,
                      verbose=verbose,
                      )
     return model
 
+def generate_minute_notes(context, prompt, model, endpoint, preprocessing=None, chunk_size=8192, n_ctx=16384, max_concurrency=1, progress=None, cache=None, read_cache=True, verbose='info'):
+    """Create the minute notes of a transcript with a local LLM.
+
+    Parameters
+    ----------
+    context : str
+        Transcript of the meeting.
+    prompt : dict
+        Prompt with the 'query', 'instructions' and 'system' parts, see :func:`load_user_prompts`.
+    model : str
+        Name of the model at the endpoint.
+    endpoint : str
+        API endpoint of the local LLM, e.g. LM Studio or Ollama.
+    preprocessing : str, optional
+        None (Unlimited), 'global-reasoning' or 'chunk-wise'. With 'chunk-wise', the chunks
+        are summarised concurrently and merged, see :func:`map_reduce_minute_notes`.
+    chunk_size : int, optional
+        Number of characters per chunk.
+    max_concurrency : int, optional
+        Number of chunk prompts that are sent to the endpoint at the same time ('chunk-wise' only).
+    progress : callable, optional
+        Called with (n_done, n_total, stage) after every chunk prompt ('chunk-wise' only).
+    cache : DiskCache, optional
+        Response cache. The minute notes are cached by the model, endpoint, settings, prompt
+        and transcript. With 'chunk-wise', the responses per chunk are cached as well.
+    read_cache : bool, optional
+        Use the cached responses. When False, the endpoint is called and the cache is updated.
+
+    Returns
+    -------
+    str
+        Minute notes.
+    """
+    settings, key = _minute_notes_key(context, prompt, model, endpoint, preprocessing, chunk_size, n_ctx)
+    cached = cache.get(key) if cache is not None and read_cache else None
+    if cached is not None:
+        logging.info(f'Minute notes of {model} are loaded from the cache.')
+        return cached['text']
+
+    if preprocessing == 'chunk-wise' and chunk_size:
+        # The responses per chunk are cached by the content of the chunk, not by the chunk size,
+        # so the unchanged chunks of an edited transcript are not sent to the endpoint again.
+        chunk_settings = {name: value for name, value in settings.items() if name not in ('preprocessing', 'chunk_size')}
+        complete_chunk = cached_completion(_local_completion(model, endpoint, n_ctx=n_ctx, verbose=verbose), cache, chunk_settings, read_cache=read_cache)
+        minute_notes = map_reduce_minute_notes(context, prompt, complete_chunk, chunk_size=chunk_size, max_concurrency=max_concurrency, progress=progress)
+    else:
+        overlap = int(0.25 * chunk_size) if isinstance(chunk_size, (int, float)) else None
+        llm = LLMlight(model=model,
+                       retrieval_method='RAG_basic',
+                       embedding=None,
+                       preprocessing=preprocessing,
+                       alpha=None,
+                       temperature=0.8,
+                       top_p=1,
+                       chunks={'method': 'chars', 'size': chunk_size, 'overlap': overlap},
+                       n_ctx=n_ctx,
+                       endpoint=endpoint,
+                       verbose=verbose,
+                       )
+
+        minute_notes = llm.prompt(prompt['query'],
+                                  instructions=prompt['instructions'],
+                                  context=context,
+                                  system=prompt['system'],
+                                  stream=False,
+                                  )
+
+    if cache is not None and isinstance(minute_notes, str) and minute_notes:
+        cache.set(key, {'text': minute_notes})
+    return minute_notes
+
+
+def generate_minute_notes_stream(context, prompt, model, endpoint, n_ctx=16384, stats=None, cache=None, read_cache=True):
+    """Yield the text of the minute notes of a local LLM while they are generated (Unlimited approach).
+
+    The whole transcript is sent in one prompt to the endpoint, see :func:`stream_completion`.
+    The stats are updated with the time to the first token and the tokens per second. The
+    minute notes share the cache with :func:`generate_minute_notes`.
+    """
+    _, key = _minute_notes_key(context, prompt, model, endpoint, None, None, n_ctx)
+    cached = cache.get(key) if cache is not None and read_cache else None
+    if cached is not None:
+        logging.info(f'Minute notes of {model} are loaded from the cache.')
+        yield cached['text']
+        return
+
+    messages = build_messages(prompt['query'], prompt['instructions'], context, prompt['system'])
+    parts = []
+    for token in stream_completion(endpoint, model, messages, temperature=0.8, top_p=1, n_ctx=n_ctx, stats=stats):
+        parts.append(token)
+        yield token
+    if cache is not None and parts:
+        cache.set(key, {'text': ''.join(parts)})
+
+
+def _minute_notes_key(context, prompt, model, endpoint, preprocessing, chunk_size, n_ctx):
+    """Settings that change the minute notes and the cache key of the minute notes."""
+    settings = {'model': model, 'endpoint': endpoint, 'preprocessing': preprocessing, 'chunk_size': chunk_size, 'n_ctx': n_ctx, 'temperature': 0.8, 'top_p': 1}
+    return settings, make_key('minute-notes', settings, prompt, context)
+
+
+def _local_completion(model, endpoint, n_ctx=16384, verbose='info'):
+    """Return complete(query, instructions, context, system) for the local LLM.
+
+    The prompts use the keep-alive connections of the shared HTTP pool, so concurrent chunk prompts reuse the open connections.
+    """
+    def _complete(query, instructions, context, system):
+        # The context is a single chunk, so it is sent as a whole (Unlimited)
+        return complete(endpoint, model, build_messages(query, instructions, context, system), temperature=0.8, top_p=1, n_ctx=n_ctx)
+    return _complete
+
+
+def generate_minute_notes_openai(context, instruction, model, client, stream=False, cache=None, read_cache=True):
+    """Create the minute notes of a transcript with OpenAI. Returns a generator of text chunks when stream=True.
+
+    The minute notes are cached by the model, instruction and transcript when a cache is given.
+    """
+    key = make_key('minute-notes-openai', model, 0, instruction, context)
+    cached = cache.get(key) if cache is not None and read_cache else None
+    if cached is not None:
+        return iter([cached['text']]) if stream else cached['text']
+
+    response = client.chat.completions.create(
+        model=model,
+        temperature=0,
+        messages=[
+            {"role": "system", "content": instruction},
+            {"role": "user", "content": context},
+        ],
+        stream=stream,
+    )
+    if not stream:
+        minute_notes = response.choices[0].message.content
+        if cache is not None and minute_notes:
+            cache.set(key, {'text': minute_notes})
+        return minute_notes
+    return _stream_to_cache(response, cache, key)
+
+
+def _stream_to_cache(response, cache, key):
+    """Yield the text of the streamed chunks and cache the complete text when the stream is finished."""
+    parts = []
+    for chunk in response:
+        text = chunk.choices[0].delta.content if chunk.choices else None
+        if text:
+            parts.append(text)
+            yield text
+    if cache is not None and parts:
+        cache.set(key, {'text': ''.join(parts)})
+
+
+def get_llm_cache():
+    """Return the global cache of the LLM responses in the temp directory, shared by all projects."""
+    cache_dir = os.path.join(st.session_state['temp_dir'], '.cache', 'llm')
+    return DiskCache(cache_dir, max_size_mb=st.session_state['llm_cache_size_mb'])
+
 #%%
 def switch_page_button(page: st.Page, text: str | None = None, button_type: str = 'secondary'):
     """
@@ -51,24 +219,26 @@ def switch_page_button(page: st.Page, text: str | None = None, button_type: str
     if st.button(text or "Volgende", type=button_type):
         st.switch_page(page)
 
-@st.cache_data(persist=True)
-def transcribe_local(audio_path, user_select):
-    # Load model: Can be "tiny", "small", "medium", "large"
-    model = whisper.load_model(user_select).to("cpu")  # Explicitly set CPU
-    # Create transcript
-    transcript = model.transcribe(audio_path)
-    # Return
-    return transcript
+def get_transcript_cache():
+    """Return the global transcript cache in the temp directory, shared by all projects."""
+    cache_dir = os.path.join(st.session_state['temp_dir'], '.cache', 'transcripts')
+    return DiskCache(cache_dir, max_size_mb=st.session_state['transcript_cache_size_mb'])
 
 
-@st.cache_data(persist=True)
-def transcribe_audio_from_path(audio_path) -> str:
-    client = OpenAI(api_key=st.session_state.openai_api_key)
+def get_openai_client(api_key):
+    """Return one shared OpenAI client per API key, with the limits of the HTTP pool. The client is thread-safe.
 
-    with open(audio_path, 'rb') as audio_file:
-        transcription = client.audio.transcriptions.create(model="whisper-1", file=audio_file)
+    Retries are handled by :func:`call_with_retry`, so the built-in retries of the client are disabled.
+    Set OPENAI_BASE_URL to use a local OpenAI-compatible server.
+    """
+    return get_http_pool().openai_client(api_key)
 
-    return transcription.text
+
+def configure_http_pool():
+    """Apply the connection limits and timeouts of the configurations to the shared HTTP pool."""
+    get_http_pool().configure(max_connections=st.session_state['llm_max_connections'],
+                              connect_timeout=st.session_state['llm_connect_timeout'],
+                              read_timeout=st.session_state['llm_read_timeout'])
 
 
 @st.cache_data(persist=True)
@@ -86,7 +256,7 @@ def transcribe_audio_streamlit_object(audio_file: BytesIO) -> str:
     str
         Text transcription of the audio file.
     """
-    client = OpenAI(api_key=st.session_state.openai_api_key)
+    client = get_openai_client(st.session_state.openai_api_key)
 
     transcription = client.audio.transcriptions.create(
         model="whisper-1", file=audio_file
@@ -123,6 +293,22 @@ def init_session_keys(overwrite=False):
     init_session_key("model_names", default_value=["gpt-4o-mini"], overwrite=False)
     init_session_key("model_type", default_value='turbo', overwrite=False)
     init_session_key("save_path", default_value=None, overwrite=False)
+    init_session_key("whisper_memory_budget", default_value=DEFAULT_MEMORY_BUDGET_GB, overwrite=False)
+    init_session_key("transcribe_workers", default_value=1, overwrite=False)
+    init_session_key("torch_threads", default_value=None, overwrite=False)
+    init_session_key("transcript_cache_size_mb", default_value=TRANSCRIPT_CACHE_SIZE_MB, overwrite=False)
+    init_session_key("vad", default_value=True, overwrite=False)
+    init_session_key("openai_concurrency", default_value=4, overwrite=False)
+    init_session_key("openai_rpm", default_value=50, overwrite=False)
+    init_session_key("openai_max_retries", default_value=5, overwrite=False)
+    init_session_key("ingest_workers", default_value=min(4, os.cpu_count() or 1), overwrite=False)
+    init_session_key("artifact_cache_size_mb", default_value=4096, overwrite=False)
+    init_session_key("llm_concurrency", default_value=4, overwrite=False)
+    init_session_key("llm_n_ctx", default_value=16384, overwrite=False)
+    init_session_key("llm_cache_size_mb", default_value=LLM_CACHE_SIZE_MB, overwrite=False)
+    init_session_key("llm_max_connections", default_value=8, overwrite=False)
+    init_session_key("llm_connect_timeout", default_value=10, overwrite=False)
+    init_session_key("llm_read_timeout", default_value=600, overwrite=False)
 
     init_session_key("instruction_name", default_value=None, overwrite=overwrite)
     init_session_key("instruction", default_value=None, overwrite=overwrite)
@@ -133,6 +319,8 @@ def init_session_keys(overwrite=False):
     init_session_key("audio_filepath", default_value=None, overwrite=overwrite)
     init_session_key("audio", default_value=None, overwrite=overwrite)
     init_session_key("minute_notes", overwrite=overwrite)
+    init_session_key("minute_notes_partial", overwrite=overwrite) # Streamed minute notes of a run that did not finish
+    init_session_key("llm_stream_stats", overwrite=overwrite) # Time to first token and tokens/s of the last streamed run
     init_session_key("audio_recording", default_value={}, overwrite=overwrite)
     init_session_key("audio_order", default_value=[], overwrite=overwrite)
     init_session_key("audio_names", default_value=[], overwrite=overwrite)
@@ -143,13 +331,37 @@ def init_session_keys(overwrite=False):
     init_session_key('query', overwrite=overwrite)
     init_session_key('system', overwrite=overwrite)
     init_session_key('context', overwrite=overwrite) # This is the transcript of the audio file
+    init_session_key('segments', default_value=[], overwrite=overwrite) # Timestamped transcript segments
+    init_session_key('transcribe_job', overwrite=overwrite) # Id of the transcription job that is loaded in the session
+    init_session_key('lazy_keys', default_value=[], overwrite=overwrite) # States of the project that are not loaded yet
 
 
-def write_audio_to_disk(audio, filepath):
+def write_audio_to_disk(audio, filepath, chunk_size=1024**2):
+    """Write the uploaded file to disk in chunks, so that no extra copy of the file is made in memory."""
     if filepath is not None:
+        audio.seek(0)
         # Write the uploaded file to the temporary directory
         with open(filepath, "wb") as f:
-            f.write(audio.getbuffer())
+            shutil.copyfileobj(audio, f, chunk_size)
+
+
+def audio_handle(file_path):
+    """File-backed handle of the audio for the session state.
+
+    The session state only keeps the path. ``st.audio`` plays the file from the path, so the
+    memory per session does not grow with the length of the recording.
+    """
+    if file_path is not None and os.path.isfile(file_path):
+        return file_path
+    return None
+
+
+def play_audio(audio, container=st):
+    """Play the audio handle, or the raw bytes of projects that were saved by older versions."""
+    if isinstance(audio, str) and not os.path.isfile(audio):
+        container.warning(f'Audio file not found: {audio}')
+        return
+    container.audio(audio)
 
 
 def file_to_bytesio(file_path):
@@ -169,128 +381,44 @@ def file_to_bytesio(file_path):
         return bytes_io
 
 
-def create_audio_chunks(temp_dir, file_path, segment_time=1800, ext='m4a'):
-    if not file_path:
-        return None
+def get_pcm_path(temp_dir, file_paths):
+    """Path of the decoded 16 kHz samples of the audio file(s).
 
-    # Define output filename pattern for chunks
-    output_pattern = os.path.join(temp_dir, "chunk_%03d.m4a")  # Example: chunk_000.m4a, chunk_001.m4a, ...
-
-    # FFmpeg command to split audio into 30-minute chunks
-    command = [
-        'ffmpeg',
-        '-i', file_path,  # Input file
-        '-f', 'segment',         # Enable segmenting
-        '-segment_time', str(segment_time), # Split into 30-minute chunks
-        '-c', 'copy',            # Keep original codec
-        '-reset_timestamps', '1',
-        '-map', '0',             # Ensure all streams are copied
-        output_pattern           # Output files (chunk_000.m4a, chunk_001.m4a, etc.)
-    ]
-
-    # Run FFmpeg
-    subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-
-    # Get all chunk file paths
-    chunk_files = sorted(Path(temp_dir).glob("chunk_*.m4a"))
-
-    # Convert to a list of file paths as strings
-    chunk_file_paths = [str(chunk) for chunk in chunk_files]
-
-    return chunk_file_paths
-
-def combine_audio_files(audio_files, temp_dir, bitrate, ext='.m4a'):
-    # Define the path for the uploaded audio file
-    # output_file = os.path.join(temp_dir, f'audio_file_stacked_{bitrate}' + '.m4a')
-    output_file = os.path.join(temp_dir, f'audio_file_stacked_{bitrate}' + ext)
-    # file_txt = 'file_list.txt'
-    file_txt = os.path.join(temp_dir, 'file_list.txt')
-    if os.path.isfile(output_file):
-        return output_file
-
-    # Create a temporary text file to list the audio files
-    with open(file_txt, 'w') as f:
-        for file in audio_files:
-            f.write(f"file '{file}'\n")
-
-    # FFmpeg command to combine the files using the concat demuxer
-    command = [
-        'ffmpeg',
-        '-f', 'concat',         # Use the concat demuxer
-        '-safe', '0',           # Allow unsafe file paths (if necessary)
-        '-i', file_txt,         # Input file list
-        '-c', 'copy',           # Copy codecs (no re-encoding)
-        output_file             # Output file
-    ]
-
-    # Run the FFmpeg command
-    subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    # Clean up the temporary file list
-    # os.remove('file_list.txt')
-    return output_file
+    The samples of an artifact are stored next to it, so they are shared and removed with the artifact.
+    """
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    if len(file_paths) == 1 and is_artifact(file_paths[0]):
+        return os.path.splitext(file_paths[0])[0] + '_16k.f32'
+    name = os.path.splitext(os.path.basename(file_paths[0]))[0] if len(file_paths) == 1 else 'audio_stacked'
+    return os.path.join(temp_dir, name + '_16k.f32')
 
 
-# @st.cache_data
-def compress_audio(file_path, bitrate='16k'):
-    #  https://github.com/openai/whisper/discussions/870
-    if file_path is not None:
-        # Check bitrate
-        logging.info('Checking bitrate..')
-        bitrate_int = bitrate_to_kbps(bitrate)
-        curr_bitrate = get_bitrate(file_path)
-        if (curr_bitrate-1000) <= curr_bitrate and (curr_bitrate+1000) >= curr_bitrate:
-            logging.info(f'Current audio file has bitrate within user defined range: {curr_bitrate} <return>')
-            return file_path
-
-        # Command to compress the audio using FFmpeg
-        filename_new = os.path.split(file_path)[1].split('.')[0] + '_compressed_' + f'{bitrate}' + '.' + os.path.split(file_path)[1].split('.')[1]
-        output_file = os.path.join(os.path.split(file_path)[0], filename_new)
-
-        print(f'Start compression audio to {bitrate}..')
-        if not os.path.isfile(output_file):
-            with st.spinner(f"Wait for it... compressing audio.. from {curr_bitrate} to {bitrate_int}"):
-                command = [
-                    'ffmpeg',
-                    '-i', file_path,  # Input file
-                    '-b:a', bitrate,   # Set bitrate (e.g., '16k')
-                    # '-vn',             # Disable video processing
-                    output_file        # Output file
-                ]
-
-                # Run the command
-                subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                # st.write(output_file)
-                # st.write(os.path.getsize(output_file))
-        return output_file
-
-
-def get_bitrate(file_path):
-    """
-    Checks if the audio file has a bitrate higher than the target.
+def combine_audio_files(audio_files, project_path, bitrate, ext='.m4a', n_jobs=1, progress=None, max_size_mb=None):
+    """Combine the audio files into one mono 16 kHz file at the bitrate.
 
-    Args:
-        file_path (str): Path to the audio file.
+    The combined file is an artifact in the temp directory (the parent of project_path),
+    named by the hash of the files, their order and the parameters. It is only reused when
+    nothing changed. The project refers to it, and the artifacts that are not referenced
+    anymore are removed when the store exceeds max_size_mb.
 
-    Returns:
-        int: bitrate
+    The files do not need to be compressed or converted first. With n_jobs > 1 the files are
+    encoded in parallel and progress is called after every file, see :func:`ingest_audio`.
+    The audio stage of the project pipeline is recorded, see :class:`Pipeline`.
     """
-    try:
-        command = [
-            'ffprobe', '-v', 'error',
-            '-select_streams', 'a:0',
-            '-show_entries', 'stream=bit_rate',
-            '-of', 'json',
-            file_path
-        ]
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        info = json.loads(result.stdout)
-        current_bitrate = int(info['streams'][0]['bit_rate'])
-
-        return current_bitrate
-    except Exception as e:
-        print(f"Error checking bitrate: {e}")
-        return None  # Assume compression is required if we can't determine bitrate
+    if not audio_files:
+        return None
+    project_path = os.path.abspath(project_path)
+    store = get_artifact_store(os.path.dirname(project_path), max_size_mb)
+    params = {'bitrate': bitrate, 'sample_rate': SAMPLE_RATE}
+    output_file = store.build('audio', audio_files, params, ext, lambda filepath: ingest_audio(audio_files, filepath, bitrate=bitrate, overwrite=True, n_jobs=n_jobs, progress=progress))
+    store.acquire(project_path, 'audio', output_file)
+    # The transcript and minute notes of other audio are stale
+    Pipeline(project_path).record('audio', params=params, inputs=[file_digest(file_path) for file_path in audio_files], output=os.path.splitext(os.path.basename(output_file))[0])
+    # Intermediates of older versions (once per project) and artifacts that are not used anymore
+    sweep_legacy(project_path, keep=list(audio_files) + [output_file])
+    store.gc()
+    return output_file
 
 
 def convert_wav_to_m4a(wav_filepath, output_directory=None, bitrate='128k', overwrite=False):
@@ -345,13 +473,6 @@ def convert_wav_to_m4a(wav_filepath, output_directory=None, bitrate='128k', over
 
     return m4a_filepath
 
-def bitrate_to_kbps(bitrate_str):
-    """Convert bitrate like '16k' to integer in bits per second."""
-    if bitrate_str.lower().endswith('k'):
-        return int(bitrate_str[:-1]) * 1000
-    return int(bitrate_str)
-
-
 #%% Define API-based Agent
 # class API_LLM:
 #     """ The Agent class.
@@ -395,30 +516,76 @@ def list_subdirectories(dirname):
     if not dirname or not os.path.exists(dirname):
         return []
 
+    # Hidden directories, such as the .cache, are not projects
     subdirs = [name for name in os.listdir(dirname)
-               if os.path.isdir(os.path.join(dirname, name))]
+               if os.path.isdir(os.path.join(dirname, name)) and not name.startswith('.')]
     return subdirs
 
 def set_project_paths(project_name):
     st.session_state["project_name"] = project_name
     st.session_state["project_path"] = os.path.join(st.session_state['temp_dir'], '' if project_name is None else project_name)
-    st.session_state["save_path"] = os.path.join(st.session_state['project_path'], 'session_states.pkl')
+    st.session_state["save_path"] = os.path.join(st.session_state['project_path'], 'session.db')
     if not os.path.exists(st.session_state["project_path"]):
         os.makedirs(st.session_state["project_path"])
 
+def save_project_state(save_path, states, wait=False):
+    """Store the states of a project so that the app can load it from the sidebar.
+
+    Only the states that changed since the last save are written, in the background.
+    Use wait=True to block until the states are on disk. The manifest of the project is
+    updated right away.
+    """
+    update_manifest(os.path.dirname(save_path), states)
+    store = get_session_store(save_path)
+    store.save(states)
+    if wait:
+        store.flush()
+
+
+def load_project_state(save_path, keys=None, exclude=()):
+    """Load the (given) states of a project. Returns an empty dict when the project has no saved states."""
+    return get_session_store(save_path).load(keys, exclude=exclude)
+
+
+def load_project(project_name):
+    """Select a project and load its states, except the large states that are loaded by :func:`ensure_loaded`."""
+    init_session_keys(overwrite=True)
+    set_project_paths(project_name)
+    for key, value in load_project_state(st.session_state["save_path"], exclude=LAZY_KEYS).items():
+        st.session_state[key] = value
+    st.session_state['lazy_keys'] = list(LAZY_KEYS)
+
+
+def ensure_loaded(*keys):
+    """Load the states of the project that are not loaded yet, the first time a page needs them."""
+    pending = [key for key in keys if key in st.session_state['lazy_keys']]
+    if not pending:
+        return
+    states = load_project_state(st.session_state["save_path"], keys=pending)
+    for key in pending:
+        if key in states:
+            st.session_state[key] = states[key]
+    st.session_state['lazy_keys'] = [key for key in st.session_state['lazy_keys'] if key not in pending]
+
+
+def project_has(key):
+    """The project has a value for the state. Uses the manifest for the states that are not loaded yet."""
+    if key in st.session_state['lazy_keys']:
+        return read_manifest(st.session_state['project_path']).get('has', {}).get(key, False)
+    return bool(st.session_state.get(key))
+
+
 def save_session(save_audio=True):
-    if save_audio:
-        filtered_states = {k: v for k, v in st.session_state.items() if k not in ('demo')}
-        pypickle.save(st.session_state["save_path"], filtered_states, overwrite=True)
-    else:
-        filtered_states = {k: v for k, v in st.session_state.items() if k not in ('audio')}
-        pypickle.save(st.session_state["save_path"], filtered_states, overwrite=True)
+    # States that are not loaded are unchanged on disk
+    exclude = ['lazy_keys'] + st.session_state['lazy_keys'] + (['demo'] if save_audio else ['audio'])
+    filtered_states = {k: v for k, v in st.session_state.items() if k not in exclude}
+    save_project_state(st.session_state["save_path"], filtered_states)
     st.success('✅ Completed and session is saved!')
 
 
 #%%
 @st.cache_data
-def load_user_prompts(path="./nota_bene/user_prompts", getfiles=None):
+def load_user_prompts(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "user_prompts"), getfiles=None):
     # getfiles='minute_notes.txt'
     # getfiles = ['minute_notes.txt', 'heisessie.txt']
 
@@ -0,0 +1,106 @@
+"""
+Parallel transcription of audio chunks in a pool of worker processes.
+
+Each worker process loads the Whisper model once in its initializer and then
+transcribes the chunks that are submitted to it. The chunks are independent, so
+the speedup is close to linear as long as ``n_workers * torch_threads`` does not
+exceed the number of cores.
+"""
+
+import os
+import logging
+import multiprocessing
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+
+from nota_bene.cache import DiskCache
+from nota_bene.model_pool import get_model_pool
+from nota_bene.transcription import transcribe_whisper, get_cached_transcript, submit_as_completed
+
+logger = logging.getLogger(__name__)
+
+# Model of the worker process, set by the initializer.
+_WORKER = {}
+
+
+#%%
+def default_torch_threads(n_workers):
+    """Divide the cores over the workers."""
+    return max(1, (os.cpu_count() or 1) // max(1, n_workers))
+
+
+def _init_worker(model_name, device, torch_threads, cache_dir, cache_size_mb, read_cache):
+    """Initialize the worker process: limit the torch threads and preload the model."""
+    import torch
+    torch.set_num_threads(torch_threads)
+    _WORKER['model_name'] = model_name
+    _WORKER['device'] = device
+    _WORKER['cache'] = DiskCache(cache_dir, max_size_mb=cache_size_mb) if cache_dir else None
+    _WORKER['read_cache'] = read_cache
+    # Preload the model so that the first chunk does not pay for it
+    get_model_pool().get(model_name, device=device)
+
+
+def _transcribe_chunk(index, audio):
+    transcript = transcribe_whisper(audio, _WORKER['model_name'], device=_WORKER['device'], cache=_WORKER['cache'], read_cache=_WORKER['read_cache'])
+    return index, transcript, transcript['duration']
+
+
+#%%
+def transcribe_chunks_parallel(audio_chunks, model_name, n_workers=2, torch_threads=None, device='cpu', cache=None, read_cache=True):
+    """Transcribe the audio chunks in a pool of worker processes.
+
+    Parameters
+    ----------
+    audio_chunks : iterable
+        (index, audio) tuples of the chunks to transcribe. The audio is a PCMSlice, so only
+        the reference is sent to the worker which memory-maps the decoded recording itself.
+        Can be a generator that is still producing chunks. The next chunk is only taken when a worker is free.
+    model_name : str
+        Name of the Whisper model, e.g. "small" or "large".
+    n_workers : int, optional
+        Number of worker processes. Every worker holds its own copy of the model.
+    torch_threads : int, optional
+        Number of torch threads per worker. Defaults to the number of cores divided by the workers.
+    device : str, optional
+        Device to run the model on.
+    cache : DiskCache, optional
+        Transcript cache that is shared with the workers.
+    read_cache : bool, optional
+        Return cached transcripts when available. Cached chunks are returned without starting the workers.
+
+    Yields
+    ------
+    tuple
+        (index, transcript, duration) in order of completion. Use the index to reassemble the chunks.
+    """
+    n_workers = max(1, n_workers)
+    if torch_threads is None:
+        torch_threads = default_torch_threads(n_workers)
+
+    def _uncached(audio_chunks):
+        # Only send the chunks to the workers that are not transcribed yet
+        for index, audio in audio_chunks:
+            transcript = get_cached_transcript(audio, model_name, cache) if read_cache else None
+            if transcript is None:
+                yield index, audio
+            else:
+                cached.append((index, transcript, transcript['duration']))
+
+    cached = []
+    audio_chunks = _uncached(audio_chunks)
+    # Start the pool at the first chunk that must be transcribed
+    for index, audio in audio_chunks:
+        yield from cached
+        cached.clear()
+
+        logger.info(f'Transcribing with {n_workers} workers x {torch_threads} torch threads.')
+        # Spawn instead of fork: the parent process runs streamlit and torch threads which do not survive a fork.
+        mp_context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context, initializer=_init_worker, initargs=(model_name, device, torch_threads, cache.cache_dir if cache else None, cache.max_size_mb if cache else None, read_cache)) as executor:
+            for result in submit_as_completed(executor, _transcribe_chunk, chain([(index, audio)], audio_chunks), max_pending=n_workers):
+                yield from cached
+                cached.clear()
+                yield result
+        break
+    yield from cached
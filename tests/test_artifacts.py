@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the content-addressed store of the intermediate audio files."""
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from nota_bene import artifacts
+from nota_bene.artifacts import ArtifactStore, sweep_legacy, LEGACY_MARKER
+
+
+def _write(filepath, size=1024):
+    with open(filepath, 'wb') as f:
+        f.write(b'\x00' * size)
+    return filepath
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifacts, 'GRACE_SECONDS', 0)
+    return ArtifactStore(str(tmp_path), max_size_mb=0)
+
+
+def test_build_once(store, tmp_path):
+    inputs = [_write(tmp_path / 'a.wav'), _write(tmp_path / 'b.wav', 2048)]
+    built = []
+    builder = lambda filepath: built.append(filepath) or _write(filepath)
+    path = store.build('audio', inputs, {'bitrate': '24k'}, '.m4a', builder)
+    assert store.build('audio', inputs, {'bitrate': '24k'}, '.m4a', builder) == path
+    assert len(built) == 1
+    # Another order or other parameters are another artifact
+    assert store.build('audio', inputs[::-1], {'bitrate': '24k'}, '.m4a', builder) != path
+    assert store.build('audio', inputs, {'bitrate': '32k'}, '.m4a', builder) != path
+    assert len(built) == 3
+
+
+def test_gc_keeps_referenced(store, tmp_path):
+    project_path = str(tmp_path / 'project')
+    os.makedirs(project_path)
+    inputs = [_write(tmp_path / 'a.wav')]
+    used = store.build('audio', inputs, {}, '.m4a', _write)
+    # A derived file of the same artifact
+    _write(used[:-len('.m4a')] + '_16k.f32')
+    unused = store.build('audio', inputs, {'bitrate': '32k'}, '.m4a', _write)
+    store.acquire(project_path, 'audio', used)
+
+    assert store.gc() == 1
+    assert os.path.isfile(used) and os.path.isfile(used[:-len('.m4a')] + '_16k.f32')
+    assert not os.path.isfile(unused)
+    assert store.stats()['referenced'] == 1
+
+    store.release(project_path, 'audio')
+    assert store.gc() == 1
+    assert store.entries() == []
+
+
+def test_references_of_deleted_projects_are_dropped(store, tmp_path):
+    project_path = str(tmp_path / 'project')
+    os.makedirs(project_path)
+    path = store.build('audio', [_write(tmp_path / 'a.wav')], {}, '.m4a', _write)
+    store.acquire(project_path, 'audio', path)
+    os.rmdir(project_path)
+    assert store.gc() == 1
+    assert store.refs() == {}
+
+
+def _acquire_all(temp_dir, owners, filepath):
+    store = ArtifactStore(temp_dir)
+    for owner in owners:
+        store.acquire(owner, 'audio', filepath)
+
+
+def test_acquire_from_processes(store, tmp_path):
+    path = store.build('audio', [_write(tmp_path / 'a.wav')], {}, '.m4a', _write)
+    owners = [str(tmp_path / f'project_{i}') for i in range(40)]
+    for owner in owners:
+        os.makedirs(owner)
+    # Like the projects of 'notabene batch --jobs 4'
+    with ProcessPoolExecutor(max_workers=4, mp_context=multiprocessing.get_context('spawn')) as executor:
+        list(executor.map(_acquire_all, [str(tmp_path)] * 4, [owners[i::4] for i in range(4)], [path] * 4))
+    assert sorted(store.refs()) == sorted(owners)
+
+
+def test_sweep_legacy(tmp_path):
+    for filename in ('chunk_000.m4a', 'chunk_001.m4a', 'audio_file_stacked_24k.m4a', 'audio_0_compressed_24k.m4a',
+                     'chunk_final.m4a', 'interview.m4a', 'audio_file_stacked_24k.mp3'):
+        _write(tmp_path / filename)
+    assert sweep_legacy(str(tmp_path), keep=[str(tmp_path / 'audio_file_stacked_24k.mp3')]) == 4
+    assert sorted(os.listdir(tmp_path)) == sorted([LEGACY_MARKER, 'chunk_final.m4a', 'interview.m4a', 'audio_file_stacked_24k.mp3'])
+    # Only once per project
+    _write(tmp_path / 'chunk_002.m4a')
+    assert sweep_legacy(str(tmp_path)) == 0
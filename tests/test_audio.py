@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the decoded audio buffers and the chunk boundaries."""
+
+import os
+import json
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from nota_bene import audio
+from nota_bene.audio import (SAMPLE_RATE, PCMSlice, pcm_slices, vad_slices, stream_pcm_slices, plan_transcode,
+                             bitrate_to_bps, probe_audio, set_probe_cache_dir, _StreamSegmenter)
+
+
+@pytest.fixture
+def pcm_path(tmp_path):
+    """Two minutes of 7 seconds of speech (a tone) followed by 3 seconds of silence."""
+    rng = np.random.default_rng(0)
+    t = np.arange(7 * SAMPLE_RATE) / SAMPLE_RATE
+    speech = 0.3 * np.sin(2 * np.pi * 220 * t)
+    silence = 1e-4 * rng.standard_normal(3 * SAMPLE_RATE)
+    samples = np.concatenate([np.concatenate([speech, silence]) for _ in range(12)]).astype(np.float32)
+    # The source is older than the decoded file, so the decoded file is up to date
+    open(tmp_path / 'audio.m4a', 'wb').close()
+    path = tmp_path / 'audio_16k.f32'
+    samples.tofile(path)
+    return str(path)
+
+
+def _bounds(slices):
+    return [(pcm_slice.start, pcm_slice.end, pcm_slice.regions) for pcm_slice in slices]
+
+
+def _feed(segmenter, n_samples, block_time=5):
+    """Feed the samples to the segmenter as if they were decoded in blocks."""
+    slices = []
+    block = block_time * SAMPLE_RATE
+    for n in range(block, n_samples, block):
+        slices += segmenter.feed(n)
+    return slices + segmenter.feed(n_samples, final=True)
+
+
+def test_pcm_slices(pcm_path):
+    slices = pcm_slices(pcm_path, segment_time=50)
+    assert [(s.start, s.end) for s in slices] == [(0, 50 * SAMPLE_RATE), (50 * SAMPLE_RATE, 100 * SAMPLE_RATE), (100 * SAMPLE_RATE, 120 * SAMPLE_RATE)]
+    assert slices[1].offset == 50
+    assert len(slices[2].load()) == 20 * SAMPLE_RATE
+
+
+def test_to_timeline():
+    pcm_slice = PCMSlice('audio.f32', 0, 10 * SAMPLE_RATE, ((0, SAMPLE_RATE), (5 * SAMPLE_RATE, 10 * SAMPLE_RATE)))
+    assert pcm_slice.seconds == 6
+    assert pcm_slice.to_timeline(0.5) == 0.5
+    # After the dropped silence
+    assert pcm_slice.to_timeline(2) == 6
+
+
+def test_vad_slices_drop_silences(pcm_path):
+    slices = vad_slices(pcm_path, segment_time=10, search_time=2)
+    assert len(slices) == 12
+    for i, pcm_slice in enumerate(slices):
+        # One region of speech with some padding, without the silence
+        assert pcm_slice.start <= i * 10 * SAMPLE_RATE
+        assert 7 <= pcm_slice.seconds < 8
+        assert pcm_slice.end <= (i * 10 + 8) * SAMPLE_RATE
+
+
+def test_stream_segmenter_matches_vad_slices(pcm_path):
+    n_samples = os.path.getsize(pcm_path) // 4
+    segmenter = _StreamSegmenter(pcm_path, segment_time=10, vad=True, search_time=2)
+    streamed = _feed(segmenter, n_samples)
+    assert _bounds(streamed) == _bounds(vad_slices(pcm_path, segment_time=10, search_time=2))
+
+
+def test_stream_segmenter_matches_pcm_slices(pcm_path):
+    n_samples = os.path.getsize(pcm_path) // 4
+    segmenter = _StreamSegmenter(pcm_path, segment_time=50)
+    assert _bounds(_feed(segmenter, n_samples)) == _bounds(pcm_slices(pcm_path, segment_time=50))
+
+
+def test_stream_segmenter_known_slices(pcm_path):
+    n_samples = os.path.getsize(pcm_path) // 4
+    # Boundaries of an earlier run that differ from a new segmentation
+    known = [PCMSlice(pcm_path, 0, 33 * SAMPLE_RATE), PCMSlice(pcm_path, 33 * SAMPLE_RATE, 61 * SAMPLE_RATE)]
+    segmenter = _StreamSegmenter(pcm_path, segment_time=50, known_slices=known)
+    slices = _feed(segmenter, n_samples)
+    assert slices[:2] == known
+    assert _bounds(slices[2:]) == _bounds(pcm_slices(pcm_path, segment_time=50, start=61 * SAMPLE_RATE))
+
+
+def test_stream_pcm_slices_known_slices(pcm_path):
+    audio_path = os.path.join(os.path.dirname(pcm_path), 'audio.m4a')
+    known = [(0, 33 * SAMPLE_RATE, []), (33 * SAMPLE_RATE, 61 * SAMPLE_RATE, [])]
+    slices = list(stream_pcm_slices(audio_path, pcm_path, segment_time=50, known_slices=known))
+    assert [(s.start, s.end) for s in slices] == [(0, 33 * SAMPLE_RATE), (33 * SAMPLE_RATE, 61 * SAMPLE_RATE), (61 * SAMPLE_RATE, 111 * SAMPLE_RATE), (111 * SAMPLE_RATE, 120 * SAMPLE_RATE)]
+
+
+def _probe(**kwargs):
+    probe = {'codec': 'aac', 'sample_rate': SAMPLE_RATE, 'channels': 1, 'bitrate': 24000, 'duration': 60.0, 'format': 'mov,mp4,m4a,3gp,3g2,mj2'}
+    return {**probe, **kwargs}
+
+
+def test_plan_transcode():
+    assert plan_transcode(_probe()) == 'copy'
+    # AAC in another container only needs a remux
+    assert plan_transcode(_probe(format='adts')) == 'remux'
+    assert plan_transcode(_probe(codec='mp3', format='mp3')) == 'transcode'
+    assert plan_transcode(_probe(channels=2)) == 'transcode'
+    assert plan_transcode(_probe(sample_rate=44100)) == 'transcode'
+    assert plan_transcode(_probe(bitrate=None)) == 'transcode'
+    assert plan_transcode(None) == 'transcode'
+
+
+def test_plan_transcode_bitrate_tolerance():
+    assert plan_transcode(_probe(bitrate=16000), bitrate='24k') == 'copy'
+    # Within 10% of the target bitrate
+    assert plan_transcode(_probe(bitrate=26000), bitrate='24k') == 'copy'
+    assert plan_transcode(_probe(bitrate=27000), bitrate='24k') == 'transcode'
+    assert plan_transcode(_probe(bitrate=27000), bitrate='24k', tolerance=0.2) == 'copy'
+    assert bitrate_to_bps('24k') == 24000
+
+
+def test_probe_cache(tmp_path, monkeypatch):
+    calls = []
+
+    def run(command, **kwargs):
+        calls.append(command)
+        info = {'streams': [{'codec_name': 'aac', 'sample_rate': '16000', 'channels': 1, 'bit_rate': '24000'}],
+                'format': {'duration': '60.0', 'format_name': 'mov,mp4,m4a,3gp,3g2,mj2'}}
+        return subprocess.CompletedProcess(command, 0, stdout=json.dumps(info), stderr='')
+
+    monkeypatch.setattr(audio.subprocess, 'run', run)
+    monkeypatch.setattr(audio, '_PROBES', OrderedDict())
+    monkeypatch.setattr(audio, 'MAX_PROBES', 2)
+    # Restored after the test
+    monkeypatch.setattr(audio, '_PROBE_CACHE_DIR', audio._PROBE_CACHE_DIR)
+    set_probe_cache_dir(str(tmp_path))
+    file_paths = []
+    for i in range(3):
+        file_paths.append(str(tmp_path / f'audio_{i}.m4a'))
+        open(file_paths[-1], 'wb').close()
+
+    assert probe_audio(file_paths[0]) == probe_audio(file_paths[0]) == _probe(bitrate=24000)
+    assert len(calls) == 1
+    # The probes are kept in the temp directory of the app
+    assert os.path.isdir(tmp_path / '.cache' / 'probes')
+
+    for file_path in file_paths:
+        probe_audio(file_path)
+    assert len(audio._PROBES) == 2
+    # The probe that dropped out of memory is read from disk
+    audio._PROBES.clear()
+    probe_audio(file_paths[0])
+    assert len(calls) == 3
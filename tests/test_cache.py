@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the content-addressed disk cache."""
+
+import os
+
+from nota_bene.cache import DiskCache, make_key
+
+
+def test_make_key():
+    assert make_key('ab', 'c') != make_key('a', 'bc')
+    assert make_key({'a': 1, 'b': 2}) == make_key({'b': 2, 'a': 1})
+
+
+def test_get_set(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    key = make_key('audio', 'small')
+    assert cache.get(key) is None
+    cache.set(key, {'text': 'hello'})
+    assert key in cache
+    assert cache.get(key) == {'text': 'hello'}
+    cache.delete(key)
+    assert key not in cache
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path), max_size_mb=0.01)
+    keys = [make_key(i) for i in range(8)]
+    for i, key in enumerate(keys):
+        cache.set(key, 'x' * 1000)
+        # Distinct access times, oldest first
+        os.utime(cache._path(key), (1000 + i, 1000 + i))
+    # The oldest entry is used again
+    assert cache.get(keys[0]) is not None
+
+    for i in range(8, 16):
+        cache.set(make_key(i), 'x' * 1000)
+    assert cache.size() <= cache.max_size_mb * 1024**2
+    assert keys[0] in cache
+    assert keys[1] not in cache
+
+
+def test_stats(tmp_path):
+    cache = DiskCache(str(tmp_path), max_size_mb=0.01)
+    cache.set('a' * 64, 1)
+    cache.get('a' * 64)
+    cache.get('b' * 64)
+    cache.get('c' * 64)
+    for i in range(20):
+        cache.set(make_key(i), 'x' * 1000)
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['evictions'] > 0
+    assert stats['entries'] == len(cache.entries())
+    # The counts are written to disk, so another cache of the directory sees them
+    assert DiskCache(str(tmp_path)).stats()['hits'] == 1
+
+    cache.clear()
+    assert cache.stats()['hits'] == 0
+    assert cache.stats()['entries'] == 0
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the headless batch mode."""
+
+import os
+
+import pytest
+
+from nota_bene.cache import TRANSCRIPT_CACHE_SIZE_MB, LLM_CACHE_SIZE_MB
+from nota_bene.cli import parse_args, find_projects, _llm_strategy
+
+PROMPT = {'query': 'Write the minute notes.', 'instructions': 'Be brief.', 'system': 'You are a secretary.'}
+
+
+def _touch(*parts):
+    filepath = os.path.join(*parts)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    open(filepath, 'wb').close()
+    return filepath
+
+
+def _transcript(n_turns):
+    return '\n'.join(f'Speaker {i % 3}: We discussed item {i} of the budget, and agreed on the next steps.' for i in range(n_turns))
+
+
+def test_parse_args():
+    args = parse_args(['batch', '/data/meetings', '--jobs', '4'])
+    assert args.command == 'batch'
+    assert args.inputs == ['/data/meetings']
+    assert args.jobs == 4
+    # The same cache sizes as the app
+    assert (args.transcript_cache_mb, args.llm_cache_mb) == (TRANSCRIPT_CACHE_SIZE_MB, LLM_CACHE_SIZE_MB)
+
+
+def test_find_projects_directory(tmp_path):
+    files = [_touch(tmp_path, 'meeting', name) for name in ('part_2.mp3', 'part_1.M4A')]
+    _touch(tmp_path, 'meeting', 'notes.txt')
+    assert find_projects([str(tmp_path / 'meeting')]) == {'meeting': sorted(files)}
+
+
+def test_find_projects_nested(tmp_path):
+    monday = _touch(tmp_path, 'meetings', 'monday', 'audio.wav')
+    tuesday = _touch(tmp_path, 'meetings', 'tuesday', 'audio.m4a')
+    os.makedirs(tmp_path / 'meetings' / 'empty')
+    # Only one level deeper
+    _touch(tmp_path, 'meetings', 'archive', '2024', 'audio.m4a')
+    assert find_projects([str(tmp_path / 'meetings')]) == {'monday': [monday], 'tuesday': [tuesday]}
+
+
+def test_find_projects_glob(tmp_path):
+    files = [_touch(tmp_path, name) for name in ('standup.m4a', 'review.mp3', 'slides.pdf')]
+    assert find_projects([str(tmp_path / '*')]) == {'review': [files[1]], 'standup': [files[0]]}
+    assert find_projects([str(tmp_path / '*.m4a'), str(tmp_path / 'missing')]) == {'standup': [files[0]]}
+
+
+@pytest.mark.parametrize('preprocessing', ['auto', 'unlimited', 'chunk-wise'])
+def test_llm_strategy_short_transcript(preprocessing):
+    args = parse_args(['batch', 'x', '--n-ctx', '16384', '--preprocessing', preprocessing])
+    preprocessing, chunk_size = _llm_strategy(_transcript(20), PROMPT, args)
+    if args.preprocessing == 'chunk-wise':
+        assert preprocessing == 'chunk-wise'
+        assert chunk_size > 0
+    else:
+        assert (preprocessing, chunk_size) == (None, None)
+
+
+def test_llm_strategy_long_transcript():
+    context = _transcript(2000)
+    preprocessing, chunk_size = _llm_strategy(context, PROMPT, parse_args(['batch', 'x', '--n-ctx', '4096']))
+    assert preprocessing == 'chunk-wise'
+    assert 0 < chunk_size < len(context)
+    # Unlimited on request, also when it does not fit
+    assert _llm_strategy(context, PROMPT, parse_args(['batch', 'x', '--n-ctx', '4096', '--preprocessing', 'unlimited'])) == (None, None)
+    assert _llm_strategy(context, PROMPT, parse_args(['batch', 'x', '--n-ctx', '4096', '--preprocessing', 'global-reasoning']))[0] == 'global-reasoning'
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the cached exports of the minute notes."""
+
+import threading
+
+import pytest
+
+from nota_bene import exports
+from nota_bene.exports import ExportCache
+
+
+class Renderer:
+    """Records the renders instead of rendering a PDF. The renders wait until they are released."""
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def __call__(self, notes):
+        self.release.wait(timeout=10)
+        self.calls.append(notes)
+        if notes == 'broken':
+            raise ValueError('Can not render')
+        return notes.encode('utf-8')
+
+
+@pytest.fixture
+def renderer(monkeypatch):
+    renderer = Renderer()
+    monkeypatch.setitem(exports.RENDERERS, 'pdf', renderer)
+    return renderer
+
+
+def test_render_once_per_version(renderer):
+    cache = ExportCache()
+    cache.prepare('pdf', '# Notes')
+    # Not ready while it is rendered
+    assert cache.get('pdf', '# Notes') is None
+    renderer.release.set()
+    assert cache.result('pdf', '# Notes') == b'# Notes'
+    assert cache.get('pdf', '# Notes') == b'# Notes'
+    cache.prepare('pdf', '# Notes')
+    assert cache.result('pdf', '# Notes') == b'# Notes'
+    assert renderer.calls == ['# Notes']
+
+    # An edit is another version
+    assert cache.result('pdf', '# Notes!') == b'# Notes!'
+    assert renderer.calls == ['# Notes', '# Notes!']
+
+
+def test_failed_render(renderer):
+    renderer.release.set()
+    cache = ExportCache()
+    with pytest.raises(ValueError):
+        cache.result('pdf', 'broken')
+    assert cache.get('pdf', 'broken') is None
+    # The failure is not rendered again on every rerun, only when asked for
+    cache.prepare('pdf', 'broken')
+    assert renderer.calls == ['broken']
+    with pytest.raises(ValueError):
+        cache.result('pdf', 'broken')
+    assert renderer.calls == ['broken', 'broken']
+
+
+def test_max_exports(renderer):
+    renderer.release.set()
+    cache = ExportCache(max_exports=2)
+    for notes in ('a', 'b', 'c'):
+        cache.result('pdf', notes)
+    assert cache.get('pdf', 'a') is None
+    assert cache.get('pdf', 'c') == b'c'
+    cache.result('pdf', 'a')
+    assert renderer.calls == ['a', 'b', 'c', 'a']
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the shared keep-alive HTTP connections."""
+
+import pytest
+
+pytest.importorskip('requests')
+
+from nota_bene.http_pool import HttpPool
+
+
+def test_session_per_endpoint():
+    pool = HttpPool(max_connections=2)
+    session = pool.session('http://localhost:11434/api/generate')
+    assert pool.session('http://localhost:11434/api/chat') is session
+    assert pool.session('http://localhost:1234/v1/chat/completions') is not session
+    assert session.get_adapter('http://localhost:11434')._pool_maxsize == 2
+
+
+def test_configure_keeps_running_sessions():
+    pool = HttpPool(max_connections=2)
+    session = pool.session('http://localhost:11434/api/generate')
+    closed = []
+    session.close = lambda: closed.append(session)
+
+    pool.configure(max_connections=2)
+    assert pool.session('http://localhost:11434/api/generate') is session
+
+    pool.configure(max_connections=4, read_timeout=60)
+    new_session = pool.session('http://localhost:11434/api/generate')
+    assert new_session is not session
+    assert new_session.get_adapter('http://localhost:11434')._pool_maxsize == 4
+    assert pool.timeout == (pool.connect_timeout, 60)
+    # A request that is running on the old session finishes on its connection
+    assert closed == []
+
+    pool.close()
+    assert closed == []
+    assert pool.session('http://localhost:11434/api/generate') is not new_session
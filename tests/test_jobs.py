@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the background transcription jobs."""
+
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('openai')
+
+from nota_bene import jobs
+from nota_bene.audio import SAMPLE_RATE
+from nota_bene.jobs import JobRunner, DONE, FAILED, CANCELLED, job_result
+
+
+@pytest.fixture
+def project_path(tmp_path):
+    """Project with two minutes of decoded audio."""
+    open(tmp_path / 'audio.m4a', 'wb').close()
+    np.zeros(120 * SAMPLE_RATE, dtype=np.float32).tofile(tmp_path / 'audio_16k.f32')
+    return str(tmp_path)
+
+
+def _params(project_path, segment_time=50):
+    return {
+        'audio_filepath': f'{project_path}/audio.m4a',
+        'pcm_path': f'{project_path}/audio_16k.f32',
+        'segment_time': segment_time,
+        'vad': False,
+    }
+
+
+def _wait(runner, project_path):
+    runner._running[project_path]['thread'].join(timeout=10)
+
+
+def test_resume_skips_finished_chunks(project_path, monkeypatch):
+    transcribed = []
+
+    def transcription_results(chunk_stream, params, cache=None, api_key=None, fail_at=None):
+        for index, chunk in chunk_stream:
+            if index == fail_at:
+                raise RuntimeError('Crash')
+            transcribed.append(index)
+            yield index, {'text': f'chunk {index}', 'segments': [{'start': 0, 'end': 1, 'text': 'x'}]}, 0.1
+
+    monkeypatch.setattr(jobs, 'probe_duration', lambda file_path: 120)
+    monkeypatch.setattr(jobs, 'transcription_results', lambda *args, **kwargs: transcription_results(*args, **kwargs, fail_at=2))
+    runner = JobRunner()
+    job_id = runner.submit(project_path, _params(project_path))
+    _wait(runner, project_path)
+    job = runner.latest(project_path)
+    assert job['status'] == FAILED
+    assert sorted(job['chunks']) == ['0', '1']
+    assert transcribed == [0, 1]
+
+    # Another segmentation would cut the audio at other points; the stored boundaries are used
+    runner.table(project_path).update(job_id, params={**job['params'], 'segment_time': 40})
+    monkeypatch.setattr(jobs, 'transcription_results', transcription_results)
+    runner.resume(project_path, job_id)
+    _wait(runner, project_path)
+    job = runner.latest(project_path)
+    assert job['status'] == DONE
+    assert transcribed == [0, 1, 2]
+    assert [(chunk['start'], chunk['end']) for _, chunk in sorted(job['chunks'].items())] == [(0, 50 * SAMPLE_RATE), (50 * SAMPLE_RATE, 100 * SAMPLE_RATE), (100 * SAMPLE_RATE, 120 * SAMPLE_RATE)]
+    assert job_result(job)['context'] == 'chunk 0 chunk 1 chunk 2'
+    # Timestamps relative to the recording
+    assert job_result(job)['segments'][1]['start'] == 50
+
+
+def test_one_job_per_project(project_path, monkeypatch):
+    release = threading.Event()
+
+    def transcription_results(chunk_stream, params, cache=None, api_key=None):
+        release.wait(timeout=10)
+        return
+        yield
+
+    monkeypatch.setattr(jobs, 'probe_duration', lambda file_path: 120)
+    monkeypatch.setattr(jobs, 'transcription_results', transcription_results)
+    runner = JobRunner()
+    runner.submit(project_path, _params(project_path))
+    with pytest.raises(RuntimeError):
+        runner.submit(project_path, _params(project_path))
+    release.set()
+    _wait(runner, project_path)
+
+    # The finished job does not block a new one
+    runner.submit(project_path, _params(project_path))
+    _wait(runner, project_path)
+    assert runner.latest(project_path)['status'] == DONE
+
+
+class FakeOpenAI:
+    """OpenAI client of which the uploads wait until they are released."""
+    def __init__(self):
+        self.uploads = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+        self.audio = self
+        self.transcriptions = self
+
+    def create(self, model, file):
+        with self._lock:
+            self.uploads += 1
+        self.started.set()
+        self.release.wait(timeout=10)
+        return type('Transcription', (), {'text': 'chunk'})()
+
+    def openai_client(self, api_key):
+        return self
+
+
+def test_cancel_pooled_job(project_path, monkeypatch):
+    client = FakeOpenAI()
+    monkeypatch.setattr(jobs, 'probe_duration', lambda file_path: 120)
+    monkeypatch.setattr(jobs, 'get_http_pool', lambda: client)
+    params = {**_params(project_path, segment_time=10), 'model_type': 'OpenAI', 'openai_concurrency': 4, 'openai_rpm': 6000}
+    runner = JobRunner()
+    job_id = runner.submit(project_path, params)
+    assert client.started.wait(timeout=10)
+    runner.cancel(project_path, job_id)
+    client.release.set()
+    _wait(runner, project_path)
+
+    job = runner.latest(project_path)
+    assert job['status'] == CANCELLED
+    # Only the uploads that were running when the job was cancelled, and they are stored
+    assert client.uploads <= 4
+    assert len(job['chunks']) == client.uploads
+
+    runner.resume(project_path, job_id)
+    _wait(runner, project_path)
+    assert runner.latest(project_path)['status'] == DONE
+    assert len(runner.latest(project_path)['chunks']) == 12
+    assert client.uploads == 12
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the streaming responses of local LLM endpoints."""
+
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+pytest.importorskip('requests')
+
+from nota_bene.local_llm import StreamStats, stream_completion, build_messages, endpoint_kind, checkpointed, _parse_line
+
+
+def test_endpoint_kind():
+    assert endpoint_kind('http://localhost:11434/api/generate') == 'ollama-generate'
+    assert endpoint_kind('http://localhost:11434/api/chat/') == 'ollama-chat'
+    assert endpoint_kind('http://localhost:1234/v1/chat/completions') == 'openai'
+
+
+def test_parse_line_sse():
+    assert _parse_line('openai', '') == (None, False, None)
+    assert _parse_line('openai', ': keep-alive') == (None, False, None)
+    assert _parse_line('openai', 'data: {"choices": [{"delta": {"content": "Hello"}}]}') == ('Hello', False, None)
+    assert _parse_line('openai', 'data: {"choices": [], "usage": {"completion_tokens": 12}}') == (None, False, 12)
+    assert _parse_line('openai', 'data: [DONE]') == (None, True, None)
+
+
+def test_parse_line_ndjson():
+    assert _parse_line('ollama-generate', '{"response": "Hello", "done": false}') == ('Hello', False, None)
+    assert _parse_line('ollama-chat', '{"message": {"content": " world"}, "done": false}') == (' world', False, None)
+    assert _parse_line('ollama-chat', '{"message": {"content": ""}, "done": true, "eval_count": 7}') == ('', True, 7)
+    with pytest.raises(RuntimeError):
+        _parse_line('ollama-generate', '{"error": "model not found"}')
+
+
+def test_checkpointed():
+    checkpoints = []
+    tokens = list(checkpointed(iter(['Hello', ' ', 'world']), checkpoints.append, interval=0))
+    assert tokens == ['Hello', ' ', 'world']
+    assert checkpoints[-1] == 'Hello world'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson' if self.path == '/api/generate' else 'text/event-stream')
+        self.end_headers()
+        if self.path == '/api/generate':
+            lines = [json.dumps({'response': token, 'done': False}, ensure_ascii=False) for token in ('Hello', ' café')]
+            lines.append(json.dumps({'response': '', 'done': True, 'eval_count': 2}))
+        else:
+            lines = [f'data: {json.dumps({"choices": [{"delta": {"content": token}}]}, ensure_ascii=False)}\n' for token in ('Hello', ' café')]
+            lines.append('data: [DONE]\n')
+        assert payload['stream'] is True
+        for line in lines:
+            self.wfile.write((line + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = HTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('path', ['/api/generate', '/v1/chat/completions'])
+def test_stream_completion(server, path):
+    stats = StreamStats()
+    messages = build_messages('Write the minute notes.', 'Be brief.', 'Hello world', 'You are a secretary.')
+    tokens = list(stream_completion(server + path, 'llama', messages, stats=stats))
+    assert tokens == ['Hello', ' café']
+    assert stats.as_dict()['tokens'] == 2
+    assert stats.time_to_first_token is not None
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the pool of loaded Whisper models."""
+
+import time
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from nota_bene import model_pool
+from nota_bene.model_pool import WhisperModelPool, get_model_pool
+
+# Number of features of the fake models. A model of n features has n * (n + 1) float32 parameters.
+SIZES = {'tiny': 64, 'small': 128, 'medium': 256, 'large': 512}
+
+
+def _nbytes(model_name):
+    n = SIZES[model_name]
+    return n * (n + 1) * 4
+
+
+def _gb(nbytes):
+    return nbytes / 1024**3
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    """Replace whisper.load_model by small torch modules and record the loads."""
+    loads = []
+
+    def load_model(model_name, device='cpu'):
+        loads.append(model_name)
+        # Some time, so that concurrent loads overlap
+        time.sleep(0.01)
+        return torch.nn.Linear(SIZES[model_name], SIZES[model_name])
+
+    monkeypatch.setattr(model_pool, 'whisper', SimpleNamespace(load_model=load_model), raising=False)
+    return loads
+
+
+def test_reuse(loads):
+    pool = WhisperModelPool(memory_budget_gb=1)
+    model = pool.get('small')
+    assert pool.get('small') is model
+    with pool.acquire('small') as acquired:
+        assert acquired is model
+    assert loads == ['small']
+    assert pool.memory_usage == _nbytes('small')
+    # Another device is another model
+    assert pool.get('small', device='cuda') is not model
+
+
+def test_evict_least_recently_used(loads):
+    pool = WhisperModelPool(memory_budget_gb=_gb(_nbytes('small') + _nbytes('medium')))
+    pool.get('small')
+    pool.get('medium')
+    pool.get('small')
+    # Room for the new model is made by evicting the least recently used
+    pool.get('tiny')
+    assert pool.loaded() == [('small', 'cpu'), ('tiny', 'cpu')]
+    assert pool.memory_usage <= pool.memory_budget
+    pool.get('medium')
+    assert loads == ['small', 'medium', 'tiny', 'medium']
+
+
+def test_model_larger_than_budget(loads):
+    pool = WhisperModelPool(memory_budget_gb=_gb(_nbytes('medium')))
+    pool.get('tiny')
+    pool.get('small')
+    # Still loaded, but it is the only model in the pool
+    model = pool.get('large')
+    assert pool.loaded() == [('large', 'cpu')]
+    assert pool.get('large') is model
+
+
+def test_get_model_pool_lowers_budget(loads, monkeypatch):
+    monkeypatch.setattr(model_pool, '_POOL', WhisperModelPool(memory_budget_gb=1))
+    pool = get_model_pool()
+    pool.get('small')
+    pool.get('tiny')
+    assert get_model_pool(_gb(_nbytes('tiny'))) is pool
+    assert pool.loaded() == [('tiny', 'cpu')]
+    assert get_model_pool().memory_budget_gb == _gb(_nbytes('tiny'))
+
+
+def test_concurrent_loads(loads):
+    pool = WhisperModelPool(memory_budget_gb=1)
+    models = []
+    threads = [threading.Thread(target=lambda: models.append(pool.get('small'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The model is loaded once and shared
+    assert loads == ['small']
+    assert all(model is models[0] for model in models)
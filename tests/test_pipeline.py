@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the dependency tracking of the pipeline stages."""
+
+from nota_bene.pipeline import Pipeline, fingerprint, downstream, MISSING, STALE, FRESH
+
+
+def _run_all(pipeline):
+    pipeline.record('audio', params={'bitrate': '24k'}, inputs=['a.wav'], output=fingerprint('audio'))
+    pipeline.record('transcript', params={'model_type': 'small'}, output=fingerprint('Hello world'))
+    pipeline.record('minute_notes', params={'model': 'llama'}, output=fingerprint('Notes'))
+
+
+def test_downstream():
+    assert downstream('audio') == ['transcript', 'minute_notes']
+    assert downstream('minute_notes') == []
+
+
+def test_state(tmp_path):
+    pipeline = Pipeline(str(tmp_path))
+    assert pipeline.state('transcript') == MISSING
+    _run_all(pipeline)
+    assert pipeline.state('transcript', params={'model_type': 'small'}) == FRESH
+    assert pipeline.stale() == []
+
+    # Other settings only make the stage itself stale
+    assert pipeline.state('transcript', params={'model_type': 'large'}) == STALE
+    assert pipeline.state('minute_notes', params={'model': 'mistral'}) == STALE
+    assert pipeline.state('transcript', params={'model_type': 'small'}) == FRESH
+
+
+def test_upstream_output_changed(tmp_path):
+    pipeline = Pipeline(str(tmp_path))
+    _run_all(pipeline)
+    # Other audio makes the transcript and, through it, the minute notes stale
+    pipeline.record('audio', params={'bitrate': '24k'}, inputs=['b.wav'], output=fingerprint('other audio'))
+    assert pipeline.stale() == ['transcript', 'minute_notes']
+    assert pipeline.reason('minute_notes') == 'the audio changed'
+
+    pipeline.record('transcript', params={'model_type': 'small'}, output=fingerprint('Hello world'))
+    assert pipeline.state('minute_notes') == FRESH
+
+
+def test_edited_output(tmp_path):
+    pipeline = Pipeline(str(tmp_path))
+    _run_all(pipeline)
+    pipeline.update_output('transcript', fingerprint('Hello world!'))
+    # The transcript itself and the audio are untouched
+    assert pipeline.stale() == ['minute_notes']
+    assert pipeline.state('transcript', params={'model_type': 'large'}) == STALE
+    assert pipeline.reason('minute_notes') == 'the transcript changed (edited)'
+
+    pipeline.invalidate('transcript')
+    assert pipeline.state('transcript') == MISSING
+    assert pipeline.state('minute_notes') == MISSING
+    assert pipeline.state('audio') == FRESH
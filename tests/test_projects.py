@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the project manifests."""
+
+import os
+
+from nota_bene.projects import list_projects, read_manifest, update_manifest
+
+
+def test_list_projects_by_name(tmp_path):
+    for name in ('beta', 'Alpha', 'gamma', '.cache'):
+        os.makedirs(tmp_path / name)
+    assert list_projects(str(tmp_path)) == ['Alpha', 'beta', 'gamma']
+
+    # Saving a project does not change the order
+    update_manifest(str(tmp_path / 'gamma'), {'context': 'Hello'})
+    assert list_projects(str(tmp_path)) == ['Alpha', 'beta', 'gamma']
+
+    os.makedirs(tmp_path / 'aardvark')
+    assert list_projects(str(tmp_path)) == ['aardvark', 'Alpha', 'beta', 'gamma']
+
+
+def test_update_manifest(tmp_path):
+    project_path = str(tmp_path / 'meeting')
+    assert read_manifest(project_path)['status'] == 'unknown'
+
+    update_manifest(project_path, {'context': 'Hello', 'model_type': 'small'})
+    update_manifest(project_path, {'minute_notes': 'Notes'})
+    manifest = read_manifest(project_path)
+    assert manifest['name'] == 'meeting'
+    assert manifest['status'] == 'minute notes'
+    # Keys that are not saved again keep their value
+    assert manifest['has'] == {'context': True, 'minute_notes': True}
+    assert manifest['model_type'] == 'small'
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the store of the recorded fragments."""
+
+import os
+import threading
+
+import pytest
+
+from nota_bene.cache import atomic_write_json
+from nota_bene.recordings import RecordingStore
+
+
+def _make_store(project_path, names):
+    store = RecordingStore(project_path)
+    os.makedirs(store.recording_dir)
+    index = []
+    for i, name in enumerate(names):
+        open(os.path.join(store.recording_dir, f'{i}.flac'), 'wb').close()
+        index.append({'id': str(i), 'name': name, 'file': f'{i}.flac', 'duration': 60})
+    atomic_write_json(store.index_path, index)
+    return store
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Store with three fragments, two of them with the same name."""
+    return _make_store(str(tmp_path), ['10:00:00', '10:05:00', '10:05:00'])
+
+
+def test_move(store):
+    store.move('2', 'up')
+    assert [entry['id'] for entry in store.index()] == ['0', '2', '1']
+    store.move('0', 'up')
+    assert [entry['id'] for entry in store.index()] == ['0', '2', '1']
+    store.move('0', 'down')
+    assert [entry['id'] for entry in store.index()] == ['2', '0', '1']
+
+
+def test_remove_fragment_with_same_name(store):
+    store.remove('2')
+    assert [entry['id'] for entry in store.index()] == ['0', '1']
+    assert store.paths() == [os.path.join(store.recording_dir, '0.flac'), os.path.join(store.recording_dir, '1.flac')]
+    assert not os.path.isfile(os.path.join(store.recording_dir, '2.flac'))
+    assert store.duration() == 120
+
+
+def test_stores_of_a_project_share_the_lock(tmp_path):
+    _make_store(str(tmp_path), [f'10:{i:02d}:00' for i in range(40)])
+    # Every rerun of the page creates its own store
+    threads = [threading.Thread(target=lambda i=i: RecordingStore(str(tmp_path)).remove(str(i))) for i in range(40)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert RecordingStore(str(tmp_path)).index() == []
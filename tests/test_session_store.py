@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the per-key store of the session states."""
+
+import io
+import os
+
+from nota_bene.session_store import SessionStore
+
+
+def test_round_trip(tmp_path):
+    db_path = str(tmp_path / 'session.db')
+    store = SessionStore(db_path, blob_threshold=1024)
+    audio = b'\x01' * 4096
+    states = {'context': 'Hello world', 'audio': audio, 'recording': io.BytesIO(audio), 'segments': [{'start': 0.0, 'text': 'Hello'}]}
+    assert sorted(store.save(states)) == sorted(states)
+    store.flush()
+
+    loaded = SessionStore(db_path).load()
+    assert loaded['context'] == 'Hello world'
+    assert loaded['audio'] == audio
+    assert loaded['recording'].getvalue() == audio
+    assert loaded['segments'] == states['segments']
+    # Both binaries are the same blob
+    assert len(os.listdir(tmp_path / '.blobs')) == 1
+
+
+def test_save_only_changed_keys(tmp_path):
+    db_path = str(tmp_path / 'session.db')
+    store = SessionStore(db_path)
+    store.save({'context': 'Hello', 'minute_notes': 'Notes'})
+    store.flush()
+    assert store.save({'context': 'Hello', 'minute_notes': 'Notes'}) == []
+    assert store.save({'context': 'Hello world', 'minute_notes': 'Notes'}) == ['context']
+    store.flush()
+
+    # A new store that loads part of the keys still knows the digests of the others
+    store = SessionStore(db_path)
+    assert store.load(keys=['context']) == {'context': 'Hello world'}
+    assert store.save({'minute_notes': 'Notes'}) == []
+
+
+def test_delete_removes_blobs(tmp_path):
+    db_path = str(tmp_path / 'session.db')
+    store = SessionStore(db_path, blob_threshold=1024)
+    store.save({'context': 'Hello', 'audio': b'\x01' * 4096})
+    store.flush()
+    store.delete(['audio'])
+    store.flush()
+    assert store.load() == {'context': 'Hello'}
+    assert os.listdir(tmp_path / '.blobs') == []
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the map-reduce minute notes."""
+
+import threading
+
+import pytest
+
+from nota_bene.cache import DiskCache
+from nota_bene.summarize import split_text, map_reduce_minute_notes, cached_completion, MAP_QUERY, REDUCE_QUERY
+
+PROMPT = {'query': 'Write the minute notes.', 'instructions': 'Be brief.', 'system': 'You are a secretary.'}
+
+
+@pytest.fixture
+def transcript():
+    """Transcript of about 40k characters with speaker turns of a few sentences."""
+    turns = []
+    for i in range(400):
+        sentences = ' '.join(f'We discussed item {i}-{j} of topic {i * 7 % 13}.' for j in range(1 + i % 3))
+        turns.append(f'Speaker {i % 3}: {sentences}')
+    return '\n'.join(turns)
+
+
+class FakeLLM:
+    """Records the prompts and answers with a short summary of the context."""
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, query, instructions, context, system):
+        with self._lock:
+            self.calls.append((query, context))
+        return f'notes of {len(context)} characters'
+
+
+def test_split_text(transcript):
+    chunks = split_text(transcript, chunk_size=4000, overlap=400)
+    assert len(chunks) > 10
+    assert all(len(chunk) <= 4000 for chunk in chunks)
+    # Every chunk but the last is at least half full
+    assert all(len(chunk) >= 1600 for chunk in chunks[:-1])
+    assert chunks[0] in transcript
+    assert split_text('Short text.', chunk_size=4000) == ['Short text.']
+    assert split_text('  ', chunk_size=4000) == []
+
+
+def test_map_reduce(transcript):
+    llm = FakeLLM()
+    progress = []
+    notes = map_reduce_minute_notes(transcript, PROMPT, llm, chunk_size=4000, max_concurrency=4, progress=lambda *args: progress.append(args))
+    n_chunks = len(split_text(transcript, chunk_size=4000, overlap=400))
+    map_calls = [call for call in llm.calls if call[0] == MAP_QUERY]
+    reduce_calls = [call for call in llm.calls if call[0] != MAP_QUERY]
+    assert len(map_calls) == n_chunks
+    # The partial notes are short, so they are merged in one final pass with the query of the user
+    assert [call[0] for call in reduce_calls] == [PROMPT['query']]
+    assert notes.startswith('notes of')
+    assert progress[-1] == (1, 1, 'reduce')
+
+
+def test_map_reduce_several_passes(transcript):
+    llm = FakeLLM()
+    # Long partial notes do not fit in one reduce prompt
+    complete = lambda query, instructions, context, system: llm(query, instructions, context, system) + ' ' + 'x' * 1500
+    map_reduce_minute_notes(transcript, PROMPT, complete, chunk_size=4000, max_concurrency=4)
+    reduce_queries = [call[0] for call in llm.calls if call[0] != MAP_QUERY]
+    assert len(reduce_queries) > 1
+    assert set(reduce_queries[:-1]) == {REDUCE_QUERY}
+    assert reduce_queries[-1] == PROMPT['query']
+
+
+def test_short_transcript_one_prompt():
+    llm = FakeLLM()
+    map_reduce_minute_notes('Speaker 0: Hello.', PROMPT, llm, chunk_size=4000)
+    assert llm.calls == [(PROMPT['query'], 'Speaker 0: Hello.')]
+
+
+def test_split_text_stable_after_edit(transcript):
+    chunks = split_text(transcript, chunk_size=4000, overlap=0)
+    # Correct a word in the middle of the transcript
+    edited = transcript.replace('item 200-0 of topic', 'item 200-0 on topic')
+    assert edited != transcript
+    edited_chunks = split_text(edited, chunk_size=4000, overlap=0)
+    changed = set(edited_chunks) - set(chunks)
+    assert 1 <= len(changed) <= 2
+    assert len(edited_chunks) - len(changed) == len(set(chunks) & set(edited_chunks))
+
+
+def test_only_changed_chunks_after_edit(transcript, tmp_path):
+    cache = DiskCache(str(tmp_path))
+    llm = FakeLLM()
+    complete = cached_completion(llm, cache, {'model': 'llama'})
+    map_reduce_minute_notes(transcript, PROMPT, complete, chunk_size=4000)
+    n_chunks = len([call for call in llm.calls if call[0] == MAP_QUERY])
+
+    llm.calls.clear()
+    map_reduce_minute_notes(transcript.replace('item 200-0 of topic', 'item 200-0 on topic'), PROMPT, complete, chunk_size=4000)
+    n_mapped = len([call for call in llm.calls if call[0] == MAP_QUERY])
+    # The chunk with the edit and, through the overlap, at most its neighbours
+    assert 1 <= n_mapped <= 3 < n_chunks
+
+    llm.calls.clear()
+    map_reduce_minute_notes(transcript, PROMPT, complete, chunk_size=4000)
+    assert llm.calls == []
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the token counts and the choice of the LLM strategy."""
+
+from nota_bene.summarize import split_text, OVERLAP
+from nota_bene.tokens import estimate_tokens, count_tokens, plan_llm_strategy, describe_plan, CHUNK_STEP
+
+PROMPT = {'query': 'Write the minute notes.', 'instructions': 'Be brief.', 'system': 'You are a secretary.'}
+
+
+def _transcript(n_turns):
+    return '\n'.join(f'Speaker {i % 3}: We discussed item {i} of the budget, and agreed on the next steps.' for i in range(n_turns))
+
+
+def test_estimate_tokens():
+    assert estimate_tokens('') == 0
+    assert estimate_tokens('The cat sat.') == 4
+    # Long words are several tokens
+    assert estimate_tokens('internationalisation') == 5
+
+
+def test_count_tokens():
+    assert count_tokens('') == 0
+    assert count_tokens('Hello world') == count_tokens('Hello world') > 0
+
+
+def test_plan_unlimited():
+    context = _transcript(50)
+    plan = plan_llm_strategy(context, PROMPT, n_ctx=16384)
+    assert plan['preprocessing'] is None
+    assert plan['n_chunks'] == 1
+    assert 'Unlimited' in describe_plan(plan, 16384)
+
+
+def test_plan_chunk_wise():
+    context = _transcript(2000)
+    plan = plan_llm_strategy(context, PROMPT, n_ctx=4096)
+    assert plan['preprocessing'] == 'chunk-wise'
+    assert plan['chunk_size'] % CHUNK_STEP == 0
+    chunks = split_text(context, chunk_size=plan['chunk_size'], overlap=int(OVERLAP * plan['chunk_size']))
+    assert plan['n_chunks'] == len(chunks)
+    # Every chunk fits in the context window with the prompt
+    assert max(count_tokens(chunk) for chunk in chunks) <= plan['available_tokens']
+    # A larger context window needs fewer chunks
+    assert plan_llm_strategy(context, PROMPT, n_ctx=16384)['n_chunks'] < plan['n_chunks']
+
+
+def test_plan_stable_after_edit():
+    context = _transcript(2000)
+    edited = context.replace('item 1000 of', 'item 1000 off')
+    assert plan_llm_strategy(edited, PROMPT, n_ctx=4096)['chunk_size'] == plan_llm_strategy(context, PROMPT, n_ctx=4096)['chunk_size']
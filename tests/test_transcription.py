@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the concurrent, rate limited OpenAI transcription."""
+
+import wave
+import threading
+
+import numpy as np
+import pytest
+
+openai = pytest.importorskip('openai')
+httpx = pytest.importorskip('httpx')
+
+from nota_bene import transcription
+from nota_bene.cache import DiskCache
+from nota_bene.transcription import TokenBucket, call_with_retry, transcribe_openai_concurrent
+
+
+class FakeTime:
+    """Clock that only moves when it sleeps. Like a real sleep, it takes at least a microsecond."""
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += max(seconds, 1e-6)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(transcription, 'time', clock)
+    return clock
+
+
+def _status_error(error_class, status, headers=None):
+    response = httpx.Response(status, headers=headers or {}, request=httpx.Request('POST', 'https://api.openai.com/v1/audio/transcriptions'))
+    return error_class('error', response=response, body=None)
+
+
+class Failing:
+    """Raises the errors in order and then returns 'ok'."""
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(requests_per_minute=600, capacity=5)
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.sleeps == []
+    # Then one request per 0.1 seconds
+    for _ in range(10):
+        bucket.acquire()
+    assert clock.now == pytest.approx(1.0, abs=1e-3)
+
+
+def test_retry_rate_limit(clock):
+    func = Failing(_status_error(openai.RateLimitError, 429, {'retry-after': '5'}), _status_error(openai.InternalServerError, 503))
+    assert call_with_retry(func, max_retries=3) == 'ok'
+    assert func.calls == 3
+    # The Retry-After header is respected
+    assert clock.sleeps[0] >= 5
+    assert len(clock.sleeps) == 2
+
+
+def test_retry_connection_error(clock):
+    func = Failing(openai.APIConnectionError(request=httpx.Request('POST', 'https://api.openai.com')))
+    assert call_with_retry(func) == 'ok'
+    assert func.calls == 2
+
+
+def test_no_retry_client_error(clock):
+    func = Failing(_status_error(openai.BadRequestError, 400))
+    with pytest.raises(openai.BadRequestError):
+        call_with_retry(func, max_retries=3)
+    assert func.calls == 1
+    assert clock.sleeps == []
+
+
+def test_max_retries(clock):
+    func = Failing(*[_status_error(openai.InternalServerError, 500) for _ in range(5)])
+    with pytest.raises(openai.InternalServerError):
+        call_with_retry(func, max_retries=2)
+    assert func.calls == 3
+
+
+def test_retry_with_rate_limiter(clock):
+    bucket = TokenBucket(requests_per_minute=60, capacity=1)
+    func = Failing(_status_error(openai.RateLimitError, 429))
+    call_with_retry(func, rate_limiter=bucket, base_delay=0)
+    # Every attempt takes a token
+    assert clock.now == pytest.approx(1.0, abs=1e-3)
+
+
+class FakeOpenAI:
+    """OpenAI client that returns the number of the chunk in the uploaded WAV. Later chunks finish first."""
+    def __init__(self, n_chunks):
+        self.n_chunks = n_chunks
+        self.uploads = 0
+        self._lock = threading.Lock()
+        self.audio = self
+        self.transcriptions = self
+
+    def create(self, model, file):
+        with wave.open(file) as wav:
+            index = int(round(np.frombuffer(wav.readframes(1), dtype='<i2')[0] / 327.67))
+        with self._lock:
+            self.uploads += 1
+        threading.Event().wait((self.n_chunks - index) * 0.01)
+        return type('Transcription', (), {'text': f'chunk {index}'})()
+
+
+def _chunks(n_chunks):
+    return [(i, np.full(1600, i / 100, dtype=np.float32)) for i in range(n_chunks)]
+
+
+def test_transcribe_openai_concurrent(tmp_path):
+    client = FakeOpenAI(8)
+    cache = DiskCache(str(tmp_path))
+    results = list(transcribe_openai_concurrent(iter(_chunks(8)), client, cache=cache, max_concurrency=4, requests_per_minute=6000))
+    assert client.uploads == 8
+    # In order of completion; the index puts the chunks back in order
+    assert [index for index, _, _ in results] != list(range(8))
+    assert [transcript['text'] for _, transcript, _ in sorted(results, key=lambda result: result[0])] == [f'chunk {i}' for i in range(8)]
+
+    # The chunks are cached by their audio
+    results = list(transcribe_openai_concurrent(iter(_chunks(8)), client, cache=cache, max_concurrency=4, requests_per_minute=6000))
+    assert client.uploads == 8
+    assert all(transcript['cached'] for _, transcript, _ in results)